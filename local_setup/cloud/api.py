@@ -1,21 +1,77 @@
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-import json, time, pathlib
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
+from collections import deque
+from functools import partial
+from typing import Optional
+import asyncio, json, os, time, pathlib
 
+from .dedup import DedupIndex
+from .heartbeat import HeartbeatMonitor
 from .models import score
-
-app = FastAPI(title="DIA Lift POC Ingest")
+from .pacing import advise
+from .registry import DeviceRegistry
+from .retention import (RAW_RETENTION_DAYS, RETENTION_ENABLED, ROLLUP_1H_RETENTION_DAYS,
+                        ROLLUP_1M_RETENTION_DAYS, TIER_FILES)
+from .rules import build_alert, check_rules
+from .sites import MAX_SITES, PERSIST_BUDGET_SEC, SCORE_BUDGET_SEC, Site, SiteShards, parse_nodes, parse_sites
+from .stream import Broker, TailerSet
+from .timesync import ClockCheck, now_reply
+from .tsindex import to_arrow, to_ndjson
 
 DATA_DIR = pathlib.Path(__file__).resolve().parent.parent / "data"
-DATA_FILE = DATA_DIR / "telemetry.jsonl"
-ALERTS_FILE = DATA_DIR / "alerts.jsonl"
+DEVICES_FILE = DATA_DIR / "devices.json"
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-# --- Hard thresholds (tunable) ---
-ECO2_WARN_PPM = 2000     # eCO2 >= 2000 ppm -> alert
-TVOC_WARN_PPB = 1000     # TVOC >= 1000 ppb -> alert
+# Per-site logs, time indexes, rollups and models (data/sites/<site_id>/).
+# With several instances: DIA_NODES=url1,url2,... and DIA_NODE=<this instance's url>.
+# DIA_SITES=site-001,site-002,... limits ingest to those sites (else DIA_MAX_SITES)
+SHARDS = SiteShards(DATA_DIR, os.environ.get("DIA_NODE"), parse_nodes(os.environ.get("DIA_NODES")),
+                    parse_sites(os.environ.get("DIA_SITES")), int(os.environ.get("DIA_MAX_SITES", MAX_SITES)))
+
+# Drops retried samples that carry a seq / msg_id idempotency key
+DEDUP = DedupIndex()
+for _d in SHARDS.dirs():
+    DEDUP.warm_from(_d / "telemetry.jsonl")
+
+# Per-device latest sample + registry, snapshot to data/devices.json
+REGISTRY = DeviceRegistry(DEVICES_FILE)
+
+# Receive stamps (rx_ts) and correction of implausible device timestamps
+CLOCK = ClockCheck()
+
+# "Device offline" alerts for devices that miss their reports
+HEARTBEAT = HeartbeatMonitor(
+    emit=lambda alert: SHARDS.get(alert.get("site_id")).alerts_log.append(alert),
+    last_seen_elsewhere=REGISTRY.last_seen,
+)
+
+# Live fan-out of new telemetry / alerts to /stream subscribers
+BROKER = Broker()
+TAILERS = TailerSet(
+    lambda: [(d / name, kind) for d in SHARDS.dirs()
+             for name, kind in (("telemetry.jsonl", "telemetry"), ("alerts.jsonl", "alert"))],
+    BROKER,
+)
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    REGISTRY.start()
+    HEARTBEAT.seed(REGISTRY.devices(), alerted_before=REGISTRY.saved_at)
+    HEARTBEAT.start()
+    if RETENTION_ENABLED:
+        SHARDS.start()     # hourly raw -> 1-minute -> hourly rollups, per site
+    task = asyncio.create_task(TAILERS.run())
+    yield
+    task.cancel()
+    SHARDS.stop()
+    HEARTBEAT.stop()
+    REGISTRY.stop()
+
+
+app = FastAPI(title="DIA Lift POC Ingest", lifespan=lifespan)
+
 def _flatten(d, parent_key: str = "", sep: str = "."):
     items = []
     for k, v in d.items():
@@ -29,23 +85,133 @@ def _flatten(d, parent_key: str = "", sep: str = "."):
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "time": time.time()}
+    return {
+        "status": "ok",
+        "time": time.time(),
+        "duplicates_dropped": DEDUP.duplicates,
+        "clock": CLOCK.stats(),
+        "stream_subscribers": BROKER.subscribers,
+        "overload": SHARDS.overload(),
+        "heartbeat": HEARTBEAT.stats(),
+        "shards": SHARDS.health(),
+        "retention": {"enabled": RETENTION_ENABLED, "raw_days": RAW_RETENTION_DAYS,
+                      "rollup_1m_days": ROLLUP_1M_RETENTION_DAYS, "rollup_1h_days": ROLLUP_1H_RETENTION_DAYS},
+    }
 
 
 @app.get("/alerts")
-def alerts(limit: int = 100):
+def alerts(limit: int = 100, site_id: Optional[str] = None):
+    if limit < 0:
+        return JSONResponse({"status": "limit must be >= 0"}, status_code=400)
     rows = []
-    if ALERTS_FILE.exists():
-        with open(ALERTS_FILE, "r", encoding="utf-8") as f:
+    for d in SHARDS.dirs(site_id):
+        path = d / "alerts.jsonl"
+        if not path.exists() or limit == 0:
+            continue
+        # Filter first, then keep the newest `limit` matches of each file
+        tail = deque(maxlen=limit)
+        with open(path, "r", encoding="utf-8") as f:
             for line in f:
                 try:
-                    rows.append(json.loads(line))
+                    rec = json.loads(line)
                 except Exception:
                     continue
-    rows = rows[-limit:]
+                if site_id is None or (isinstance(rec, dict) and rec.get("site_id") == site_id):
+                    tail.append(rec)
+        rows.extend(tail)
+    if len(rows) > limit:
+        rows.sort(key=lambda r: r.get("ts") or 0)
+        rows = rows[-limit:]
     return {"count": len(rows), "items": rows}
 
 
+@app.get("/devices")
+def devices():
+    items = REGISTRY.devices()
+    return {"count": len(items), "items": items}
+
+
+@app.get("/devices/offline")
+def devices_offline():
+    items = HEARTBEAT.offline()
+    return {"count": len(items), "items": items}
+
+
+@app.get("/devices/{device_id}/latest")
+def device_latest(device_id: str):
+    latest = REGISTRY.latest(device_id)
+    if latest is None:
+        return JSONResponse({"status": "unknown device"}, status_code=404)
+    return latest
+
+
+@app.get("/stream")
+def stream(device_id: Optional[str] = None, types: Optional[str] = None):
+    """
+    Server-Sent Events of newly ingested samples ("telemetry") and alerts ("alert").
+    device_id / types take comma-separated lists to filter the stream.
+    """
+    devices = [d.strip() for d in device_id.split(",") if d.strip()] if device_id else None
+    kinds = [k.strip() for k in types.split(",") if k.strip()] if types else None
+    sub = BROKER.subscribe(devices, kinds)
+    return StreamingResponse(
+        BROKER.events(sub),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/telemetry")
+def telemetry(
+    device_id: Optional[str] = None,
+    site_id: Optional[str] = None,
+    from_: Optional[float] = Query(None, alias="from"),
+    to: Optional[float] = None,
+    fields: Optional[str] = None,
+    format: str = "ndjson",
+    limit: Optional[int] = None,
+    tier: str = "all",
+):
+    """
+    Stream telemetry in [from, to] (epoch seconds) as NDJSON or Arrow IPC.
+    `fields` is a comma-separated list of flattened keys, e.g. metrics.eco2_ppm.
+    `tier` is raw, 1m, 1h or all (hourly, then 1-minute, then raw rows).
+    """
+    if tier != "all" and tier not in TIER_FILES:
+        return JSONResponse({"status": f"unknown tier: {tier}"}, status_code=400)
+    if limit is not None and limit < 0:
+        return JSONResponse({"status": "limit must be >= 0"}, status_code=400)
+    cols = [c.strip() for c in fields.split(",") if c.strip()] if fields else None
+    tiers = list(TIER_FILES) if tier == "all" else [tier]
+    dirs = [d for d in SHARDS.dirs(site_id) if d.is_dir()]
+
+    def _records():
+        left = limit
+        if left == 0:
+            return
+        for t in tiers:
+            for d in dirs:
+                for rec in SHARDS.index(d, t).query(device_id, site_id, from_, to, cols, left):
+                    yield rec
+                    if left is not None:
+                        left -= 1
+                if left is not None and left <= 0:
+                    return
+
+    records = _records()
+    if format == "arrow":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return JSONResponse({"status": "arrow format requires pyarrow"}, status_code=406)
+        if not cols:
+            return JSONResponse({"status": "arrow format requires fields"}, status_code=400)
+        return StreamingResponse(to_arrow(records, cols), media_type="application/vnd.apache.arrow.stream")
+    if format != "ndjson":
+        return JSONResponse({"status": f"unknown format: {format}"}, status_code=400)
+    return StreamingResponse(to_ndjson(records), media_type="application/x-ndjson")
+
+
 @app.post("/ingest")
 async def ingest(req: Request):
     try:
@@ -53,64 +219,106 @@ async def ingest(req: Request):
     except Exception:
         return JSONResponse({"status": "bad json"}, status_code=400)
 
-    # 1) persist telemetry
-    with open(DATA_FILE, "a", encoding="utf-8") as f:
-        f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+    if not isinstance(payload, dict):
+        return JSONResponse({"status": "bad json"}, status_code=400)
 
-    # 2) ML scoring
-    s = score(payload)
+    # Sites owned by another instance go there (307 keeps the POST body)
+    owner = SHARDS.owner(payload.get("site_id"))
+    if owner is not None:
+        return JSONResponse({"status": "moved", "owner": owner}, status_code=307,
+                            headers={"Location": f"{owner}/ingest"})
+    # Each site costs a directory and threads: only configured / known ones, or a bounded few
+    if not SHARDS.admits(payload.get("site_id")):
+        return JSONResponse({"status": "unknown site"}, status_code=403)
+    # Any sample, even one we refuse or drop, shows the device is alive
+    received = time.time()
+    HEARTBEAT.observe(payload, received_at=received)
 
-    # 3) Hard-rule checks
-    flat = _flatten(payload)
-    rule_alerts = []
+    site = SHARDS.get(payload.get("site_id"))
+    if site.busy:
+        # This site is flooding us; refuse it rather than queue other sites behind it
+        return _retry_later(site, "busy", 429)
 
-    try:
-        eco2 = float(flat.get("metrics.eco2_ppm", "nan"))
-        if eco2 == eco2 and eco2 >= ECO2_WARN_PPM:
-            rule_alerts.append(f"eCO2 high: {eco2:.0f} ppm (>= {ECO2_WARN_PPM})")
-    except Exception:
-        pass
+    # 0) drop duplicates (retries carrying an already-seen or in-flight
+    #    idempotency key); the key only counts as seen once the write succeeded
+    token = DEDUP.reserve(payload)
+    if token is True:
+        return {"status": "duplicate"}
+    CLOCK.stamp(payload, received)
 
+    # 1) persist, then 2) score; each awaited only up to its budget (the work
+    #    itself is never cancelled, it finishes in the background)
+    t0 = time.perf_counter()
+    persisted, processed = site.submit(partial(_persist, received_at=received), _process, payload)
+    persisted.add_done_callback(partial(_persisted, token))
     try:
-        tvoc = float(flat.get("metrics.tvoc_ppb", "nan"))
-        if tvoc == tvoc and tvoc >= TVOC_WARN_PPB:
-            rule_alerts.append(f"TVOC high: {tvoc:.0f} ppb (>= {TVOC_WARN_PPB})")
-    except Exception:
-        pass
+        await asyncio.wait_for(asyncio.shield(persisted), PERSIST_BUDGET_SEC)
+    except asyncio.TimeoutError:
+        # Still queued for writing, so a retry is dropped as a duplicate
+        site.queued += 1
+        site.observe(time.perf_counter() - t0)
+        return _retry_later(site, "queued", 202)
+    try:
+        result = await asyncio.wait_for(asyncio.shield(processed), SCORE_BUDGET_SEC)
+    except asyncio.TimeoutError:
+        # Stored; the score and any alert follow in the background
+        site.deferred += 1
+        flat = _flatten(payload)
+        s = {"score": None, "is_anomaly": False, "deferred": True, "details": {"reason": "deferred"}}
+        result = {"status": "ok", "scoring": s, "next": advise(payload, flat, s, check_rules(flat))}
+    site.observe(time.perf_counter() - t0)
+    return result
+
+
+def _retry_later(site: Site, status: str, code: int) -> JSONResponse:
+    if code == 429:
+        site.rejected += 1
+    after = site.retry_after()
+    return JSONResponse({"status": status, "retry_after": after}, status_code=code,
+                        headers={"Retry-After": str(after)})
+
+
+def _persisted(token, fut) -> None:
+    # A failed write must not leave the key behind, or the device's retry is dropped
+    if fut.cancelled() or fut.exception() is not None:
+        DEDUP.release(token)
+    else:
+        DEDUP.commit(token)
+
+
+def _persist(site: Site, payload: dict, received_at: Optional[float] = None) -> None:
+    # Runs on the site's writer thread
+    site.telemetry_log.append(payload)
+    REGISTRY.observe(payload, received_at)
+
+
+def _process(site: Site, payload: dict, skip_ml: bool) -> dict:
+    # Runs on the site's own thread, after _persist
+
+    # 2) ML scoring (site model if trained, else the shared one), with the
+    #    device's rolling-window features; under overload only the windows
+    #    are kept up to date
+    feats = site.features.catch_up(payload)   # this sample and any other worker wrote before it
+    if feats is None:
+        feats = site.features.update(payload)  # log replaced by retention meanwhile
+    if skip_ml:
+        s = {"score": None, "is_anomaly": False, "details": {"reason": "overload"}}
+    else:
+        s = score(payload, site.model(), feats)
+
+    # 3) Hard-rule checks
+    flat = _flatten(payload)
+    rule_alerts = check_rules(flat)
 
     # 4) write alert if ML or rules triggered
-    if s.get("is_anomaly") or rule_alerts:
-        sample_keys = [
-            "metrics.ambient_temp_c",
-            "metrics.ambient_rh_pct",
-            "metrics.pressure_hpa",
-            "metrics.eco2_ppm",
-            "metrics.tvoc_ppb",
-        ]
-        sample = {k: flat[k] for k in sample_keys if k in flat}
-
-        details = {
-            "algo": (s.get("details") or {}).get("algo", "IF"),
-            "score": s.get("score"),
-            "anomaly_prob": s.get("anomaly_prob"),
-            "is_anomaly": s.get("is_anomaly", False),
-        }
-        if rule_alerts:
-            details["rule_alerts"] = rule_alerts
-            details["algo"] = f"{details['algo']}+Rules"
-
-        alert = {
-            "ts": payload.get("ts", time.time()),
-            "device_id": payload.get("device_id"),
-            "score": s.get("score"),
-            "details": details,
-            "sample": sample,
-        }
-        with open(ALERTS_FILE, "a", encoding="utf-8") as f:
-            f.write(json.dumps(alert, ensure_ascii=False) + "\n")
-
-    return {"status": "ok", "scoring": s}
+    alert = build_alert(payload, flat, s, rule_alerts)
+    if alert is not None:
+        site.alerts_log.append(alert)
+
+    # 5) tell the device when to report next (faster during excursions)
+    return {"status": "ok", "scoring": s, "next": advise(payload, flat, s, rule_alerts)}
 
 @app.get("/now")
-def now():
-    return {"now": time.time()}
\ No newline at end of file
+async def now(t0: Optional[int] = None):
+    # Async so no thread hop sits between the receive and transmit stamps
+    return now_reply(t0, time.time())
\ No newline at end of file
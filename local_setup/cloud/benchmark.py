@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Evaluate and benchmark a model file.
+
+    python -m cloud.benchmark [--model data/model.joblib] [--input FILE ...]
+                              [--inject-rate 0.05] [--single 500] [--seed 0]
+
+Replays a telemetry set (by default every tier in data/ and in each site
+shard, like training) through cloud/models.py and reports:
+  - single-row score() latency (p50/p95/p99) and batch score_batch()
+    throughput for a few batch sizes,
+  - memory: model file size, heap allocated by loading it, and peak heap
+    while scoring the whole set in one batch,
+  - precision / recall / F1 of is_anomaly against labels.
+
+Labels come from a "label" (or "is_anomaly") field on the records when the
+set has one. Otherwise anomalies are injected: a fraction of the rows get
+one or two readings pushed SHIFT_IQR spreads (IQR, or std when larger) away
+from the median and are labelled 1, the rest 0. For models with rolling-window
+features those are computed after injection, so a spike also shows up in
+its device's rates and deviations. Natural outliers in the original data
+count as normal, so precision is a lower bound in that mode.
+
+Each run is appended to data/benchmark_stats.json (next to
+training_stats.json), keyed by model version, so runs can be compared.
+"""
+import argparse
+import json
+import pathlib
+import pickle
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .features import METRICS, FeaturePipeline, add_features
+from .models import MODEL_FILE, _flatten, load_model_file, model_cols, model_version, score, score_batch
+from .sites import telemetry_files
+from .storage import write_json_atomic
+
+DATA_DIR = pathlib.Path(__file__).resolve().parent.parent / "data"
+RESULTS_FILE = DATA_DIR / "benchmark_stats.json"
+
+LABEL_KEYS = ("label", "is_anomaly")
+INJECT_RATE = 0.05
+SHIFT_IQR = 8.0
+SINGLE_ROWS = 500          # score() calls timed one by one
+BATCH_SIZES = [64, 1024, 16384]
+MAX_RUNS = 50              # runs kept in benchmark_stats.json
+
+
+def _read_records(path: pathlib.Path) -> List[Dict[str, Any]]:
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except Exception:
+                continue
+            if isinstance(rec, dict):
+                rows.append(rec)
+    return rows
+
+
+def _label_of(rec: Dict[str, Any]) -> Optional[int]:
+    for k in LABEL_KEYS:
+        if k in rec:
+            return int(bool(rec[k]))
+    return None
+
+
+def _frame(flats: List[Dict[str, Any]], cols: List[str]) -> pd.DataFrame:
+    return pd.DataFrame.from_records(flats, columns=cols).apply(pd.to_numeric, errors="coerce")
+
+
+def _with_windows(X: pd.DataFrame, flats: List[Dict[str, Any]], cols: List[str]) -> pd.DataFrame:
+    # Rolling-window features over the (possibly injected) readings, in record order
+    frame = _frame(flats, ["ts", "device_id"] + [f"metrics.{m}" for m in METRICS])
+    frame["device_id"] = [fl.get("device_id") for fl in flats]
+    for c in X.columns:
+        frame[c] = X[c].to_numpy()
+    return add_features(frame).reindex(columns=cols)
+
+
+def _unflatten(flat: Dict[str, Any]) -> Dict[str, Any]:
+    # Back to the nested payload shape score() expects
+    out: Dict[str, Any] = {}
+    for k, v in flat.items():
+        d = out
+        *parents, leaf = k.split(".")
+        for p in parents:
+            d = d.setdefault(p, {})
+        d[leaf] = v
+    return out
+
+
+def inject_anomalies(X: pd.DataFrame, rate: float, seed: int = 0) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Copy of X with `rate` of the rows shifted far out on 1-2 features, plus labels."""
+    rng = np.random.default_rng(seed)
+    X = X.copy()
+    y = np.zeros(len(X), dtype=int)
+    n = int(round(rate * len(X)))
+    if n == 0 or X.shape[1] == 0:
+        return X, y
+    med = X.median()
+    # IQR alone is ~0 for features that sit at a floor most of the time (eCO2, TVOC)
+    iqr = (X.quantile(0.75) - X.quantile(0.25)).fillna(0.0)
+    spread = pd.concat([iqr, X.std().fillna(0.0)], axis=1).max(axis=1).replace(0, 1.0)
+    rows = rng.choice(len(X), size=n, replace=False)
+    vals = X.to_numpy(dtype=float, copy=True)
+    for r in rows:
+        k = rng.integers(1, min(2, X.shape[1]) + 1)
+        for j in rng.choice(X.shape[1], size=k, replace=False):
+            sign = rng.choice([-1.0, 1.0])
+            vals[r, j] = med.iloc[j] + sign * SHIFT_IQR * spread.iloc[j]
+    y[rows] = 1
+    return pd.DataFrame(vals, columns=X.columns, index=X.index), y
+
+
+def _percentiles(samples_s: List[float]) -> Dict[str, float]:
+    if not samples_s:
+        return {}
+    ms = np.asarray(samples_s) * 1000.0
+    return {"p50_ms": float(np.percentile(ms, 50)), "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)), "mean_ms": float(ms.mean())}
+
+
+def _quality(y: np.ndarray, pred: np.ndarray) -> Dict[str, Any]:
+    tp = int(((pred == 1) & (y == 1)).sum())
+    fp = int(((pred == 1) & (y == 0)).sum())
+    fn = int(((pred == 0) & (y == 1)).sum())
+    precision = tp / (tp + fp) if tp + fp else None
+    recall = tp / (tp + fn) if tp + fn else None
+    f1 = (2 * precision * recall / (precision + recall)
+          if precision is not None and recall is not None and precision + recall else None)
+    return {"tp": tp, "fp": fp, "fn": fn, "tn": int(len(y) - tp - fp - fn),
+            "precision": precision, "recall": recall, "f1": f1}
+
+
+def benchmark(model_path: pathlib.Path = MODEL_FILE, input_paths: Optional[Sequence[pathlib.Path]] = None,
+              inject_rate: float = INJECT_RATE, single_rows: int = SINGLE_ROWS,
+              seed: int = 0) -> Dict[str, Any]:
+    model_path = pathlib.Path(model_path)
+    inputs = [pathlib.Path(p) for p in input_paths] if input_paths else telemetry_files(DATA_DIR)
+    missing = [p for p in inputs if not p.exists()]
+    if not inputs or missing:
+        raise SystemExit(f"No telemetry found at {missing[0] if missing else DATA_DIR}")
+
+    # ---------- memory: loading ----------
+    load_model_file(model_path)   # first load pays for imports (joblib, sklearn)
+    tracemalloc.start()
+    model = load_model_file(model_path)
+    load_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    if model is None:
+        raise SystemExit(f"Cannot load model from {model_path}")
+    cols = model_cols(model)
+    if not cols:
+        raise SystemExit(f"Model {model_path} has no feature columns")
+
+    # ---------- data + labels ----------
+    records = [r for p in inputs for r in _read_records(p)]
+    if not records:
+        raise SystemExit(f"No telemetry found in {', '.join(map(str, inputs))}")
+    labels = [_label_of(r) for r in records]
+    flats = [_flatten(r) for r in records]
+    windowed = [c for c in cols if c.startswith("feat.")]
+    X = _frame(flats, [c for c in cols if c not in windowed])
+    if any(v is not None for v in labels):
+        mode = "labelled"
+        y = np.array([v or 0 for v in labels], dtype=int)
+    else:
+        mode = "synthetic"
+        X, y = inject_anomalies(X, inject_rate, seed)
+    if windowed:
+        X = _with_windows(X, flats, cols)
+
+    # ---------- per-sample feature cost at ingest ----------
+    pipeline = FeaturePipeline()
+    feat = []
+    for r in records[:max(single_rows, 1)]:
+        t0 = time.perf_counter()
+        pipeline.update(r)
+        feat.append(time.perf_counter() - t0)
+
+    # ---------- single-row latency ----------
+    rng = np.random.default_rng(seed)
+    pick = rng.choice(len(X), size=min(single_rows, len(X)), replace=False)
+    payloads = [_unflatten({c: (None if pd.isna(v) else float(v)) for c, v in X.iloc[i].items()})
+                for i in pick]
+    for p in payloads[:10]:
+        score(p, model)   # warm-up
+    single = []
+    for p in payloads:
+        t0 = time.perf_counter()
+        score(p, model)
+        single.append(time.perf_counter() - t0)
+
+    # ---------- batch throughput ----------
+    batches = {}
+    for bs in BATCH_SIZES:
+        times = []
+        for start in range(0, len(X), bs):
+            chunk = X.iloc[start:start + bs]
+            t0 = time.perf_counter()
+            score_batch(model, chunk)
+            times.append(time.perf_counter() - t0)
+        total = sum(times)
+        batches[str(bs)] = dict(_percentiles(times), rows_per_s=len(X) / total if total > 0 else None)
+
+    # ---------- full pass: memory peak + quality ----------
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    res = score_batch(model, X)
+    full_s = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    pred = res["is_anomaly"].to_numpy(dtype=bool).astype(int)
+
+    return {
+        "model_version": model_version(model_path),
+        "model_file": str(model_path),
+        "algo": model.get("model"),
+        "input": [str(p) for p in inputs],
+        "rows": int(len(X)),
+        "labels": mode,
+        "anomaly_rate": float(y.mean()) if len(y) else 0.0,
+        "seed": seed,
+        "latency_single": dict(_percentiles(single), rows=len(single)),
+        "latency_features": dict(_percentiles(feat), rows=len(feat)),
+        "batch": batches,
+        "full_batch": {"elapsed_s": full_s, "rows_per_s": len(X) / full_s if full_s > 0 else None},
+        "memory": {
+            "model_file_bytes": model_path.stat().st_size,
+            "model_pickled_bytes": len(pickle.dumps(model)),
+            "model_load_heap_bytes": load_bytes,
+            "full_batch_peak_heap_bytes": peak,
+        },
+        "quality": _quality(y, pred),
+        "created_at": time.time(),
+    }
+
+
+def save_run(run: Dict[str, Any], path: pathlib.Path = RESULTS_FILE) -> Optional[Dict[str, Any]]:
+    """Append a run to the results file; returns the previous run, if any."""
+    try:
+        runs = json.loads(pathlib.Path(path).read_text(encoding="utf-8")).get("runs", [])
+    except Exception:
+        runs = []
+    prev = runs[-1] if runs else None
+    runs = (runs + [run])[-MAX_RUNS:]
+    write_json_atomic(path, {"runs": runs})
+    return prev
+
+
+def _fmt(v, spec=".3f") -> str:
+    return "n/a" if v is None else format(v, spec)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark and evaluate an anomaly model.")
+    ap.add_argument("--model", default=str(MODEL_FILE), help="model file (joblib or RobustZ JSON)")
+    ap.add_argument("--input", nargs="+", default=None,
+                    help="telemetry JSONL file(s) to replay (default: every tier of every site)")
+    ap.add_argument("--inject-rate", type=float, default=INJECT_RATE,
+                    help="share of rows turned into anomalies when the set has no labels")
+    ap.add_argument("--single", type=int, default=SINGLE_ROWS, help="rows timed through score()")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--no-save", action="store_true", help="do not append to benchmark_stats.json")
+    args = ap.parse_args()
+    run = benchmark(pathlib.Path(args.model), args.input,
+                    args.inject_rate, args.single, args.seed)
+    prev = None if args.no_save else save_run(run)
+
+    q, lat, mem = run["quality"], run["latency_single"], run["memory"]
+    print(f"model {run['model_version']} ({run['algo']}) on {run['rows']} rows, {run['labels']} labels")
+    print(f"  single-row  p50 {_fmt(lat.get('p50_ms'))} ms  p99 {_fmt(lat.get('p99_ms'))} ms")
+    fl = run["latency_features"]
+    print(f"  features    p50 {_fmt(fl.get('p50_ms'))} ms  p99 {_fmt(fl.get('p99_ms'))} ms per sample")
+    for bs, b in run["batch"].items():
+        print(f"  batch {bs:>6}  {_fmt(b['rows_per_s'], ',.0f')} rows/s  p50 {_fmt(b.get('p50_ms'))} ms")
+    print(f"  memory      file {mem['model_file_bytes']:,} B  loaded {mem['model_load_heap_bytes']:,} B  "
+          f"scoring peak {mem['full_batch_peak_heap_bytes']:,} B")
+    print(f"  quality     precision {_fmt(q['precision'])}  recall {_fmt(q['recall'])}  f1 {_fmt(q['f1'])}")
+    if prev is not None:
+        pq = prev.get("quality", {})
+        print(f"  previous    {prev.get('model_version')}: precision {_fmt(pq.get('precision'))}  "
+              f"recall {_fmt(pq.get('recall'))}  single p50 "
+              f"{_fmt(prev.get('latency_single', {}).get('p50_ms'))} ms")
+
+
+if __name__ == "__main__":
+    main()
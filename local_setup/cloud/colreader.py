@@ -0,0 +1,293 @@
+"""
+Memory-mapped column reader for the telemetry JSONL logs.
+
+The loaders used to read each file through text I/O: decode every line,
+json.loads it into a dict, flatten it, then build a DataFrame from the
+dicts. This reader maps the file instead and works on the raw bytes:
+
+  - line boundaries come from one vectorized scan for b"\\n" over the mapping,
+  - each top-level field is found with one compiled regex pass over the
+    whole mapping (`re` runs on the mmap directly, nothing is copied), and a
+    match is placed in its line's slot with searchsorted on those boundaries
+    (or taken in order when every line has exactly one),
+  - for nested fields the bodies of the parent objects ("metrics") are cut
+    out once, joined one per line, and scanned the same way, so
+    "metrics.eco2_ppm" never picks up "agg.max.eco2_ppm",
+  - values land in preallocated NumPy columns: float64 (NaN when missing)
+    for numbers, object for strings; ids are decoded once per distinct value.
+
+Supported fields are top-level scalars ("ts", "device_id") and scalars in a
+flat object one level down ("metrics.eco2_ppm"), which covers every
+telemetry record shape (device samples, aggregated windows and rollups).
+Top-level keys are matched anywhere on the line; no record nests "ts",
+"device_id" or "site_id". Lines that are not a complete {...} object (a
+torn write) are skipped like the old loaders' json.loads failures.
+
+Standalone on purpose (NumPy only, no package imports) so `python
+cloud/train.py` and the dashboard can use it as well as the API.
+
+    python -m cloud.colreader [path ...]     # benchmark against the json loaders
+"""
+import json
+import mmap
+import os
+import pathlib
+import re
+import time
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+METRIC_FIELDS = [
+    "metrics.ambient_temp_c",
+    "metrics.ambient_rh_pct",
+    "metrics.pressure_hpa",
+    "metrics.eco2_ppm",
+    "metrics.tvoc_ppb",
+]
+STRING_FIELDS = {"device_id", "site_id", "tier"}
+DEFAULT_FIELDS = ["ts", "device_id", "site_id"] + METRIC_FIELDS
+
+# One JSON scalar: a string, a number, or a literal
+_VALUE = rb'("[^"\\]*(?:\\.[^"\\]*)*"|-?[0-9][0-9.eE+-]*|null|true|false|NaN|-?Infinity)'
+_NL = ord("\n")
+
+_patterns: Dict[str, "re.Pattern"] = {}
+
+
+def _pattern(key: str) -> "re.Pattern":
+    # Starts with the quoted key, so `re` can skip ahead on the literal
+    pat = _patterns.get(key)
+    if pat is None:
+        pat = _patterns[key] = re.compile(rb'"' + re.escape(key.encode()) + rb'"\s*:\s*' + _VALUE)
+    return pat
+
+
+def _body(parent: str) -> "re.Pattern":
+    # A flat `parent` object; captures what is between its braces
+    key = "{" + parent
+    pat = _patterns.get(key)
+    if pat is None:
+        pat = _patterns[key] = re.compile(rb'"' + re.escape(parent.encode()) + rb'"\s*:\s*\{([^{}]*)\}')
+    return pat
+
+
+def _to_float(tok: bytes) -> float:
+    if tok[:1] == b'"':
+        tok = tok[1:-1]
+    try:
+        return float(tok)
+    except ValueError:
+        return float("nan")
+
+
+def _to_str(tok: bytes):
+    if tok[:1] != b'"':
+        return None if tok == b"null" else tok.decode("ascii")
+    s = tok[1:-1]
+    if b"\\" in s:
+        return json.loads(tok)
+    return s.decode("utf-8", errors="replace")
+
+
+def _floats(tokens: List[bytes]) -> np.ndarray:
+    # Fast path: plain numbers convert in one NumPy call
+    try:
+        return np.array(tokens, dtype="S").astype(np.float64)
+    except ValueError:
+        return np.array([_to_float(t) for t in tokens], dtype=np.float64)
+
+
+def _strings(tokens: List[bytes]) -> np.ndarray:
+    # Ids repeat a lot: decode each distinct value once
+    seen: Dict[bytes, Optional[str]] = {}
+    col = np.empty(len(tokens), dtype=object)
+    col[:] = [seen[t] if t in seen else seen.setdefault(t, _to_str(t)) for t in tokens]
+    return col
+
+
+def _line_bounds(raw: np.ndarray) -> np.ndarray:
+    # Offsets of every "\n" plus the end of an unterminated last line
+    nl = np.flatnonzero(raw == _NL)
+    if len(raw) and (not len(nl) or nl[-1] != len(raw) - 1):
+        nl = np.append(nl, len(raw))
+    return nl
+
+
+def _complete(raw: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    # A line counts if it is "{...}" (ignoring a trailing "\r")
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    nonempty = ends > starts
+    last = np.where(nonempty, ends - 1, 0)
+    last = np.where(nonempty & (raw[last] == ord("\r")) & (last > starts), last - 1, last)
+    return nonempty & (raw[np.minimum(starts, len(raw) - 1)] == ord("{")) & (raw[last] == ord("}"))
+
+
+class _Scan:
+    """Fields of one buffer (a mapped file, or the bodies of its nested objects)."""
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.raw = np.frombuffer(buf, dtype=np.uint8)
+        self.ends = _line_bounds(self.raw)
+        self._subs: Dict[str, tuple] = {}
+
+    def _rows(self, pat: "re.Pattern", count: int) -> Optional[np.ndarray]:
+        # Line of each match; None when there is exactly one per line, in line order
+        if count == len(self.ends):
+            return None
+        pos = np.fromiter((m.start() for m in pat.finditer(self.buf)), dtype=np.int64, count=count)
+        return np.searchsorted(self.ends, pos)
+
+    def sub(self, parent: str):
+        # The `parent` objects' bodies, one per line, as their own scan; copying
+        # them out once is cheaper than checking every key match against its
+        # enclosing braces, and agg.min/agg.max can no longer be confused with metrics
+        if parent not in self._subs:
+            pat = _body(parent)
+            bodies = pat.findall(self.buf)
+            rows = self._rows(pat, len(bodies))
+            self._subs[parent] = (_Scan(b"\n".join(bodies) + b"\n" if bodies else b""), rows)
+        return self._subs[parent]
+
+    def column(self, field: str) -> np.ndarray:
+        n = len(self.ends)
+        is_str = field in STRING_FIELDS
+        col = np.empty(n, dtype=object) if is_str else np.full(n, np.nan)
+        parent, _, key = field.partition(".")
+        if key:
+            inner, rows = self.sub(parent)
+            vals = inner.column(key)
+        else:
+            pat = _pattern(field)
+            tokens = pat.findall(self.buf)
+            rows = self._rows(pat, len(tokens))
+            vals = (_strings(tokens) if is_str else _floats(tokens)) if tokens else None
+        if vals is not None and len(vals):
+            if rows is None:
+                col[:] = vals
+            else:
+                col[rows] = vals   # a key repeated on one line: the last one wins, as in json.loads
+        return col
+
+
+def _empty(fields: Sequence[str]) -> Dict[str, np.ndarray]:
+    return {k: (np.empty(0, dtype=object) if k in STRING_FIELDS else np.empty(0)) for k in fields}
+
+
+def _read_buffer(buf, fields: Sequence[str], site_id: Optional[str] = None) -> Dict[str, np.ndarray]:
+    scan = _Scan(buf)
+    if not len(scan.ends):
+        return _empty(fields)
+    keep = _complete(scan.raw, scan.ends)
+    cols: Dict[str, np.ndarray] = {}
+    if site_id is not None:
+        # Filter first: another site's file (or data/) costs one column, not all of them
+        cols["site_id"] = scan.column("site_id")
+        keep &= cols["site_id"] == site_id
+        if not keep.any():
+            return _empty(fields)
+    cols = {k: cols[k] if k in cols else scan.column(k) for k in fields}
+    return cols if keep.all() else {k: v[keep] for k, v in cols.items()}
+
+
+def read_columns(path: pathlib.Path, fields: Sequence[str] = DEFAULT_FIELDS,
+                 site_id: Optional[str] = None) -> Dict[str, np.ndarray]:
+    """
+    Columns for `fields` from one JSONL file, one entry per complete line
+    (only the lines of `site_id`, if given).
+    """
+    path = pathlib.Path(path)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return _empty(fields)
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            return _read_buffer(mm, fields, site_id)
+
+
+def read_many(paths: Iterable[pathlib.Path], fields: Sequence[str] = DEFAULT_FIELDS,
+              site_id: Optional[str] = None) -> Dict[str, np.ndarray]:
+    """read_columns over several files, concatenated; missing files are skipped."""
+    parts = [read_columns(p, fields, site_id) for p in paths if pathlib.Path(p).exists()]
+    if not parts:
+        return _empty(fields)
+    return {k: np.concatenate([p[k] for p in parts]) for k in fields}
+
+
+# ----------------------------------------------------------------------
+# Benchmark against the line-by-line json loaders
+# ----------------------------------------------------------------------
+def _json_columns(path: pathlib.Path, fields: Sequence[str]) -> Dict[str, list]:
+    # The old way: text I/O, a str and a dict per line
+    cols = {k: [] for k in fields}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except Exception:
+                continue
+            for k in fields:
+                top, _, sub = k.partition(".")
+                v = rec.get(top)
+                if sub:
+                    v = v.get(sub) if isinstance(v, dict) else None
+                cols[k].append(v)
+    return cols
+
+
+def _json_frame(path: pathlib.Path):
+    # What train.py / the dashboard did before: json.loads per line + json_normalize
+    import pandas as pd
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except Exception:
+                pass
+    return pd.json_normalize(rows)
+
+
+def benchmark(paths: List[pathlib.Path], repeat: int = 3) -> List[Dict[str, float]]:
+    """Best-of-`repeat` wall time per loader, plus its peak Python heap (one traced run)."""
+    import tracemalloc
+    import pandas as pd
+    results = []
+    for path in paths:
+        size = path.stat().st_size
+        cases = {
+            "json.loads + json_normalize": lambda: _json_frame(path),
+            "json.loads, fields only": lambda: _json_columns(path, DEFAULT_FIELDS),
+            "mmap columns": lambda: read_columns(path),
+            "mmap columns -> DataFrame": lambda: pd.DataFrame(read_columns(path)),
+        }
+        for name, fn in cases.items():
+            best = float("inf")
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                out = fn()
+                best = min(best, time.perf_counter() - t0)
+            rows = len(out) if not isinstance(out, dict) else len(next(iter(out.values())))
+            del out
+            # Mapped pages are page cache, not heap: tracemalloc sees only what the loader allocates
+            tracemalloc.start()
+            out = fn()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del out
+            results.append({"file": str(path), "case": name, "rows": rows, "seconds": best,
+                            "mb_per_s": size / 1e6 / best, "peak_mb": peak / 1e6})
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="Benchmark the mmap column reader against the json loaders.")
+    ap.add_argument("paths", nargs="*", type=pathlib.Path,
+                    default=[pathlib.Path(__file__).resolve().parent.parent / "data" / "telemetry.jsonl"])
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+    for r in benchmark(args.paths, args.repeat):
+        print(f"{r['case']:>28}: {r['rows']:>9,} rows  {r['seconds'] * 1000:9.1f} ms  "
+              f"{r['mb_per_s']:7.1f} MB/s  peak {r['peak_mb']:8.1f} MB  ({r['file']})")
@@ -0,0 +1,190 @@
+"""
+Bounded in-memory duplicate filter for /ingest.
+
+Devices retry on flaky Wi-Fi, so the same sample can arrive more than once.
+A payload may carry an idempotency key:
+  - "seq" (int, monotonically increasing per boot) plus optional "boot" id
+  - "msg_id" (any scalar, unique per device)
+Payloads without a key are always accepted.
+
+For "seq" we keep a per-(device_id, boot) high-water mark: anything above it is
+new. Keys at or below it (late or retried) are checked against a Bloom filter
+of recently accepted keys. "msg_id" keys only use the Bloom filter.
+Memory is fixed: the stream table is LRU-bounded and the Bloom filter rotates
+between two generations once the current one holds `capacity` keys.
+
+/ingest reserve()s a key before writing the sample and commit()s it only once
+the write succeeded. A Bloom filter cannot forget a key, so until then it is
+held in a small in-flight set: a retry arriving meanwhile is a duplicate, and
+if the write fails release() frees the key for the device's next retry.
+
+The index lives in each process. With `--workers N` a retry that reaches
+another worker than the original is not caught here; the stored copy
+carries the same key, and readers that need exactly-once (train.py _dedup)
+drop it.
+"""
+import hashlib
+import json
+import math
+import os
+import pathlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+MAX_STREAMS = 10000        # tracked (device_id, boot) pairs
+BLOOM_CAPACITY = 200000    # keys per generation
+BLOOM_FP_RATE = 0.001      # target false-positive rate per generation
+WARM_TAIL_BYTES = 4 * 1024 * 1024
+
+
+class BloomFilter:
+    def __init__(self, capacity: int = BLOOM_CAPACITY, fp_rate: float = BLOOM_FP_RATE):
+        self.capacity = capacity
+        self.nbits = max(64, int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.nhash = max(1, int(round(self.nbits / capacity * math.log(2))))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: bytes):
+        # Kirsch-Mitzenmacher double hashing from one 128-bit digest
+        h = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], "little")
+        h2 = int.from_bytes(h[8:], "little") | 1
+        for i in range(self.nhash):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, key: bytes) -> None:
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+def idempotency_key(payload: Dict[str, Any]) -> Optional[Tuple[str, Any, Any, Optional[int]]]:
+    """
+    Return (device_id, boot, key, seq) or None when the payload carries no key.
+    `seq` is the integer sequence number when one is present, else None.
+    A non-integral seq (1.5, NaN...) is not a key: int() would merge distinct samples.
+    """
+    dev = str(payload.get("device_id", ""))
+    boot = payload.get("boot")
+    seq = payload.get("seq")
+    if isinstance(seq, float) and seq.is_integer():
+        seq = int(seq)
+    if isinstance(seq, int) and not isinstance(seq, bool):
+        return dev, boot, f"s:{seq}", seq
+    msg_id = payload.get("msg_id")
+    if msg_id is not None and not isinstance(msg_id, (dict, list)):
+        return dev, boot, f"m:{msg_id}", None
+    return None
+
+
+class DedupIndex:
+    def __init__(self, max_streams: int = MAX_STREAMS, capacity: int = BLOOM_CAPACITY):
+        self.max_streams = max_streams
+        self.capacity = capacity
+        self._hwm: "OrderedDict[Tuple[str, Any], int]" = OrderedDict()
+        self._cur = BloomFilter(capacity)
+        self._prev: Optional[BloomFilter] = None
+        self._inflight = set()    # reserved keys whose write has not finished
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    @staticmethod
+    def _bkey(dev: str, boot: Any, key: str) -> bytes:
+        return f"{dev}\x1f{boot}\x1f{key}".encode("utf-8")
+
+    def _remember(self, bkey: bytes) -> None:
+        if self._cur.count >= self.capacity:
+            self._prev, self._cur = self._cur, BloomFilter(self.capacity)
+        self._cur.add(bkey)
+
+    def _seen(self, bkey: bytes) -> bool:
+        return bkey in self._cur or (self._prev is not None and bkey in self._prev)
+
+    def _accepted(self, stream: Tuple[str, Any], seq: Optional[int], bkey: bytes) -> bool:
+        if seq is not None:
+            hwm = self._hwm.get(stream)
+            if hwm is None or seq > hwm:
+                return False
+        return self._seen(bkey)
+
+    def reserve(self, payload: Dict[str, Any]):
+        """
+        Hold the payload's key while it is written. Returns True if it is a
+        duplicate (drop it), None if it has no key, else a token for
+        commit() / release().
+        """
+        k = idempotency_key(payload)
+        if k is None:
+            return None
+        dev, boot, key, seq = k
+        token = ((dev, boot), seq, self._bkey(dev, boot, key))
+        with self._lock:
+            if token[2] in self._inflight or self._accepted(*token):
+                self.duplicates += 1
+                return True
+            self._inflight.add(token[2])
+        return token
+
+    def commit(self, token) -> None:
+        """The write succeeded: the key now counts as seen."""
+        if token is None or token is True:
+            return
+        stream, seq, bkey = token
+        with self._lock:
+            self._inflight.discard(bkey)
+            if seq is not None:
+                hwm = self._hwm.get(stream)
+                if hwm is None or seq > hwm:
+                    self._hwm[stream] = seq
+                    self._hwm.move_to_end(stream)
+                    if len(self._hwm) > self.max_streams:
+                        self._hwm.popitem(last=False)
+            self._remember(bkey)
+
+    def release(self, token) -> None:
+        """The write failed: forget the reservation so a retry is accepted."""
+        if token is None or token is True:
+            return
+        with self._lock:
+            self._inflight.discard(token[2])
+
+    def check_and_add(self, payload: Dict[str, Any]) -> bool:
+        """
+        Record the payload's key. Returns True if it is a duplicate
+        (and should be dropped), False if it is new or has no key.
+        """
+        token = self.reserve(payload)
+        if token is True:
+            return True
+        self.commit(token)
+        return False
+
+    def warm_from(self, path: pathlib.Path, tail_bytes: int = WARM_TAIL_BYTES) -> int:
+        """
+        Seed the index from the tail of an existing telemetry log so retries that
+        straddle a restart are still caught. Returns the number of keys loaded.
+        """
+        if not path.exists():
+            return 0
+        n = 0
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            start = max(0, size - tail_bytes)
+            f.seek(start)
+            if start:
+                f.readline()  # skip partial first line
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except Exception:
+                    continue
+                if isinstance(rec, dict) and idempotency_key(rec) is not None:
+                    self.check_and_add(rec)
+                    n += 1
+        self.duplicates = 0
+        return n
@@ -0,0 +1,149 @@
+"""
+Streaming feature-drift monitor.
+
+train.py stores, per feature, decile bin edges and the share of training rows
+in each bin (training_stats.json -> "reference"). The monitor drops every new
+sample into the same bins (O(1) per sample) and keeps the counts in a ring of
+time sub-windows, so it always describes the most recent `window_sec` with
+fixed memory. Drift per feature is the Population Stability Index (PSI) of
+the recent bin shares against the training shares; quantiles of the recent
+window are estimated from the same counts.
+"""
+import bisect
+import json
+import math
+import pathlib
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+WINDOW_SEC = 24 * 3600
+SUB_WINDOWS = 24
+PSI_EPS = 1e-4
+PSI_THRESHOLD = 0.25       # > 0.25 is the usual "significant shift" cut-off
+
+
+class FeatureBins:
+    def __init__(self, edges: List[float], expected: List[float],
+                 lo: Optional[float] = None, hi: Optional[float] = None):
+        self.edges = list(edges)
+        self.expected = list(expected)
+        self.nbins = len(self.edges) + 1
+        self.lo = lo
+        self.hi = hi
+
+    def bin(self, v: float) -> int:
+        # Clipped like the training rows the reference was built from
+        if self.lo is not None and v < self.lo:
+            v = self.lo
+        if self.hi is not None and v > self.hi:
+            v = self.hi
+        return bisect.bisect_right(self.edges, v)
+
+
+class DriftMonitor:
+    def __init__(self, reference: Dict[str, Dict[str, Any]],
+                 window_sec: float = WINDOW_SEC, sub_windows: int = SUB_WINDOWS):
+        self.features = {c: FeatureBins(r["edges"], r["expected"], r.get("lo"), r.get("hi"))
+                         for c, r in reference.items()}
+        self.step = window_sec / sub_windows
+        self.sub_windows = sub_windows
+        # (sub-window start, {feature: [counts per bin]})
+        self._ring: deque = deque()
+        self._totals = {c: [0] * f.nbins for c, f in self.features.items()}
+
+    @classmethod
+    def from_stats(cls, path: pathlib.Path, **kw) -> Optional["DriftMonitor"]:
+        try:
+            stats = json.loads(pathlib.Path(path).read_text(encoding="utf-8"))
+        except Exception:
+            return None
+        ref = stats.get("reference")
+        return cls(ref, **kw) if ref else None
+
+    def _expire(self, now: float) -> None:
+        while self._ring and self._ring[0][0] <= now - self.step * self.sub_windows:
+            _, counts = self._ring.popleft()
+            for c, arr in counts.items():
+                tot = self._totals[c]
+                for i, n in enumerate(arr):
+                    tot[i] -= n
+
+    def observe(self, flat: Dict[str, Any], ts: float) -> None:
+        """Add one flattened sample (metrics.* keys) taken at `ts`."""
+        start = ts // self.step * self.step
+        if not self._ring or start > self._ring[-1][0]:
+            self._ring.append((start, {c: [0] * f.nbins for c, f in self.features.items()}))
+            self._expire(start)
+            slot = self._ring[-1][1]
+        else:
+            slot = self._slot(start)
+            if slot is None:
+                return  # older than the window
+        for c, f in self.features.items():
+            try:
+                v = float(flat.get(c))
+            except (TypeError, ValueError):
+                continue
+            if v != v:
+                continue
+            b = f.bin(v)
+            slot[c][b] += 1
+            self._totals[c][b] += 1
+
+    def _slot(self, start: float) -> Optional[Dict[str, List[int]]]:
+        # Late sample: the newest sub-window that started at or before it
+        for s, counts in reversed(self._ring):
+            if s <= start:
+                return counts
+        return None
+
+    def count(self, feature: str) -> int:
+        return sum(self._totals.get(feature, ()))
+
+    def psi(self) -> Dict[str, float]:
+        out = {}
+        for c, f in self.features.items():
+            tot = self._totals[c]
+            n = sum(tot)
+            if n == 0:
+                continue
+            v = 0.0
+            for a_cnt, e in zip(tot, f.expected):
+                a = max(a_cnt / n, PSI_EPS)
+                e = max(e, PSI_EPS)
+                v += (a - e) * math.log(a / e)
+            out[c] = v
+        return out
+
+    def quantiles(self, qs=(0.05, 0.5, 0.95)) -> Dict[str, Dict[str, float]]:
+        # Piecewise-linear estimate inside each bin; open-ended bins are clamped to the edge
+        out = {}
+        for c, f in self.features.items():
+            tot = self._totals[c]
+            n = sum(tot)
+            if n == 0 or not f.edges:
+                continue
+            res = {}
+            for q in qs:
+                target = q * n
+                acc = 0
+                for i, k in enumerate(tot):
+                    if acc + k >= target and k:
+                        lo = f.edges[i - 1] if i > 0 else f.edges[0]
+                        hi = f.edges[i] if i < len(f.edges) else f.edges[-1]
+                        res[str(q)] = lo + (hi - lo) * (target - acc) / k
+                        break
+                    acc += k
+            out[c] = res
+        return out
+
+    def status(self, threshold: float = PSI_THRESHOLD) -> Dict[str, Any]:
+        psi = self.psi()
+        worst = max(psi.values()) if psi else 0.0
+        return {
+            "psi": psi,
+            "max_psi": worst,
+            "drifted": [c for c, v in psi.items() if v > threshold],
+            "samples": {c: self.count(c) for c in self.features},
+            "recent_quantiles": self.quantiles(),
+        }
@@ -0,0 +1,330 @@
+"""
+Rolling-window features per device, computed the same way at ingest and in
+training.
+
+The detector used to see only the five instantaneous readings, so a slow
+eCO2 ramp that never leaves the normal range looked normal at every step.
+For each metric this adds, over the device's previous WINDOW_SAMPLES samples
+that are at most WINDOW_SEC old:
+
+  feat.<metric>.rate    change per minute since the previous sample
+  feat.<metric>.slope   least-squares trend per minute over the window
+  feat.<metric>.std     spread of the window (current sample included)
+  feat.<metric>.dev     current value minus the mean of the previous samples
+
+Both paths feed window_features() the same (rows, WINDOW_SAMPLES + 1) layout,
+oldest sample first and the current one last:
+  - FeaturePipeline at ingest keeps one fixed-size deque per device
+    (LRU-bounded), so each sample costs O(1). It follows the site's shared
+    telemetry log rather than only the samples its own process received:
+    with `--workers N` each worker sees part of a device's samples, and
+    windows built from those alone would differ from training's,
+  - add_features() for training / re-scoring / benchmarks builds the history
+    columns by shifting the frame per device, then makes one vectorized call
+    per metric.
+Sums run column by column in a fixed order, so one row sums exactly like a
+row of a batch: a sample gets bit-identical features either way, provided
+each device's samples are seen in the same order (log order at ingest;
+the frame's row order offline, which train.py sorts by the server's receive
+stamp rx_ts, the same order for one device's samples). A sample that arrives late (retried, older ts) only counts as
+history for samples with a later ts, and "rate" is taken against the
+previous sample closest in time, not the last one to arrive.
+
+Missing history (first sample of a device, or after a gap) gives 0 rather
+than NaN so the IsolationForest can always score; a missing reading stays NaN
+as before. Standalone (NumPy/pandas only) so `python cloud/train.py` can use it.
+"""
+import json
+import os
+import pathlib
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+METRICS = ["ambient_temp_c", "ambient_rh_pct", "pressure_hpa", "eco2_ppm", "tvoc_ppb"]
+STATS = ["rate", "slope", "std", "dev"]
+FEATURE_COLS = [f"feat.{m}.{s}" for m in METRICS for s in STATS]
+
+WINDOW_SAMPLES = 12        # previous samples kept per device
+WINDOW_SEC = 600           # ... and only those at most this old
+MAX_DEVICES = 10000        # devices with live state at ingest (LRU)
+WARM_TAIL_BYTES = 256 * 1024
+
+
+def derived_cols(base_cols: List[str]) -> List[str]:
+    """FEATURE_COLS of the metrics among `base_cols` ("metrics.<name>")."""
+    return [f"feat.{m}.{s}" for m in METRICS if f"metrics.{m}" in base_cols for s in STATS]
+
+
+def _as_float(v) -> float:
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def _rowsum(a: np.ndarray) -> np.ndarray:
+    # Left-to-right over the columns: the same order for 1 row or a million
+    s = a[:, 0].copy()
+    for j in range(1, a.shape[1]):
+        s += a[:, j]
+    return s
+
+
+def window_features(t: np.ndarray, x: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    t, x: (rows, WINDOW_SAMPLES + 1) timestamps and readings, oldest first,
+    current sample in the last column; NaN where there is no history.
+    Returns each of STATS as a (rows,) array.
+    """
+    cur_x = x[:, -1]
+    dt = t - t[:, -1:]                       # seconds relative to the current sample
+    with np.errstate(invalid="ignore"):
+        ok = ~np.isnan(x) & (dt <= 0) & (dt >= -WINDOW_SEC)
+    hist = ok[:, :-1]
+    n_hist = hist.sum(axis=1)
+    has_hist = n_hist > 0
+    cur_ok = ~np.isnan(cur_x) & ~np.isnan(t[:, -1])
+
+    # rate: against the usable previous sample closest in time (the latest
+    # arrival when tied), whatever order they arrived in
+    hdt = np.where(hist, dt[:, :-1], -np.inf)
+    last = hdt.shape[1] - 1 - np.argmax(hdt[:, ::-1], axis=1)
+    rows = np.arange(len(x))
+    prev_x, prev_dt = x[rows, last], dt[rows, last]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rate = np.where(has_hist & (prev_dt < 0), (cur_x - prev_x) / -prev_dt * 60.0, 0.0)
+
+    # dev: against the mean of the previous samples
+    hsum = _rowsum(np.where(hist, x[:, :-1], 0.0))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dev = np.where(has_hist, cur_x - hsum / np.maximum(n_hist, 1), 0.0)
+
+    # std and slope over the whole window, current sample included
+    w = ok & cur_ok[:, None]
+    n = w.sum(axis=1)
+    nn = np.maximum(n, 1)
+    xm = _rowsum(np.where(w, x, 0.0)) / nn
+    tm = _rowsum(np.where(w, dt, 0.0)) / nn
+    xc = np.where(w, x - xm[:, None], 0.0)
+    tc = np.where(w, dt - tm[:, None], 0.0)
+    var_x = _rowsum(xc * xc) / nn
+    var_t = _rowsum(tc * tc)
+    cov = _rowsum(tc * xc)
+    std = np.where(n >= 2, np.sqrt(var_x), 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = np.where((n >= 3) & (var_t > 0), cov / var_t * 60.0, 0.0)
+
+    out = {"rate": rate, "slope": slope, "std": std, "dev": dev}
+    # A missing reading stays missing, whatever its history
+    return {k: np.where(cur_ok, v, np.nan) for k, v in out.items()}
+
+
+def _device_key(v) -> str:
+    return "" if v is None or (isinstance(v, float) and v != v) else str(v)
+
+
+# ----------------------------------------------------------------------
+# Online: one sample at a time
+# ----------------------------------------------------------------------
+class FeaturePipeline:
+    """
+    Per-device window state for /ingest. Not thread-safe: each site updates
+    its own pipeline from its own thread.
+
+    follow() + catch_up() keep it in step with a telemetry log that several
+    processes append to: every sample is folded in once, in log order, so
+    each worker's windows hold all of a device's samples.
+    """
+
+    def __init__(self, max_devices: int = MAX_DEVICES):
+        self.max_devices = max_devices
+        self._hist: "OrderedDict[str, deque]" = OrderedDict()
+        self._path: Optional[pathlib.Path] = None
+        self._offset = 0
+        self._ino = None
+        self._last_line = b""      # last line folded in, to find our place after compaction
+
+    def __len__(self) -> int:
+        return len(self._hist)
+
+    def update(self, payload: Dict[str, Any]) -> Dict[str, float]:
+        """Features for this sample (from the samples before it), then remember it."""
+        key = _device_key(payload.get("device_id"))
+        hist = self._hist.get(key)
+        if hist is None:
+            hist = self._hist[key] = deque(maxlen=WINDOW_SAMPLES)
+            if len(self._hist) > self.max_devices:
+                self._hist.popitem(last=False)
+        else:
+            self._hist.move_to_end(key)
+
+        metrics = payload.get("metrics") or {}
+        if not isinstance(metrics, dict):
+            metrics = {}
+        ts = _as_float(payload.get("ts"))
+        cur = [_as_float(metrics.get(m)) for m in METRICS]
+
+        # One row per metric, same layout as add_features() builds per device
+        t = np.full((len(METRICS), WINDOW_SAMPLES + 1), np.nan)
+        x = np.full((len(METRICS), WINDOW_SAMPLES + 1), np.nan)
+        first = WINDOW_SAMPLES - len(hist)
+        for j, (ht, hx) in enumerate(hist, start=first):
+            t[:, j] = ht
+            x[:, j] = hx
+        t[:, -1] = ts
+        x[:, -1] = cur
+        feats = window_features(t, x)
+        hist.append((ts, cur))
+        return {f"feat.{m}.{s}": float(feats[s][i]) for i, m in enumerate(METRICS) for s in STATS}
+
+    def warm_from(self, path: pathlib.Path, tail_bytes: int = WARM_TAIL_BYTES) -> int:
+        """
+        Replay the tail of a telemetry log so windows survive a restart.
+        Returns the number of samples replayed.
+        """
+        if not path.exists():
+            return 0
+        n = 0
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            start = max(0, size - tail_bytes)
+            f.seek(start)
+            if start:
+                f.readline()  # skip partial first line
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except Exception:
+                    continue
+                if isinstance(rec, dict):
+                    self.update(rec)
+                    n += 1
+        return n
+
+    def follow(self, path: pathlib.Path, tail_bytes: int = WARM_TAIL_BYTES) -> int:
+        """warm_from(path), then fold in whatever catch_up() finds appended to it."""
+        self._path = pathlib.Path(path)
+        self._offset, self._ino = 0, None
+        try:
+            st = os.stat(self._path)
+        except FileNotFoundError:
+            return 0
+        self._ino = st.st_ino
+        self._offset = max(0, st.st_size - tail_bytes)
+        if self._offset:
+            with open(self._path, "rb") as f:
+                f.seek(self._offset)
+                self._offset += len(f.readline())  # skip partial first line
+        return len(self._read_new())
+
+    def catch_up(self, payload: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, float]]:
+        """
+        Fold in the samples appended to the followed log since the last call,
+        by this process or any other. Returns the features of `payload` (told
+        apart by its receive stamp rx_ts) if its line was among them, else None.
+        """
+        if self._path is None:
+            return None
+        want = None if payload is None else (payload.get("rx_ts"), payload.get("device_id"))
+        found = None
+        for rec, feats in self._read_new():
+            if want is not None and want[0] is not None and (rec.get("rx_ts"), rec.get("device_id")) == want:
+                found = feats
+        return found
+
+    def _read_new(self) -> List[tuple]:
+        try:
+            st = os.stat(self._path)
+        except FileNotFoundError:
+            return []
+        if st.st_ino != self._ino or st.st_size < self._offset:
+            # Compacted (replaced) by retention: resume after the last line we folded in
+            self._ino = st.st_ino
+            self._offset = st.st_size
+            start = max(0, st.st_size - WARM_TAIL_BYTES)
+            with open(self._path, "rb") as f:
+                f.seek(start)
+                tail = f.read(st.st_size - start)
+            at = tail.rfind(self._last_line) if self._last_line else -1
+            if at >= 0:
+                self._offset = start + at + len(self._last_line)
+        if st.st_size <= self._offset:
+            return []
+        with open(self._path, "rb") as f:
+            f.seek(self._offset)
+            buf = f.read(st.st_size - self._offset)
+        end = buf.rfind(b"\n") + 1          # only complete lines
+        if not end:
+            return []
+        self._offset += end
+        out = []
+        for line in buf[:end].splitlines(keepends=True):
+            self._last_line = line
+            try:
+                rec = json.loads(line)
+            except Exception:
+                continue
+            if isinstance(rec, dict):
+                out.append((rec, self.update(rec)))
+        return out
+
+
+# ----------------------------------------------------------------------
+# Offline: a whole frame at once
+# ----------------------------------------------------------------------
+def add_features(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Copy of a flattened telemetry frame (ts, device_id, metrics.*) with
+    FEATURE_COLS added. Each device's samples are taken in the frame's row
+    order, so put them in arrival order first (rx_ts, else ts) when the rows
+    come from several files.
+    """
+    df = df.copy()
+    m = len(df)
+    if m == 0:
+        for c in FEATURE_COLS:
+            df[c] = pd.Series(dtype=float)
+        return df
+
+    ts = pd.to_numeric(df["ts"], errors="coerce").to_numpy(dtype=float) if "ts" in df.columns \
+        else np.full(m, np.nan)
+    devices = df["device_id"] if "device_id" in df.columns else pd.Series([None] * m)
+    codes = pd.factorize(pd.Series([_device_key(v) for v in devices], dtype=object))[0]
+    order = np.argsort(codes, kind="stable")          # grouped by device, row order kept
+    inverse = np.empty(m, dtype=np.int64)
+    inverse[order] = np.arange(m)
+    dev_sorted = codes[order]
+    t_sorted = ts[order]
+
+    # Column WINDOW_SAMPLES - k holds the k-th previous sample of the same device
+    idx = np.arange(m)
+    t = np.full((m, WINDOW_SAMPLES + 1), np.nan)
+    t[:, -1] = t_sorted
+    prev = []
+    for k in range(1, WINDOW_SAMPLES + 1):
+        src = idx - k
+        same = src >= 0
+        same[same] = dev_sorted[src[same]] == dev_sorted[same]
+        prev.append((k, src, same))
+        t[same, WINDOW_SAMPLES - k] = t_sorted[src[same]]
+
+    new = {}
+    for metric in METRICS:
+        col = f"metrics.{metric}"
+        vals = pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=float) if col in df.columns \
+            else np.full(m, np.nan)
+        v_sorted = vals[order]
+        x = np.full((m, WINDOW_SAMPLES + 1), np.nan)
+        x[:, -1] = v_sorted
+        for k, src, same in prev:
+            x[same, WINDOW_SAMPLES - k] = v_sorted[src[same]]
+        feats = window_features(t, x)
+        for s in STATS:
+            new[f"feat.{metric}.{s}"] = feats[s][inverse]
+    for c in FEATURE_COLS:
+        df[c] = new[c]
+    return df
+
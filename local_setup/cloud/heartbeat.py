@@ -0,0 +1,234 @@
+"""
+Offline detection: an alert when a device misses its expected reports.
+
+Each device reports at least every interval_s, which it sends in every
+sample (the server advises it, see cloud/pacing.py; it at most doubles per
+report, which MISSED_REPORTS covers). After a sample the deadline is
+
+    received_at + MISSED_REPORTS * interval_s + GRACE_SEC
+
+and it is re-armed by every sample. A device whose deadline passes gets one
+"device offline" alert in its site's alerts.jsonl (rules.offline_alert), and
+counts as online again with its next sample.
+
+Deadlines live in a hashed timer wheel (WHEEL_SLOTS slots of RESOLUTION_SEC):
+re-arming moves the device between two slot dicts in O(1), and each tick
+only looks at the slot(s) that came due, so the cost is O(1) per sample and
+O(expired) per tick, never a scan of every device or of the logs. Deadlines
+further out than one turn of the wheel stay in their slot until their turn.
+
+With several uvicorn workers a device's samples may reach more than one
+worker. Before alerting, a worker checks the shared registry
+(data/devices.json): if another worker has seen the device since, it stops
+tracking it and leaves the alert to that worker.
+"""
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+from .pacing import MAX_INTERVAL_SEC, MIN_INTERVAL_SEC
+from .rules import offline_alert
+
+RESOLUTION_SEC = 1.0
+WHEEL_SLOTS = 512          # one turn: ~8.5 min, more than any normal deadline
+MISSED_REPORTS = 3         # intervals without a sample before a device is offline
+GRACE_SEC = 30             # on top, for Wi-Fi reconnects / retries / time sync
+
+
+def report_interval(v: Any, default: float = MAX_INTERVAL_SEC) -> float:
+    """A device's reported interval_s, clamped to what pacing can advise."""
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return default
+    return min(max(f, MIN_INTERVAL_SEC), MAX_INTERVAL_SEC) if f == f else default
+
+
+def offline_after(interval_s: Any = None, missed: int = MISSED_REPORTS, grace: float = GRACE_SEC) -> float:
+    """Silence (s) after which a device reporting every interval_s is offline."""
+    return missed * report_interval(interval_s) + grace
+
+
+class TimerWheel:
+    """Hashed timer wheel of keys with deadlines. Not thread-safe."""
+
+    def __init__(self, slots: int = WHEEL_SLOTS, resolution: float = RESOLUTION_SEC,
+                 now: Optional[float] = None):
+        self.resolution = resolution
+        self._slots: List[Dict[Hashable, int]] = [{} for _ in range(slots)]   # key -> due tick
+        self._where: Dict[Hashable, int] = {}                                    # key -> slot
+        self._tick = int((time.time() if now is None else now) // resolution)
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._where
+
+    def schedule(self, key: Hashable, when: float) -> None:
+        """(Re-)arm `key` to expire at `when` (epoch seconds)."""
+        due = max(math.ceil(when / self.resolution), self._tick + 1)
+        slot = due % len(self._slots)
+        old = self._where.get(key)
+        if old is not None and old != slot:
+            del self._slots[old][key]
+        self._slots[slot][key] = due
+        self._where[key] = slot
+
+    def cancel(self, key: Hashable) -> None:
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Move the wheel to `now`; returns the keys that expired."""
+        target = int(now // self.resolution)
+        if target <= self._tick:
+            return []
+        n = len(self._slots)
+        expired: List[Hashable] = []
+        # After a long pause every slot is due once, not once per missed turn
+        for tick in range(max(self._tick + 1, target - n + 1), target + 1):
+            slot = self._slots[tick % n]
+            if not slot:
+                continue
+            due = [k for k, t in slot.items() if t <= target]
+            for k in due:
+                del slot[k]
+                del self._where[k]
+            expired.extend(due)
+        self._tick = target
+        return expired
+
+
+class HeartbeatMonitor:
+    """
+    Expected-report tracking per device. observe() from /ingest; a background
+    thread calls tick() every RESOLUTION_SEC and hands offline alerts to `emit`.
+    """
+
+    def __init__(self, emit: Callable[[Dict[str, Any]], None],
+                 last_seen_elsewhere: Optional[Callable[[str], Optional[float]]] = None,
+                 missed: int = MISSED_REPORTS, grace: float = GRACE_SEC):
+        self.emit = emit
+        self.last_seen_elsewhere = last_seen_elsewhere
+        self.missed = missed
+        self.grace = grace
+        self._wheel = TimerWheel()
+        self._devices: Dict[str, Dict[str, Any]] = {}   # device_id -> site_id, interval_s, last_seen
+        self._offline = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.alerts = 0
+        self.recovered = 0
+
+    def _deadline(self, e: Dict[str, Any]) -> float:
+        return e["last_seen"] + offline_after(e["interval_s"], self.missed, self.grace)
+
+    def observe(self, payload: Dict[str, Any], interval_s: Any = None,
+                received_at: Optional[float] = None) -> None:
+        """
+        A sample arrived. `interval_s` defaults to the one in the payload
+        (else the device's previous one).
+        """
+        dev = payload.get("device_id")
+        if dev is None:
+            return
+        dev = str(dev)
+        now = time.time() if received_at is None else received_at
+        with self._lock:
+            e = self._devices.get(dev)
+            if e is None:
+                e = self._devices[dev] = {"interval_s": MAX_INTERVAL_SEC}
+            e["site_id"] = payload.get("site_id", e.get("site_id"))
+            e["interval_s"] = report_interval(interval_s if interval_s is not None else payload.get("interval_s"),
+                                             e["interval_s"])
+            e["last_seen"] = now
+            if dev in self._offline:
+                self._offline.discard(dev)
+                self.recovered += 1
+            self._wheel.schedule(dev, self._deadline(e))
+
+    def seed(self, entries: List[Dict[str, Any]], alerted_before: Optional[float] = None) -> int:
+        """
+        Start tracking devices from registry entries (at startup), so a device
+        that went silent while the service was down is still reported.
+        Devices already past their deadline at `alerted_before` (when the
+        previous run saved the registry) were alerted then: they start offline.
+        """
+        n = 0
+        with self._lock:
+            for r in entries:
+                dev, last = r.get("device_id"), r.get("last_seen")
+                if dev is None or last is None or str(dev) in self._devices:
+                    continue
+                dev = str(dev)
+                fw = r.get("firmware") or {}
+                e = self._devices[dev] = {
+                    "site_id": r.get("site_id"),
+                    "interval_s": report_interval(fw.get("interval_s"), MAX_INTERVAL_SEC),
+                    "last_seen": float(last),
+                }
+                if alerted_before is not None and self._deadline(e) <= alerted_before:
+                    self._offline.add(dev)
+                else:
+                    self._wheel.schedule(dev, self._deadline(e))
+                n += 1
+        return n
+
+    def tick(self, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Alerts for devices whose deadline passed; also passed to `emit`."""
+        now = time.time() if now is None else now
+        alerts = []
+        with self._lock:
+            for dev in self._wheel.advance(now):
+                e = self._devices[dev]
+                if self.last_seen_elsewhere is not None:
+                    other = self.last_seen_elsewhere(dev)
+                    if other is not None and other > e["last_seen"]:
+                        # Another worker has newer samples: it owns this device now
+                        del self._devices[dev]
+                        continue
+                self._offline.add(dev)
+                alerts.append(offline_alert(dev, e.get("site_id"), e["last_seen"], e["interval_s"], now))
+            self.alerts += len(alerts)
+        for a in alerts:
+            try:
+                self.emit(a)
+            except Exception:
+                pass
+        return alerts
+
+    def offline(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entries = [(d, self._devices[d]) for d in self._offline]
+        return [{"device_id": d, "site_id": e.get("site_id"), "last_seen": e["last_seen"],
+                 "silent_s": now - e["last_seen"], "expected_interval_s": e["interval_s"]}
+                for d, e in entries]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"tracked": len(self._devices), "armed": len(self._wheel), "offline": len(self._offline),
+                    "alerts": self.alerts, "recovered": self.recovered}
+
+    def start(self, interval: float = RESOLUTION_SEC) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+
+        def _loop():
+            while not self._stop.wait(interval):
+                self.tick()
+
+        self._thread = threading.Thread(target=_loop, name="heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self._thread = None
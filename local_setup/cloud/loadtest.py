@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Load test /ingest with many simulated devices, comparing a new TCP
+connection per request with keep-alive (and optional pipelining).
+
+    python -m cloud.loadtest [--url http://127.0.0.1:8000] [--devices 200]
+                             [--requests 50] [--mode both] [--pipeline 1] [--sites 8]
+                             [--path /ingest]
+
+Each device sends `requests` samples back to back over raw asyncio streams
+(no client library overhead), with its own device_id / boot / seq so the
+server's de-duplication does not drop anything. Devices are spread over
+`sites` site_ids, as each site is served by one thread.
+Run it against a scratch instance: samples are stored like real ones.
+Any other --path (e.g. /now) is fetched with GET, which isolates the
+connection cost from scoring and storage.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import urllib.parse
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+
+def _payload(site: str, device: str, boot: int, seq: int) -> bytes:
+    return json.dumps({
+        "site_id": site,
+        "device_id": device,
+        "ts": time.time(),
+        "boot": boot,
+        "seq": seq,
+        "metrics": {
+            "ambient_temp_c": 22 + random.random(),
+            "ambient_rh_pct": 40 + random.random(),
+            "pressure_hpa": 830 + random.random(),
+            "eco2_ppm": 400 + random.randint(0, 20),
+            "tvoc_ppb": random.randint(0, 10),
+        },
+    }).encode()
+
+
+def _request(host: str, path: str, body: bytes, keepalive: bool) -> bytes:
+    conn = "keep-alive" if keepalive else "close"
+    if path != "/ingest":
+        return f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: {conn}\r\n\r\n".encode()
+    return (f"POST {path} HTTP/1.1\r\nHost: {host}\r\nConnection: {conn}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n").encode() + body
+
+
+async def _read_response(reader: asyncio.StreamReader) -> Tuple[int, bool, bytes]:
+    """Read one response; returns (status, server wants to keep the connection, body)."""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    status = int(line.split(None, 2)[1])
+    length, keep = 0, True
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        k, _, v = line.decode("latin-1").partition(":")
+        k, v = k.strip().lower(), v.strip().lower()
+        if k == "content-length":
+            length = int(v)
+        elif k == "connection" and v == "close":
+            keep = False
+    body = await reader.readexactly(length)
+    return status, keep, body
+
+
+async def _device(i: int, args, mode: str, host: str, port: int, path: str,
+                  lat: List[float], status: Counter) -> None:
+    site = f"loadtest-{i % args.sites}"
+    device = f"loadtest-{mode}-{i}"
+    boot = random.getrandbits(30)
+    keepalive = mode == "keepalive"
+    depth = args.pipeline if keepalive else 1
+    reader = writer = None
+    seq = 0
+    while seq < args.requests:
+        n = min(depth, args.requests - seq)
+        t0 = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            # Pipelining: write n requests, then read n responses in order
+            writer.write(b"".join(_request(host, path, _payload(site, device, boot, seq + k), keepalive)
+                                  for k in range(n)))
+            await writer.drain()
+            keep = keepalive
+            for _ in range(n):
+                code, k, _ = await _read_response(reader)
+                status[code] += 1
+                keep = keep and k
+        except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+            status[type(e).__name__] += n
+            keep = False
+        lat.append((time.perf_counter() - t0) / n)
+        seq += n
+        if not keep:
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run_mode(args, mode: str) -> Dict[str, Any]:
+    u = urllib.parse.urlsplit(args.url)
+    host, port = u.hostname, u.port or 80
+    path = args.path
+    lat: List[float] = []
+    status: Counter = Counter()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(_device(i, args, mode, host, port, path, lat, status)
+                           for i in range(args.devices)))
+    elapsed = time.perf_counter() - t0
+    ok = status.get(200, 0)
+    ms = np.asarray(lat) * 1000.0 if lat else np.zeros(1)
+    return {
+        "mode": mode if mode == "close" or args.pipeline == 1 else f"{mode} x{args.pipeline}",
+        "devices": args.devices,
+        "requests": sum(status.values()),
+        "ok": ok,
+        "status": {str(k): v for k, v in status.items()},
+        "elapsed_s": elapsed,
+        "rps": ok / elapsed,
+        "rps_per_device": ok / elapsed / args.devices,
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Load test the API: per-request connections vs keep-alive.")
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--devices", type=int, default=200)
+    ap.add_argument("--requests", type=int, default=50, help="samples per device")
+    ap.add_argument("--mode", choices=["close", "keepalive", "both"], default="both")
+    ap.add_argument("--pipeline", type=int, default=1, help="requests in flight per keep-alive connection")
+    ap.add_argument("--sites", type=int, default=8)
+    ap.add_argument("--path", default="/ingest", help="other paths are sent as GET, e.g. /now")
+    args = ap.parse_args()
+
+    modes = ["close", "keepalive"] if args.mode == "both" else [args.mode]
+    results = [asyncio.run(run_mode(args, m)) for m in modes]
+    for r in results:
+        print(f"{r['mode']:>14}: {r['ok']}/{r['requests']} ok in {r['elapsed_s']:.2f}s  "
+              f"{r['rps']:,.0f} req/s  {r['rps_per_device']:.2f} req/s/device  "
+              f"p50 {r['p50_ms']:.1f} ms  p99 {r['p99_ms']:.1f} ms  {r['status']}")
+    if len(results) == 2 and results[0]["rps"] > 0:
+        print(f"keep-alive gain: {results[1]['rps'] / results[0]['rps']:.2f}x req/s")
+
+
+if __name__ == "__main__":
+    main()
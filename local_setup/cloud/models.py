@@ -1,6 +1,7 @@
+import hashlib
 import json
 import pathlib
-from typing import Dict, Any
+from typing import Any, Dict, List, Optional
 
 import numpy as np
 import pandas as pd
@@ -28,32 +29,73 @@ def _flatten(d, parent_key: str = "", sep: str = ".") -> Dict[str, Any]:
     return dict(items)
 
 
-def _load_model():
-    # Load the trained model from disk.
-    if not MODEL_FILE.exists():
+def load_model_file(path: pathlib.Path):
+    # Load a trained model: joblib (IsolationForest) or JSON (RobustZ)
+    if not path.exists():
         return None
     try:
         from joblib import load
-        return load(MODEL_FILE)
+        return load(path)
     except Exception:
         try:
-            return json.loads(MODEL_FILE.read_text(encoding="utf-8"))
+            return json.loads(path.read_text(encoding="utf-8"))
         except Exception:
             return None
 
 
-def score(payload: Dict[str, Any]) -> Dict[str, Any]:
-    # Load model
-    model = _load_model()
+def model_version(path: pathlib.Path = MODEL_FILE) -> Optional[str]:
+    # Content hash, so the same model always gets the same version
+    if not path.exists():
+        return None
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()[:12]
+
+
+_cache: Dict[str, Any] = {}   # path -> (file signature, model)
+
+
+def load_cached(path: pathlib.Path):
+    # Load a model from disk, cached until the file is replaced
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    sig = (st.st_ino, st.st_size, st.st_mtime_ns)
+    hit = _cache.get(str(path))
+    if hit is None or hit[0] != sig:
+        hit = _cache[str(path)] = (sig, load_model_file(path))
+    return hit[1]
+
+
+def _load_model():
+    return load_cached(MODEL_FILE)
+
+
+def model_cols(model) -> List[str]:
+    # Get the feature columns used in training
+    return model.get("cols") or model.get("params", {}).get("cols") or []
+
+
+def score(payload: Dict[str, Any], model=None, features: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    # Load model (the deployed one unless a model is passed in).
+    # `features`: rolling-window values for this sample (cloud/features.py), used
+    # when the model was trained with them
+
+    if model is None:
+        model = _load_model()
     if model is None:
         return {"score": None, "is_anomaly": False, "details": {"reason": "no_model"}}
 
-    # Get the feature columns used in training
-    cols = model.get("cols") or model.get("params", {}).get("cols") or []
+    cols = model_cols(model)
     if not cols:
         return {"score": None, "is_anomaly": False, "details": {"reason": "no_feature_cols"}}
 
     flat = _flatten(payload)
+    if features:
+        flat.update(features)
 
     # Extract only needed features and convert to floats
     row = {}
@@ -103,4 +145,54 @@ def score(payload: Dict[str, Any]) -> Dict[str, Any]:
         }
 
     # ---------- Unknown model type ----------
-    return {"score": None, "is_anomaly": False, "details": {"reason": "unknown_model_type"}}
\ No newline at end of file
+    return {"score": None, "is_anomaly": False, "details": {"reason": "unknown_model_type"}}
+
+
+def score_batch(model, X: pd.DataFrame) -> pd.DataFrame:
+    """
+    Vectorized score() for many rows at once. X holds the model's feature
+    columns (float, NaN for missing). Returns one row per input row with
+    score, anomaly_prob, is_anomaly and algo, matching score() row for row.
+    """
+    out = pd.DataFrame(index=X.index)
+    out["score"] = np.nan
+    out["anomaly_prob"] = np.nan
+    out["is_anomaly"] = False
+    out["algo"] = None
+    if model is None or X.empty:
+        return out
+    cols = model_cols(model)
+    X = X.reindex(columns=cols).astype(float)
+
+    # ---------- IsolationForest ----------
+    if model.get("model") == "IsolationForest":
+        clf = model["clf"]
+        out["algo"] = "IF"
+        # score() fails the whole row if the model rejects it (e.g. NaN input)
+        try:
+            raw = clf.decision_function(X)
+        except Exception:
+            ok = X.notna().all(axis=1)
+            raw = np.full(len(X), np.nan)
+            if ok.any():
+                raw[ok.to_numpy()] = clf.decision_function(X[ok])
+        prob = 1 / (1 + np.exp(5 * raw))
+        out["score"] = raw
+        out["anomaly_prob"] = prob
+        out["is_anomaly"] = prob > 0.6
+        return out
+
+    # ---------- Robust Z-score branch ----------
+    if model.get("model") == "RobustZ":
+        params = model["params"]
+        med = pd.Series({c: float(params["median"].get(c, 0.0)) for c in cols})
+        mad = pd.Series({c: float(params["mad"].get(c, 1e-6)) or 1e-6 for c in cols})
+        k = float(params.get("k", 6.0))
+        z = ((X - med) / (1.4826 * mad)).abs().fillna(0.0)
+        zmax = z.max(axis=1) if cols else pd.Series(0.0, index=X.index)
+        out["algo"] = "RobustZ"
+        out["score"] = zmax
+        out["is_anomaly"] = zmax >= k
+        return out
+
+    return out
@@ -0,0 +1,77 @@
+"""
+Server-driven reporting rate for devices.
+
+Every /ingest answer carries "next": the interval the device should report
+at and a per-metric deadband for send-on-change. The advice is stateless:
+the device echoes its current "interval_s" and why it sent ("reason") in the
+payload, so any worker or shard can answer without per-device memory.
+
+  excursion  (alert, ML flag, a metric near a rule threshold, or a device
+              "threshold" send)
+             -> MIN_INTERVAL_SEC, no deadband: full resolution
+  "change"   (the device sent because a reading left its deadband)
+             -> keep the current interval
+  otherwise  (a quiet heartbeat)
+             -> double the interval, up to MAX_INTERVAL_SEC
+
+A stable station therefore settles on one message per MAX_INTERVAL_SEC
+(12x fewer than the 5 s default) and drops back to 5 s on the first excursion.
+"""
+from typing import Any, Dict, List, Optional
+
+from .rules import ECO2_WARN_PPM, SEV_MEDIUM_PROB, TVOC_WARN_PPB
+
+MIN_INTERVAL_SEC = 5
+MAX_INTERVAL_SEC = 60
+NEAR_THRESHOLD = 0.8       # fraction of a rule threshold that already counts as an excursion
+
+# Send-on-change deadbands (device metric names), used when readings are stable
+DEADBAND = {
+    "ambient_temp_c": 0.3,
+    "ambient_rh_pct": 2.0,
+    "pressure_hpa": 1.0,
+    "eco2_ppm": 100,
+    "tvoc_ppb": 50,
+}
+
+_NEAR = {
+    "eco2_ppm": NEAR_THRESHOLD * ECO2_WARN_PPM,
+    "tvoc_ppb": NEAR_THRESHOLD * TVOC_WARN_PPB,
+}
+
+
+def _as_float(v) -> Optional[float]:
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return None
+    return f if f == f else None
+
+
+def excursion(flat: Dict[str, Any], s: Dict[str, Any], rule_alerts: List[str]) -> bool:
+    if rule_alerts or s.get("is_anomaly"):
+        return True
+    prob = _as_float(s.get("anomaly_prob"))
+    if prob is not None and prob >= SEV_MEDIUM_PROB:
+        return True
+    for key, limit in _NEAR.items():
+        # metrics.* is a window mean for aggregated samples; agg.max.* its peak
+        for k in (f"metrics.{key}", f"agg.max.{key}"):
+            v = _as_float(flat.get(k))
+            if v is not None and v >= limit:
+                return True
+    return False
+
+
+def advise(payload: Dict[str, Any], flat: Dict[str, Any], s: Dict[str, Any],
+           rule_alerts: List[str]) -> Dict[str, Any]:
+    """Recommended next interval and deadband for the device that sent `payload`."""
+    if payload.get("reason") == "threshold" or excursion(flat, s, rule_alerts):
+        return {"interval_s": MIN_INTERVAL_SEC, "deadband": {}, "mode": "excursion"}
+    current = _as_float(payload.get("interval_s")) or MIN_INTERVAL_SEC
+    current = min(max(current, MIN_INTERVAL_SEC), MAX_INTERVAL_SEC)
+    if payload.get("reason") == "change":
+        interval = current
+    else:
+        interval = min(MAX_INTERVAL_SEC, current * 2)
+    return {"interval_s": int(interval), "deadband": DEADBAND, "mode": "stable"}
@@ -0,0 +1,172 @@
+"""
+Latest-value cache and device registry.
+
+ingest() calls `observe(payload)` for every accepted sample, keeping one entry
+per device in memory: first/last seen, sample count, the latest payload and
+its firmware fields (boot, seq, fw, ...). /devices and /devices/{id}/latest
+answer from this table in O(1) instead of scanning the log.
+
+The table is snapshot to data/devices.json by a background thread. With
+several uvicorn workers each one merges its own changes into the shared
+snapshot under a file lock and reloads the result, so every worker converges
+on the same view within one snapshot interval. The dashboard reads the same
+file for its "Latest Data" table and offline warnings.
+"""
+import json
+import pathlib
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from .heartbeat import offline_after
+from .storage import file_lock, write_json_atomic
+
+SNAPSHOT_SEC = 10
+
+_CORE_KEYS = ("device_id", "site_id", "ts", "ts_ms", "rx_ts", "device_ts", "metrics", "agg")
+
+
+class DeviceRegistry:
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self._devices: Dict[str, Dict[str, Any]] = {}
+        self._unsaved: Dict[str, int] = {}    # samples counted since last snapshot
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.saved_at: Optional[float] = None   # of the snapshot last read
+        self._devices = self._read()
+
+    # ---------- updates ----------
+    def observe(self, payload: Dict[str, Any], received_at: Optional[float] = None) -> None:
+        dev = payload.get("device_id")
+        if dev is None:
+            return
+        dev = str(dev)
+        now = time.time() if received_at is None else received_at
+        firmware = {k: v for k, v in payload.items() if k not in _CORE_KEYS}
+        with self._lock:
+            e = self._devices.get(dev)
+            if e is None:
+                e = self._devices[dev] = {"device_id": dev, "first_seen": now, "count": 0}
+            e["site_id"] = payload.get("site_id", e.get("site_id"))
+            e["last_seen"] = now
+            e["last_ts"] = payload.get("ts")
+            e["count"] += 1
+            e["firmware"] = firmware
+            e["latest"] = payload
+            self._unsaved[dev] = self._unsaved.get(dev, 0) + 1
+
+    # ---------- reads ----------
+    @staticmethod
+    def _with_staleness(e: Dict[str, Any], now: float) -> Dict[str, Any]:
+        out = dict(e)
+        out["staleness_s"] = max(0.0, now - float(e.get("last_seen") or 0))
+        # Same rule as the offline alerts (cloud/heartbeat.py), at the device's own rate
+        out["online"] = out["staleness_s"] < offline_after((e.get("firmware") or {}).get("interval_s"))
+        return out
+
+    def devices(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entries = list(self._devices.values())
+        items = []
+        for e in entries:
+            s = self._with_staleness(e, now)
+            s.pop("latest", None)
+            items.append(s)
+        return items
+
+    def last_seen(self, device_id: str) -> Optional[float]:
+        with self._lock:
+            e = self._devices.get(device_id)
+        return None if e is None else e.get("last_seen")
+
+    def latest(self, device_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            e = self._devices.get(device_id)
+        if e is None:
+            return None
+        s = self._with_staleness(e, time.time())
+        return {
+            "device_id": device_id,
+            "last_seen": s["last_seen"],
+            "staleness_s": s["staleness_s"],
+            "online": s["online"],
+            "sample": e.get("latest"),
+        }
+
+    # ---------- persistence ----------
+    def _read(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            raw = json.loads(self.path.read_text(encoding="utf-8"))
+            self.saved_at = raw.get("saved_at")
+            return {e["device_id"]: e for e in raw.get("devices", [])}
+        except Exception:
+            return {}
+
+    def snapshot(self) -> None:
+        """Merge local changes into data/devices.json and reload the shared view."""
+        with self._lock:
+            local = {k: dict(v) for k, v in self._devices.items()}
+            unsaved, self._unsaved = self._unsaved, {}
+        if not unsaved:
+            # Nothing new here; just pick up other workers' changes
+            merged = self._read()
+            with self._lock:
+                for dev, e in merged.items():
+                    if dev not in self._unsaved:
+                        self._devices[dev] = e
+            return
+        try:
+            with file_lock(self.lock_path):
+                merged = self._read()
+                for dev, e in local.items():
+                    d = merged.get(dev)
+                    if d is None:
+                        merged[dev] = e
+                        continue
+                    d["first_seen"] = min(d.get("first_seen", e["first_seen"]), e["first_seen"])
+                    d["count"] = d.get("count", 0) + unsaved.get(dev, 0)
+                    if e.get("last_seen", 0) > d.get("last_seen", 0):
+                        for k in ("site_id", "last_seen", "last_ts", "firmware", "latest"):
+                            d[k] = e.get(k)
+                write_json_atomic(self.path, {"saved_at": time.time(), "devices": list(merged.values())})
+        except Exception:
+            # Keep the counts for the next attempt
+            with self._lock:
+                for dev, n in unsaved.items():
+                    self._unsaved[dev] = self._unsaved.get(dev, 0) + n
+            return
+        with self._lock:
+            # Samples observed while we were writing stay in _unsaved
+            for dev, e in merged.items():
+                pending = self._unsaved.get(dev, 0)
+                mine = self._devices.get(dev)
+                if mine is not None and pending:
+                    e = dict(e, count=e.get("count", 0) + pending)
+                    if mine.get("last_seen", 0) > e.get("last_seen", 0):
+                        for k in ("site_id", "last_seen", "last_ts", "firmware", "latest"):
+                            e[k] = mine.get(k)
+                self._devices[dev] = e
+
+    def start(self, interval: float = SNAPSHOT_SEC) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+
+        def _loop():
+            while not self._stop.wait(interval):
+                self.snapshot()
+
+        self._thread = threading.Thread(target=_loop, name="device-registry", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self._thread = None
+        self.snapshot()
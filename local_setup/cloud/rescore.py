@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Re-score historical telemetry with a model and write a versioned alert set.
+
+    python -m cloud.rescore [--model data/model.joblib] [--input FILE ...]
+                            [--workers N] [--chunk-mb 8]
+
+The input defaults to every telemetry tier in data/ and in each site shard
+(data/sites/<site>/), like training. Each file is split into newline-aligned byte ranges that worker processes
+score in parallel: each chunk is parsed once, scored with models.score_batch
+(vectorized, same results as score()) and checked against the eCO2/TVOC
+rules, and only flagged rows are turned into alerts via rules.build_alert.
+Like /ingest, a row whose site has its own model (data/sites/<site>/model.joblib)
+is scored with that model; every other row uses --model.
+For models trained with rolling-window features, a chunk also reads back
+far enough (features.WINDOW_SEC) to fill each device's window, so features
+match what /ingest computed in the same log order.
+Output goes to data/alerts/<model_version>.jsonl plus a .json manifest, so
+alert sets from different models can be compared offline.
+"""
+import argparse
+import json
+import os
+import pathlib
+import shutil
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .features import METRICS, WINDOW_SEC, add_features
+from .models import MODEL_FILE, _flatten, load_cached, load_model_file, model_cols, model_version, score_batch
+from .rules import build_alert, check_rules
+from .sites import site_dir, site_key, telemetry_files
+
+DATA_DIR = pathlib.Path(__file__).resolve().parent.parent / "data"
+OUT_DIR = DATA_DIR / "alerts"
+CHUNK_MB = 8
+LOOKBACK_STEP = 256 * 1024   # bytes per step when reading back for window history
+
+
+def chunk_ranges(path: pathlib.Path, chunk_bytes: int) -> List[Tuple[int, int]]:
+    """Split a file into byte ranges that start and end on line boundaries."""
+    size = path.stat().st_size
+    ranges = []
+    with open(path, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+# ---------- worker side ----------
+_model = None
+_version = None
+_site_models: Dict[Optional[str], Tuple[Any, Optional[str]]] = {}   # site key -> (model, version)
+
+
+def _single_threaded(model) -> None:
+    # One process per core already; avoid nested thread pools in sklearn
+    clf = (model or {}).get("clf")
+    if clf is not None and hasattr(clf, "n_jobs"):
+        clf.n_jobs = 1
+
+
+def _init_worker(model_path: str, version: str) -> None:
+    global _model, _version
+    _model = load_model_file(pathlib.Path(model_path))
+    _version = version
+    _site_models.clear()
+    _single_threaded(_model)
+
+
+def _resolve(site_id) -> Tuple[Any, Optional[str]]:
+    """(model, version) for a row of this site: its own model if it has one, else --model."""
+    key = site_key(site_id)
+    if key not in _site_models:
+        path = site_dir(DATA_DIR, site_id) / MODEL_FILE.name
+        model = load_cached(path) if key is not None else None
+        if model is None:
+            _site_models[key] = (_model, _version)
+        else:
+            _single_threaded(model)
+            _site_models[key] = (model, model_version(path))
+    return _site_models[key]
+
+
+def _none_if_nan(v):
+    return None if v is None or (isinstance(v, float) and v != v) else v
+
+
+def _parse(buf: bytes) -> List[Dict[str, Any]]:
+    out = []
+    for line in buf.splitlines():
+        try:
+            rec = json.loads(line)
+        except Exception:
+            continue
+        if isinstance(rec, dict):
+            out.append(rec)
+    return out
+
+
+def _first_ts(f, pos: int):
+    # ts of the first complete line at or after pos
+    f.seek(pos)
+    if pos:
+        f.readline()
+    for line in f:
+        try:
+            return float(json.loads(line).get("ts"))
+        except Exception:
+            continue
+    return None
+
+
+def history_start(f, start: int) -> int:
+    """
+    Offset before `start` holding at least WINDOW_SEC of earlier samples
+    (the log is appended in arrival order, so roughly in time order).
+    """
+    t0 = _first_ts(f, start)
+    pos = start
+    while t0 is not None and pos > 0:
+        pos = max(0, pos - LOOKBACK_STEP)
+        t = _first_ts(f, pos)
+        if t is not None and t < t0 - WINDOW_SEC:
+            break
+    if pos:
+        f.seek(pos)
+        f.readline()
+        pos = f.tell()
+    return min(pos, start)
+
+
+def score_chunk(args) -> Dict[str, Any]:
+    path, start, end, part = args
+    with open(path, "rb") as f:
+        f.seek(start)
+        payloads = _parse(f.read(end - start))
+        flats = [_flatten(rec) for rec in payloads]
+        # Rows grouped by the model that scores them: model version -> (model, row numbers)
+        groups: Dict[Optional[str], Tuple[Any, List[int]]] = {}
+        for i, fl in enumerate(flats):
+            model, version = _resolve(fl.get("site_id"))
+            groups.setdefault(version, (model, []))[1].append(i)
+        cols = list(dict.fromkeys(c for m, _ in groups.values() if m for c in model_cols(m)))
+        windowed = any(c.startswith("feat.") for c in cols)
+        hist_start = history_start(f, start) if windowed else start
+        f.seek(hist_start)
+        history = _parse(f.read(start - hist_start))
+
+    if windowed:
+        # History rows only fill the windows; they belong to the previous chunk
+        keep = list(dict.fromkeys(["ts", "device_id"] + [f"metrics.{m}" for m in METRICS] + cols))
+        frame = pd.DataFrame.from_records([_flatten(r) for r in history] + flats, columns=keep)
+        X = add_features(frame).iloc[len(history):].reset_index(drop=True)
+        X = X.reindex(columns=cols).apply(pd.to_numeric, errors="coerce")
+    else:
+        X = pd.DataFrame.from_records(flats, columns=cols).apply(pd.to_numeric, errors="coerce")
+    versions = [None] * len(flats)
+    scored = []
+    for version, (model, rows) in groups.items():
+        scored.append(score_batch(model, X.iloc[rows]))
+        for i in rows:
+            versions[i] = version
+    res = pd.concat(scored).sort_index() if scored else score_batch(None, X)
+
+    # Candidate rows: ML flag or any rule, checked exactly as /ingest does
+    # (including agg.max.* of device-aggregated windows)
+    rules = [check_rules(fl) for fl in flats]
+    flagged = res["is_anomaly"].to_numpy(dtype=bool) if len(res) else np.zeros(0, dtype=bool)
+    if flats:
+        flagged = flagged | np.fromiter((bool(r) for r in rules), dtype=bool, count=len(rules))
+
+    severities = Counter()
+    n_alerts = 0
+    with open(part, "w", encoding="utf-8") as out:
+        for i in np.flatnonzero(flagged):
+            r = res.iloc[i]
+            s = {
+                "score": _none_if_nan(float(r["score"])),
+                "anomaly_prob": _none_if_nan(float(r["anomaly_prob"])),
+                "is_anomaly": bool(r["is_anomaly"]),
+                "details": {"algo": r["algo"] or "IF"},
+            }
+            alert = build_alert(payloads[i], flats[i], s, rules[i])
+            if alert is None:
+                continue
+            alert["model_version"] = versions[i]
+            out.write(json.dumps(alert, ensure_ascii=False) + "\n")
+            severities[alert["severity"]] += 1
+            n_alerts += 1
+    site_models = {k: v for k, (_, v) in _site_models.items() if v != _version}
+    return {"rows": len(payloads), "alerts": n_alerts, "severity": dict(severities),
+            "site_models": site_models}
+
+
+# ---------- driver ----------
+def rescore(model_path: pathlib.Path = MODEL_FILE, input_paths: Optional[Sequence[pathlib.Path]] = None,
+            workers: int = 0, chunk_mb: float = CHUNK_MB) -> Dict[str, Any]:
+    model_path = pathlib.Path(model_path)
+    inputs = [pathlib.Path(p) for p in input_paths] if input_paths else telemetry_files(DATA_DIR)
+    model = load_model_file(model_path)
+    if model is None:
+        raise SystemExit(f"Cannot load model from {model_path}")
+    missing = [p for p in inputs if not p.exists()]
+    if not inputs or missing:
+        raise SystemExit(f"No telemetry found at {missing[0] if missing else DATA_DIR}")
+    version = model_version(model_path)
+    workers = workers or os.cpu_count() or 1
+
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    parts_dir = OUT_DIR / f".parts-{version}-{os.getpid()}"
+    parts_dir.mkdir()
+    ranges = [(p, a, b) for p in inputs for a, b in chunk_ranges(p, int(chunk_mb * 1024 * 1024))]
+    jobs = [(str(p), a, b, str(parts_dir / f"{i:06d}.jsonl")) for i, (p, a, b) in enumerate(ranges)]
+
+    t0 = time.time()
+    try:
+        if workers == 1:
+            _init_worker(str(model_path), version)
+            results = [score_chunk(j) for j in jobs]
+        else:
+            with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                     initargs=(str(model_path), version)) as pool:
+                results = list(pool.map(score_chunk, jobs))
+
+        # Concatenate parts in input order, then publish atomically
+        out_file = OUT_DIR / f"{version}.jsonl"
+        tmp = out_file.with_name(out_file.name + ".tmp")
+        with open(tmp, "wb") as out:
+            for j in jobs:
+                with open(j[3], "rb") as part:
+                    shutil.copyfileobj(part, out)
+        os.replace(tmp, out_file)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    elapsed = time.time() - t0
+
+    severity = Counter()
+    site_models: Dict[str, str] = {}
+    for r in results:
+        severity.update(r["severity"])
+        site_models.update(r["site_models"])
+    rows = sum(r["rows"] for r in results)
+    manifest = {
+        "model_version": version,
+        "model_file": str(model_path),
+        "algo": model.get("model"),
+        "site_models": dict(sorted(site_models.items())),
+        "input": [str(p) for p in inputs],
+        "rows": rows,
+        "alerts": sum(r["alerts"] for r in results),
+        "severity": dict(severity),
+        "workers": workers,
+        "chunks": len(jobs),
+        "elapsed_s": elapsed,
+        "rows_per_s": rows / elapsed if elapsed > 0 else None,
+        "created_at": time.time(),
+        "alerts_file": str(out_file),
+    }
+    out_file.with_suffix(".json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    return manifest
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Re-score historical telemetry with a model.")
+    ap.add_argument("--model", default=str(MODEL_FILE), help="model file (joblib or RobustZ JSON)")
+    ap.add_argument("--input", nargs="+", default=None,
+                    help="telemetry JSONL file(s) to replay (default: every tier of every site)")
+    ap.add_argument("--workers", type=int, default=0, help="processes (default: all cores)")
+    ap.add_argument("--chunk-mb", type=float, default=CHUNK_MB, help="bytes per work item, in MB")
+    args = ap.parse_args()
+    m = rescore(pathlib.Path(args.model), args.input, args.workers, args.chunk_mb)
+    print(f"OK: model {m['model_version']} scored {m['rows']} rows -> {m['alerts']} alerts "
+          f"in {m['elapsed_s']:.2f}s ({m['alerts_file']})")
+
+
+if __name__ == "__main__":
+    main()
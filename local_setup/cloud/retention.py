@@ -0,0 +1,307 @@
+"""
+Retention, tiering and downsampled archival of telemetry.
+
+Three tiers share the raw record shape, so readers can treat them alike:
+  telemetry.jsonl      raw samples, kept RAW_RETENTION_DAYS
+  telemetry_1m.jsonl   1-minute rollups, kept ROLLUP_1M_RETENTION_DAYS
+  telemetry_1h.jsonl   hourly rollups, kept ROLLUP_1H_RETENTION_DAYS (None = forever)
+A rollup record has the bucket start as "ts", per-metric means in "metrics",
+"tier", and "agg" = {"n", "min", "max"} so it can be rolled up again.
+
+Compaction never blocks ingest for long: expired records are folded into
+rollups and the retained records copied to a temp file while workers keep
+appending. Appends are paused (storage.appends_paused) only to copy the few
+lines written in the meantime and rename the temp file over the log.
+
+Rollups are appended to the next tier before the log is replaced, so a pass
+that dies in between would leave the raw records to be rolled up again. A
+journal (<log>.compact.json) notes the rollup log's size first; the next pass
+finding it while the log still holds expired records truncates the rollups
+back, and a pass that raises does so at once.
+"""
+import json
+import os
+import pathlib
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .storage import JsonlLog, appends_paused, file_lock, write_json_atomic
+
+
+
+def _env_days(name: str, default: Optional[float]) -> Optional[float]:
+    # Unset keeps the default; "none" (or "") keeps a tier forever
+    v = os.environ.get(name)
+    if v is None:
+        return default
+    return None if v.strip().lower() in ("", "none") else float(v)
+
+
+# Off by default: the API would otherwise roll the sample data/telemetry.jsonl
+# (old demo readings) up into hourly rollups on its first pass.
+RETENTION_ENABLED = os.environ.get("DIA_RETENTION", "off").strip().lower() in ("1", "on", "true", "yes")
+RAW_RETENTION_DAYS = _env_days("DIA_RAW_DAYS", 7)
+ROLLUP_1M_RETENTION_DAYS = _env_days("DIA_1M_DAYS", 90)
+ROLLUP_1H_RETENTION_DAYS: Optional[float] = _env_days("DIA_1H_DAYS", None)
+RETENTION_INTERVAL_SEC = 3600
+
+RAW_FILE = "telemetry.jsonl"
+TIER_FILES = {"1h": "telemetry_1h.jsonl", "1m": "telemetry_1m.jsonl", "raw": RAW_FILE}
+
+SETTLE_LINES = 1000        # consecutive retained lines before we stop parsing
+FLUSH_BUCKETS = 100000     # bound on buckets held in memory during a pass
+COPY_CHUNK = 1024 * 1024
+
+
+def tier_paths(data_dir: pathlib.Path) -> List[pathlib.Path]:
+    """All telemetry tiers, coarsest (oldest data) first."""
+    return [pathlib.Path(data_dir) / name for name in TIER_FILES.values()]
+
+
+def _as_float(v) -> Optional[float]:
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return None
+    return f if f == f else None
+
+
+class Rollup:
+    """Accumulate records into fixed-width time buckets per device."""
+
+    def __init__(self, width: int, tier: str):
+        self.width = width
+        self.tier = tier
+        self._buckets: Dict[Tuple[Any, Any, int], Dict[str, Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def add(self, rec: Dict[str, Any], ts: float) -> None:
+        start = int(ts // self.width * self.width)
+        key = (rec.get("device_id"), rec.get("site_id"), start)
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = {"n": 0, "sum": {}, "w": {}, "min": {}, "max": {}}
+        agg = rec.get("agg") or {}
+        n = int(agg.get("n", 1))
+        b["n"] += n
+        for k, v in (rec.get("metrics") or {}).items():
+            v = _as_float(v)
+            if v is None:
+                continue
+            lo = _as_float((agg.get("min") or {}).get(k))
+            hi = _as_float((agg.get("max") or {}).get(k))
+            lo = v if lo is None else lo
+            hi = v if hi is None else hi
+            b["sum"][k] = b["sum"].get(k, 0.0) + v * n
+            b["w"][k] = b["w"].get(k, 0) + n
+            b["min"][k] = min(b["min"].get(k, lo), lo)
+            b["max"][k] = max(b["max"].get(k, hi), hi)
+
+    def drain(self) -> Iterator[Dict[str, Any]]:
+        buckets, self._buckets = self._buckets, {}
+        for (dev, site, start), b in sorted(buckets.items(), key=lambda kv: (kv[0][2], str(kv[0][0]))):
+            yield {
+                "site_id": site,
+                "device_id": dev,
+                "ts": start,
+                "tier": self.tier,
+                "metrics": {k: b["sum"][k] / b["w"][k] for k in b["sum"]},
+                "agg": {"n": b["n"], "min": b["min"], "max": b["max"]},
+            }
+
+
+def _copy_range(src, dst, start: int, end: int) -> None:
+    src.seek(start)
+    left = end - start
+    while left > 0:
+        chunk = src.read(min(COPY_CHUNK, left))
+        if not chunk:
+            break
+        dst.write(chunk)
+        left -= len(chunk)
+
+
+def _journal(path: pathlib.Path) -> pathlib.Path:
+    return path.with_name(path.name + ".compact.json")
+
+
+def _has_expired(path: pathlib.Path, cutoff: float) -> bool:
+    # Same scan as compact(): expired records left in the head of the log
+    settled = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if settled >= SETTLE_LINES:
+                break
+            try:
+                rec = json.loads(line)
+                ts = _as_float(rec.get("ts")) if isinstance(rec, dict) else None
+            except Exception:
+                ts = None
+            if ts is not None and ts < cutoff:
+                return True
+            settled += 1
+    return False
+
+
+def _rollback(out_path: pathlib.Path, size: int) -> None:
+    try:
+        if os.stat(out_path).st_size > size:
+            os.truncate(out_path, size)
+    except FileNotFoundError:
+        pass
+
+
+def recover(path: pathlib.Path) -> bool:
+    """
+    Finish a compaction of `path` that stopped after writing rollups: if the
+    log was not replaced, drop those rollups again. True if there was one.
+    """
+    path = pathlib.Path(path)
+    journal = _journal(path)
+    try:
+        j = json.loads(journal.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return False
+    except Exception:
+        j = None
+    if j is not None and path.exists() and _has_expired(path, j["cutoff"]):
+        _rollback(path.with_name(j["out"]), j["out_size"])
+    journal.unlink()
+    return True
+
+
+def compact(path: pathlib.Path, cutoff: float, rollup: Optional[Rollup],
+            out: Optional[JsonlLog]) -> int:
+    """
+    Remove records with ts < cutoff from `path`, folding them into `rollup`
+    (appended to `out`) or dropping them when rollup is None.
+    Returns the number of records removed.
+    """
+    path = pathlib.Path(path)
+    if not path.exists():
+        return 0
+    recover(path)
+    tmp = path.with_name(path.name + ".compact.tmp")
+    journal = _journal(path)
+    mark = None   # size of out before this pass's rollups
+
+    def _flush():
+        nonlocal mark
+        if mark is None:
+            mark = os.stat(out.path).st_size if out.path.exists() else 0
+            write_json_atomic(journal, {"cutoff": cutoff, "out": out.path.name, "out_size": mark})
+        out.append_many(rollup.drain())
+
+    moved = 0
+    try:
+        moved = _compact(path, tmp, cutoff, rollup, _flush)
+    except BaseException:
+        if mark is not None:
+            _rollback(out.path, mark)
+        tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        journal.unlink(missing_ok=True)
+    return moved
+
+
+def _compact(path: pathlib.Path, tmp: pathlib.Path, cutoff: float, rollup: Optional[Rollup],
+             flush) -> int:
+    moved = 0
+    with open(path, "rb") as src, open(tmp, "wb") as dst:
+        end = os.fstat(src.fileno()).st_size
+        pos = 0
+        settled = 0
+        # The log is close to time-ordered: parse until expired records stop
+        # showing up, then copy the remainder verbatim
+        while pos < end and settled < SETTLE_LINES:
+            line = src.readline()
+            if not line.endswith(b"\n"):
+                break
+            pos += len(line)
+            try:
+                rec = json.loads(line)
+                ts = _as_float(rec.get("ts")) if isinstance(rec, dict) else None
+            except Exception:
+                ts = None
+            if ts is not None and ts < cutoff:
+                moved += 1
+                settled = 0
+                if rollup is not None:
+                    rollup.add(rec, ts)
+                    if len(rollup) >= FLUSH_BUCKETS:
+                        flush()
+                continue
+            dst.write(line)
+            settled += 1
+        if moved == 0:
+            dst.close()
+            tmp.unlink()
+            return 0
+        if rollup is not None:
+            flush()
+        end = max(end, pos)
+        _copy_range(src, dst, pos, end)
+        with appends_paused(path) as fd:
+            live_end = os.fstat(fd).st_size
+            _copy_range(src, dst, end, live_end)
+            dst.flush()
+            os.fsync(dst.fileno())
+            os.replace(tmp, path)
+    return moved
+
+
+class RetentionManager:
+    def __init__(self, data_dir: pathlib.Path,
+                 raw_days: Optional[float] = RAW_RETENTION_DAYS,
+                 rollup_1m_days: Optional[float] = ROLLUP_1M_RETENTION_DAYS,
+                 rollup_1h_days: Optional[float] = ROLLUP_1H_RETENTION_DAYS):
+        self.data_dir = pathlib.Path(data_dir)
+        self.raw_days = raw_days
+        self.rollup_1m_days = rollup_1m_days
+        self.rollup_1h_days = rollup_1h_days
+        self.lock_path = self.data_dir / "retention.lock"
+        self.last_run: Dict[str, Any] = {}
+
+    def path(self, tier: str) -> pathlib.Path:
+        return self.data_dir / TIER_FILES[tier]
+
+    def run_once(self, now: Optional[float] = None) -> Dict[str, Any]:
+        """One retention pass; a no-op if another worker is already running one."""
+        now = time.time() if now is None else now
+        with file_lock(self.lock_path, blocking=False) as locked:
+            if not locked:
+                return {}
+            t0 = time.time()
+            stats = {"started_at": now}
+            # Cutoffs are aligned to bucket edges so no bucket is split across passes
+            if self.raw_days is not None:
+                cut_raw = (now - self.raw_days * 86400) // 60 * 60
+                out = JsonlLog(self.path("1m"))
+                try:
+                    stats["raw_to_1m"] = compact(self.path("raw"), cut_raw, Rollup(60, "1m"), out)
+                finally:
+                    out.close()
+            if self.rollup_1m_days is not None:
+                cut_1m = (now - self.rollup_1m_days * 86400) // 3600 * 3600
+                out = JsonlLog(self.path("1h"))
+                try:
+                    stats["1m_to_1h"] = compact(self.path("1m"), cut_1m, Rollup(3600, "1h"), out)
+                finally:
+                    out.close()
+            if self.rollup_1h_days is not None:
+                cut_1h = now - self.rollup_1h_days * 86400
+                stats["1h_dropped"] = compact(self.path("1h"), cut_1h, None, None)
+            stats["elapsed_s"] = time.time() - t0
+            self.last_run = stats
+            return stats
+
+
+if __name__ == "__main__":
+    # Manual pass: python -m cloud.retention
+    data_dir = pathlib.Path(__file__).resolve().parent.parent / "data"
+    sites = data_dir / "sites"
+    for d in [data_dir] + (sorted(p for p in sites.iterdir() if p.is_dir()) if sites.is_dir() else []):
+        print(d.name, RetentionManager(d).run_once())
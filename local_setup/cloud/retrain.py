@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Scheduled, drift-triggered retraining.
+
+    python -m cloud.retrain [--every 3600] [--window-days 7] [--threshold 0.25] [--once]
+
+Each tick feeds the telemetry appended since the previous tick (to data/ and
+every site shard) into a DriftMonitor built from the shared
+training_stats.json. When any feature's PSI exceeds
+the threshold (with enough recent samples, and not within the cooldown), the
+model is refit on only the last `window_days` of raw telemetry, read through
+the sparse time index, and promoted atomically by train.fit. The running API
+picks the new model.joblib up on its next score, without a restart.
+Samples pass through the same rolling-window pipeline as /ingest, so the
+window features (feat.*) are monitored alongside the readings.
+Drift status is written to data/drift_status.json every tick.
+"""
+import argparse
+import json
+import os
+import pathlib
+import time
+from typing import Any, Dict, Optional
+
+from . import train
+from .drift import PSI_THRESHOLD, WINDOW_SEC, DriftMonitor
+from .features import FeaturePipeline
+from .sites import site_dirs
+from .storage import write_json_atomic
+from .tsindex import TelemetryIndex
+
+DATA_DIR = pathlib.Path(__file__).resolve().parent.parent / "data"
+STATUS_FILE = DATA_DIR / "drift_status.json"
+
+RETRAIN_EVERY_SEC = 3600
+TRAIN_WINDOW_DAYS = 7
+MIN_SAMPLES = 500          # per feature, before drift is trusted
+COOLDOWN_SEC = 6 * 3600    # minimum gap between two retrains
+
+
+class Retrainer:
+    def __init__(self, window_days: float = TRAIN_WINDOW_DAYS, threshold: float = PSI_THRESHOLD,
+                 drift_window_sec: float = WINDOW_SEC, cooldown_sec: float = COOLDOWN_SEC):
+        self.window_days = window_days
+        self.threshold = threshold
+        self.drift_window_sec = drift_window_sec
+        self.cooldown_sec = cooldown_sec
+        self.indexes: Dict[str, TelemetryIndex] = {}
+        self.monitor: Optional[DriftMonitor] = None
+        self.features = FeaturePipeline()
+        self.last_retrain = 0.0
+        self.last_bootstrap = 0.0   # last bootstrap attempt, successful or not
+        self._offsets: Dict[str, tuple] = {}   # path -> (inode, bytes consumed)
+
+    def _logs(self) -> Dict[str, TelemetryIndex]:
+        # Raw log of data/ and of every site shard, picking up new sites
+        for d in site_dirs(DATA_DIR):
+            path = str(d / "telemetry.jsonl")
+            if path not in self.indexes:
+                self.indexes[path] = TelemetryIndex(pathlib.Path(path))
+        return self.indexes
+
+    def _query(self, t_from: float):
+        for idx in self._logs().values():
+            yield from idx.query(t_from=t_from)
+
+    def _feed(self, rec: Dict[str, Any]) -> None:
+        try:
+            ts = float(rec.get("ts"))
+        except (TypeError, ValueError):
+            return
+        flat = train._flatten(rec)
+        flat.update(self.features.update(rec))
+        self.monitor.observe(flat, ts)
+
+    def _reset_monitor(self) -> None:
+        # Fresh monitor against the current reference, primed with the recent window
+        self.monitor = DriftMonitor.from_stats(train.STATS_FILE, window_sec=self.drift_window_sec)
+        self.features = FeaturePipeline()
+        if self.monitor is not None:
+            for rec in self._query(time.time() - self.drift_window_sec):
+                self._feed(rec)
+        self._offsets = {}
+        for path, idx in self._logs().items():
+            idx.refresh()
+            if os.path.exists(path):
+                self._offsets[path] = (os.stat(path).st_ino, idx.indexed_upto)
+
+    def _read_new(self) -> None:
+        # Feed complete lines appended since the last tick
+        for path in self._logs():
+            if not os.path.exists(path):
+                continue
+            st = os.stat(path)
+            ino, offset = self._offsets.get(path, (st.st_ino, 0))   # new site: from the start
+            if st.st_ino != ino or st.st_size < offset:
+                self._reset_monitor()  # log replaced (retention / restore)
+                return
+            with open(path, "rb") as f:
+                f.seek(offset)
+                buf = f.read(st.st_size - offset)
+            end = buf.rfind(b"\n") + 1
+            self._offsets[path] = (ino, offset + end)
+            for line in buf[:end].splitlines():
+                try:
+                    rec = json.loads(line)
+                except Exception:
+                    continue
+                if isinstance(rec, dict):
+                    self._feed(rec)
+
+    def retrain(self, reason: str) -> Dict[str, Any]:
+        since = time.time() - self.window_days * 86400
+        df = train._frame(self._query(since))
+        if len(df) < MIN_SAMPLES:
+            # Never replace the deployed model with one fit on a handful of rows
+            raise SystemExit(f"Only {len(df)} rows in the last {self.window_days} days (< {MIN_SAMPLES})")
+        stats = train.fit(df, source=f"{DATA_DIR} (last {self.window_days} days)")
+        self.last_retrain = time.time()
+        print(f"RETRAIN ({reason}): {stats['algo']} on {stats['rows_used']} rows")
+        self._reset_monitor()
+        return stats
+
+    def tick(self) -> Dict[str, Any]:
+        if self.monitor is None:
+            self._reset_monitor()
+        else:
+            self._read_new()
+        now = time.time()
+        status: Dict[str, Any] = {"checked_at": now, "threshold": self.threshold, "retrained": False}
+        cooled = now - self.last_retrain >= self.cooldown_sec
+        if self.monitor is None:
+            # No reference distribution yet (model predates drift tracking): bootstrap one,
+            # at most once per cooldown even when the attempt fails (too few rows...)
+            status["reason"] = "no_reference"
+            if cooled and now - self.last_bootstrap >= self.cooldown_sec:
+                self.last_bootstrap = now
+                try:
+                    self.retrain("no reference distribution")
+                    status["retrained"] = True
+                except SystemExit as e:
+                    status["error"] = str(e)
+                except Exception as e:
+                    status["error"] = f"retrain failed: {e!r}"
+        else:
+            status.update(self.monitor.status(self.threshold))
+            enough = [c for c in status["drifted"] if status["samples"][c] >= MIN_SAMPLES]
+            if enough and cooled:
+                try:
+                    self.retrain("drift in " + ", ".join(enough))
+                    status["retrained"] = True
+                except SystemExit as e:
+                    status["error"] = str(e)
+                except Exception as e:
+                    # Bad rows, a fit error...: keep the deployed model, try again next tick
+                    status["error"] = f"retrain failed: {e!r}"
+        write_json_atomic(STATUS_FILE, status)
+        return status
+
+    def run(self, every: float = RETRAIN_EVERY_SEC) -> None:
+        while True:
+            try:
+                s = self.tick()
+                print(f"DRIFT: max_psi={s.get('max_psi', 0):.3f} drifted={s.get('drifted', [])} "
+                      f"retrained={s['retrained']}" + (f" error={s['error']}" if s.get("error") else ""))
+            except Exception as e:
+                # One bad tick (unreadable log, full disk...) must not end the scheduler
+                print(f"DRIFT: tick failed: {e!r}")
+            time.sleep(every)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Retrain the anomaly model when features drift.")
+    ap.add_argument("--every", type=float, default=RETRAIN_EVERY_SEC, help="seconds between checks")
+    ap.add_argument("--window-days", type=float, default=TRAIN_WINDOW_DAYS, help="training window")
+    ap.add_argument("--threshold", type=float, default=PSI_THRESHOLD, help="PSI that triggers retraining")
+    ap.add_argument("--drift-window-sec", type=float, default=WINDOW_SEC, help="recent window compared")
+    ap.add_argument("--once", action="store_true", help="run a single check and exit")
+    args = ap.parse_args()
+    r = Retrainer(args.window_days, args.threshold, args.drift_window_sec)
+    if args.once:
+        print(json.dumps(r.tick(), indent=2))
+    else:
+        r.run(args.every)
+
+
+if __name__ == "__main__":
+    main()
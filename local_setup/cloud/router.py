@@ -0,0 +1,89 @@
+"""
+Front door for several ingest instances, each owning a share of the sites.
+
+    DIA_NODES=http://10.0.0.5:8001,http://10.0.0.6:8001 uvicorn cloud.router:app --port 8000
+
+Every instance runs `uvicorn cloud.api:app` with the same DIA_NODES and its own
+DIA_NODE. The router hashes site_id onto the same ring (cloud/sites.py) and:
+  - POST /ingest: forwards the body to the owner and relays its answer
+    (devices do not follow redirects),
+  - GET with ?site_id=: redirects to the owner,
+  - GET /now: answered here (devices sync their clock through the router,
+    and a forwarding hop would only add to the round trip they measure),
+  - GET /health: this router's view of the ring.
+"""
+import asyncio
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+from typing import Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, RedirectResponse, Response
+
+from .sites import HashRing, parse_nodes
+from .timesync import now_reply
+
+NODES = parse_nodes(os.environ.get("DIA_NODES"))
+RING = HashRing(NODES)
+FORWARD_TIMEOUT_SEC = 5
+
+app = FastAPI(title="DIA Lift POC Router")
+
+
+def _forward(url: str, body: bytes, content_type: str):
+    req = urllib.request.Request(url, data=body, method="POST",
+                                 headers={"Content-Type": content_type or "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=FORWARD_TIMEOUT_SEC) as r:
+            return r.status, r.read(), dict(r.headers)
+    except urllib.error.HTTPError as e:
+        return e.code, e.read(), dict(e.headers)
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok" if NODES else "no nodes configured", "nodes": NODES}
+
+
+@app.get("/now")
+async def now(t0: Optional[int] = None):
+    return now_reply(t0, time.time())
+
+
+@app.post("/ingest")
+async def ingest(req: Request):
+    body = await req.body()
+    try:
+        payload = json.loads(body)
+    except Exception:
+        return JSONResponse({"status": "bad json"}, status_code=400)
+    node = RING.node_for(payload.get("site_id") if isinstance(payload, dict) else None)
+    if node is None:
+        return JSONResponse({"status": "no nodes configured"}, status_code=503)
+    try:
+        status, data, headers = await asyncio.to_thread(
+            _forward, f"{node}/ingest", body, req.headers.get("content-type"))
+    except Exception as e:
+        return JSONResponse({"status": "node unreachable", "node": node, "error": str(e)},
+                            status_code=502, headers={"Retry-After": "1"})
+    keep = {k: v for k, v in headers.items() if k.lower() == "retry-after"}
+    return Response(data, status_code=status, media_type="application/json", headers=keep)
+
+
+@app.get("/{path:path}")
+def by_site(path: str, req: Request):
+    site_id = req.query_params.get("site_id")
+    if site_id is None:
+        return JSONResponse({"status": "site_id required behind the router", "nodes": NODES},
+                            status_code=400)
+    node = RING.node_for(site_id)
+    if node is None:
+        return JSONResponse({"status": "no nodes configured"}, status_code=503)
+    url = f"{node}/{path}"
+    if req.url.query:
+        url += "?" + req.url.query
+    return RedirectResponse(url, status_code=307)
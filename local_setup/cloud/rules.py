@@ -0,0 +1,115 @@
+"""
+Hard-rule checks and alert construction shared by /ingest and the batch
+re-scoring job, so live and backfilled alerts have exactly the same shape.
+"""
+import time
+from typing import Any, Dict, List, Optional
+
+# --- Hard thresholds (tunable) ---
+ECO2_WARN_PPM = 2000     # eCO2 >= 2000 ppm -> alert
+TVOC_WARN_PPB = 1000     # TVOC >= 1000 ppb -> alert
+
+# --- Alert severity buckets (shown by the dashboard) ---
+SEV_HIGH_PROB = 0.85
+SEV_MEDIUM_PROB = 0.60
+
+SAMPLE_KEYS = [
+    "metrics.ambient_temp_c",
+    "metrics.ambient_rh_pct",
+    "metrics.pressure_hpa",
+    "metrics.eco2_ppm",
+    "metrics.tvoc_ppb",
+]
+
+
+def _peak(flat: Dict[str, Any], key: str) -> float:
+    # Highest reading in the sample: a device-aggregated window carries agg.max.*
+    best = float("nan")
+    for k in (f"metrics.{key}", f"agg.max.{key}"):
+        try:
+            v = float(flat.get(k, "nan"))
+        except Exception:
+            continue
+        if v == v and not best >= v:
+            best = v
+    return best
+
+
+def check_rules(flat: Dict[str, Any]) -> List[str]:
+    """Return the human-readable rule violations for one flattened sample."""
+    rule_alerts = []
+
+    eco2 = _peak(flat, "eco2_ppm")
+    if eco2 == eco2 and eco2 >= ECO2_WARN_PPM:
+        rule_alerts.append(f"eCO2 high: {eco2:.0f} ppm (>= {ECO2_WARN_PPM})")
+
+    tvoc = _peak(flat, "tvoc_ppb")
+    if tvoc == tvoc and tvoc >= TVOC_WARN_PPB:
+        rule_alerts.append(f"TVOC high: {tvoc:.0f} ppb (>= {TVOC_WARN_PPB})")
+
+    return rule_alerts
+
+
+def severity(details: Dict[str, Any]) -> Optional[str]:
+    # Rules first, then ML probability, then the bare ML flag
+    if details.get("rule_alerts"):
+        return "CRITICAL"
+    p = details.get("anomaly_prob")
+    if p is not None and p == p:
+        if p >= SEV_HIGH_PROB:
+            return "HIGH"
+        if p >= SEV_MEDIUM_PROB:
+            return "MEDIUM"
+    if details.get("is_anomaly"):
+        return "MEDIUM"
+    return None
+
+
+def build_alert(payload: Dict[str, Any], flat: Dict[str, Any], s: Dict[str, Any],
+                rule_alerts: List[str]) -> Optional[Dict[str, Any]]:
+    """Alert record for a scored sample, or None if neither ML nor rules fired."""
+    if not (s.get("is_anomaly") or rule_alerts):
+        return None
+    sample = {k: flat[k] for k in SAMPLE_KEYS if k in flat}
+
+    details = {
+        "algo": (s.get("details") or {}).get("algo", "IF"),
+        "score": s.get("score"),
+        "anomaly_prob": s.get("anomaly_prob"),
+        "is_anomaly": s.get("is_anomaly", False),
+    }
+    if rule_alerts:
+        details["rule_alerts"] = rule_alerts
+        details["algo"] = f"{details['algo']}+Rules"
+
+    return {
+        "ts": payload.get("ts", time.time()),
+        "device_id": payload.get("device_id"),
+        "site_id": payload.get("site_id"),
+        "score": s.get("score"),
+        "details": details,
+        "sample": sample,
+        "severity": severity(details),
+    }
+
+
+def offline_alert(device_id: Any, site_id: Any, last_seen: float, interval_s: float,
+                  now: Optional[float] = None) -> Dict[str, Any]:
+    """Alert for a device that missed its expected reports (cloud/heartbeat.py)."""
+    now = time.time() if now is None else now
+    silent = now - last_seen
+    details = {
+        "algo": "Heartbeat",
+        "rule_alerts": [f"Device offline: no data for {silent:.0f} s (expected every {interval_s:.0f} s)"],
+        "last_seen": last_seen,
+        "expected_interval_s": interval_s,
+    }
+    return {
+        "ts": now,
+        "device_id": device_id,
+        "site_id": site_id,
+        "score": None,
+        "details": details,
+        "sample": {},
+        "severity": "HIGH",
+    }
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Run the ingest API with connection settings tuned for many long-lived
+device connections.
+
+    python -m cloud.serve [--host 0.0.0.0] [--port 8000] [--workers N]
+
+Compared with a bare `uvicorn cloud.api:app`:
+  - keep-alive outlives the slowest advised reporting interval
+    (pacing.MAX_INTERVAL_SEC), so an idle device reuses its socket instead
+    of reconnecting for every heartbeat,
+  - a larger listen backlog absorbs reconnect bursts (e.g. after a Wi-Fi drop),
+  - concurrency per worker is capped (uvicorn answers 503 beyond it), and
+  - the open-file limit is raised to its hard maximum, one fd per connection.
+
+With --workers N a device's samples spread over the workers. State that must
+see all of them follows the shared site logs instead of living only in the
+receiving process: rolling-window features (cloud/features.py) and /stream.
+"""
+import argparse
+
+import uvicorn
+
+from .pacing import MAX_INTERVAL_SEC
+
+KEEPALIVE_SEC = MAX_INTERVAL_SEC + 15
+BACKLOG = 4096
+MAX_CONNECTIONS = 8192     # per worker
+
+
+def raise_nofile() -> int:
+    """Raise the soft open-file limit to the hard one; returns the new soft limit."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return -1
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Run cloud.api with device-friendly connection settings.")
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--keepalive", type=float, default=KEEPALIVE_SEC, help="idle keep-alive timeout (s)")
+    ap.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS, help="per worker")
+    ap.add_argument("--backlog", type=int, default=BACKLOG)
+    args = ap.parse_args()
+
+    nofile = raise_nofile()
+    if 0 < nofile < args.max_connections + 64:
+        print(f"[warn] open-file limit {nofile} is below --max-connections {args.max_connections}")
+    uvicorn.run(
+        "cloud.api:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_keep_alive=int(args.keepalive),
+        limit_concurrency=args.max_connections,
+        backlog=args.backlog,
+        access_log=False,   # one log line per sample costs more than the request itself
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""
+Simulated device fleet: thousands of virtual M5StickCs in one asyncio process.
+
+    python -m cloud.simfleet [--url http://127.0.0.1:8000] [--devices 1000] [--sites 10]
+                             [--duration 300] [--anomaly-rate 0.5] [--outage-rate 0.2]
+                             [--labels data/sim_labels.jsonl] [--seed 0]
+
+Each virtual device follows devices/m5stickc/main.py:
+  - reads ENV-III / SGP30 every READ_MS and folds the readings into a window
+    (AGGREGATE), sending the mean plus agg = {n, min, max},
+  - reports at the server-advised interval, early when a reading leaves its
+    deadband, at once when it crosses LOCAL_ECO2_WARN / LOCAL_TVOC_WARN,
+  - stamps ts / ts_ms with the firmware's synthetic clock (last /now + its own
+    ticks, which run DRIFT_PPM fast or slow, corrected by the drift rate it
+    estimates between syncs) and resyncs every RESYNC_SEC with SYNC_SAMPLES
+    NTP-style exchanges, keeping the one with the smallest round trip,
+  - keeps one connection open, retries a failed send once (same boot/seq),
+    and pauses for retry_after when the server answers 202/429/503.
+
+Readings follow a per-device baseline with a slow daily cycle and occupancy-
+driven eCO2/TVOC. Anomalies (ANOMALY_KINDS) and outages are injected at
+random per device-hour:
+  spike    eCO2/TVOC far above the thresholds for a few readings
+  ramp     eCO2 climbing steadily (the slow drift the window features target)
+  stuck    every reading frozen at its last value
+  dropout  the SGP30 returns nothing
+  wifi     no network for a while: sends fail, samples are lost as on the device
+  reboot   new boot id, seq back to 0, clock unsynced until /now answers
+Injected anomalies are the ground truth: at the end they are matched against
+/alerts (by device and ts) for a rough recall, and --labels writes them out.
+Run it against a scratch instance: samples are stored like real ones.
+"""
+import argparse
+import asyncio
+import json
+import math
+import pathlib
+import random
+import time
+import urllib.parse
+import urllib.request
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .loadtest import _read_response, _request
+from .pacing import MIN_INTERVAL_SEC
+from .rules import ECO2_WARN_PPM, TVOC_WARN_PPB
+from .serve import raise_nofile
+
+READ_MS = 800              # firmware loop period
+HTTP_TIMEOUT_S = 3         # firmware socket timeout
+RESYNC_SEC = 6 * 3600
+RESYNC_CHECK_SEC = 60
+SYNC_SAMPLES = 4
+DRIFT_SPAN_MS = 600000
+MAX_RATE_PPM = 500
+DRIFT_PPM = 100            # crystal error, uniform in [-DRIFT_PPM, DRIFT_PPM]
+LOCAL_ECO2_WARN = ECO2_WARN_PPM
+LOCAL_TVOC_WARN = TVOC_WARN_PPB
+METRIC_KEYS = ("ambient_temp_c", "ambient_rh_pct", "pressure_hpa", "eco2_ppm", "tvoc_ppb")
+ANOMALY_KINDS = ("spike", "ramp", "stuck", "dropout")
+ANOMALY_SEC = {"spike": (2, 6), "ramp": (300, 600), "stuck": (120, 300), "dropout": (60, 120)}
+OUTAGE_KINDS = ("wifi", "reboot")
+OUTAGE_SEC = 60.0          # mean Wi-Fi outage (exponential)
+BOOT_SEC = 8.0             # time from reset to the first reading
+DETECT_SLACK_SEC = 60      # an alert this long after an anomaly still counts
+
+
+class Fleet:
+    """Counters and ground truth shared by every virtual device."""
+
+    def __init__(self, url: str):
+        u = urllib.parse.urlsplit(url)
+        self.url = url.rstrip("/")
+        self.host, self.port = u.hostname, u.port or 80
+        self.status: Counter = Counter()
+        self.events: Counter = Counter()
+        self.latency: List[float] = []
+        self.labels: List[Dict[str, Any]] = []
+
+
+class SimDevice:
+    def __init__(self, i: int, site: str, fleet: Fleet, rng: random.Random, args):
+        self.device_id = f"sim-{i:05d}"
+        self.site_id = site
+        self.fleet = fleet
+        self.rng = rng
+        self.args = args
+        self.reader = self.writer = None
+        # Per-device environment
+        self.base = {
+            "ambient_temp_c": rng.uniform(19, 26),
+            "ambient_rh_pct": rng.uniform(30, 55),
+            "pressure_hpa": rng.uniform(820, 1015),
+            "eco2_ppm": rng.uniform(400, 550),
+            "tvoc_ppb": rng.uniform(0, 40),
+        }
+        self.phase = rng.uniform(0, 2 * math.pi)
+        self.occupancy = 0.0
+        self.drift = rng.uniform(-args.drift_ppm, args.drift_ppm) * 1e-6
+        self.anomaly: Optional[Dict[str, Any]] = None
+        self.offline_until = 0.0
+        self.next_anomaly = self._next(args.anomaly_rate)
+        self.next_outage = self._next(args.outage_rate)
+        self._boot()
+
+    def _next(self, per_hour: float) -> float:
+        return time.monotonic() + (self.rng.expovariate(per_hour / 3600.0) if per_hour > 0 else math.inf)
+
+    def _boot(self) -> None:
+        self.boot = self.rng.getrandbits(30)
+        self.seq = 0
+        self.boot_mono = time.monotonic()
+        self.server_ms = 0
+        self.sync_ticks = 0
+        self.rate_ppm = 0
+        self.interval_s = MIN_INTERVAL_SEC
+        self.deadband: Dict[str, float] = {}
+        self.last_sent: Dict[str, Any] = {}
+        self.hold_until = 0.0
+        self.alarm = False
+        self.agg = {k: [0, 0.0, None, None] for k in METRIC_KEYS}
+        self.last: Dict[str, Any] = {}
+
+    # ---------- clock (firmware now_ms / need_resync) ----------
+    def ticks(self) -> int:
+        """Milliseconds since boot as the device's own oscillator counts them."""
+        return int((time.monotonic() - self.boot_mono) * (1.0 + self.drift) * 1000)
+
+    def now_ms(self) -> int:
+        if self.server_ms > 0:
+            el = max(0, self.ticks() - self.sync_ticks)
+            return self.server_ms + el + el * self.rate_ppm // 1000000
+        # RTC never set: time.time() counts from the MicroPython epoch at boot
+        return self.ticks() // 1000 * 1000
+
+    def now_ts(self) -> int:
+        return self.now_ms() // 1000
+
+    def need_resync(self) -> bool:
+        return self.server_ms == 0 or self.ticks() - self.sync_ticks >= self.args.resync_sec * 1000
+
+    # ---------- HTTP (firmware http_request) ----------
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def _once(self, path: str, body: Optional[bytes]):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.fleet.host, self.fleet.port)
+        self.writer.write(_request(self.fleet.host, path, body or b"", True))
+        await self.writer.drain()
+        code, keep, data = await _read_response(self.reader)
+        if not keep:
+            self.close()
+        return code, data
+
+    async def http(self, path: str, body: Optional[bytes] = None):
+        """(status, body), reconnecting once; None when the network is down or times out."""
+        if time.monotonic() < self.offline_until:
+            self.fleet.events["offline_attempts"] += 1
+            await asyncio.sleep(HTTP_TIMEOUT_S)   # the firmware waits out its socket timeout
+            return None
+        for _ in range(2):
+            try:
+                return await asyncio.wait_for(self._once(path, body), HTTP_TIMEOUT_S)
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                self.close()
+                self.fleet.status[type(e).__name__] += 1
+        return None
+
+    async def time_exchange(self):
+        """One /now round trip: (rtt ms, server ms at t3, t3 ticks), or None."""
+        t0 = self.ticks()
+        r = await self.http("/now?t0=%d" % t0)
+        t3 = self.ticks()
+        try:
+            data = json.loads(r[1])
+            rx, tx = data.get("rx_ms"), data.get("tx_ms")
+            if rx is None or tx is None:
+                return t3 - t0, int(data["now"]) * 1000, t3
+            if data.get("t0") != t0:
+                return None
+        except Exception:
+            return None
+        rtt = (t3 - t0) - (tx - rx)
+        return rtt, tx + rtt // 2, t3
+
+    async def sync_time(self) -> bool:
+        best = None
+        for _ in range(SYNC_SAMPLES):
+            s = await self.time_exchange()
+            if s is not None and (best is None or s[0] < best[0]):
+                best = s
+        if best is None or best[1] < 1700000000000:
+            return False
+        rtt, server_ms, ticks = best
+        if self.server_ms > 0:
+            span = ticks - self.sync_ticks
+            if span >= DRIFT_SPAN_MS:
+                rate = (server_ms - self.server_ms - span) * 1000000 // span
+                if -MAX_RATE_PPM <= rate <= MAX_RATE_PPM:
+                    self.rate_ppm = rate if self.rate_ppm == 0 else (self.rate_ppm + rate) // 2
+        self.server_ms, self.sync_ticks = server_ms, ticks
+        self.fleet.events["time_syncs"] += 1
+        return True
+
+    # ---------- sensors ----------
+    def read(self) -> Dict[str, Any]:
+        rng, b = self.rng, self.base
+        day = math.sin(2 * math.pi * time.time() / 86400.0 + self.phase)
+        self.occupancy = min(600.0, max(0.0, self.occupancy + rng.gauss(0, 8)))
+        m = {
+            "ambient_temp_c": round(b["ambient_temp_c"] + 1.5 * day + rng.gauss(0, 0.05), 2),
+            "ambient_rh_pct": round(b["ambient_rh_pct"] - 4 * day + rng.gauss(0, 0.2), 2),
+            "pressure_hpa": round(b["pressure_hpa"] + 0.5 * day + rng.gauss(0, 0.05), 2),
+            "eco2_ppm": int(b["eco2_ppm"] + self.occupancy + rng.gauss(0, 5)),
+            "tvoc_ppb": max(0, int(b["tvoc_ppb"] + 0.15 * self.occupancy + rng.gauss(0, 3))),
+        }
+        a = self.anomaly
+        if a is not None:
+            if time.monotonic() >= a["until"]:
+                a["label"]["end"] = self.now_ts()
+                self.anomaly = a = None
+            elif a["kind"] == "spike":
+                m["eco2_ppm"] = int(LOCAL_ECO2_WARN * rng.uniform(1.2, 2.5))
+                m["tvoc_ppb"] = int(LOCAL_TVOC_WARN * rng.uniform(1.2, 3.0))
+            elif a["kind"] == "ramp":
+                m["eco2_ppm"] += int(a["rate"] * (time.monotonic() - a["since"]) / 60.0)
+            elif a["kind"] == "stuck":
+                m = dict(self.last) or m
+            elif a["kind"] == "dropout":
+                m["eco2_ppm"] = m["tvoc_ppb"] = None
+        self.last = m
+        return m
+
+    def _inject(self) -> None:
+        now = time.monotonic()
+        if now >= self.next_anomaly:
+            self.next_anomaly = self._next(self.args.anomaly_rate)
+            if self.anomaly is None:
+                kind = self.rng.choice(self.args.anomaly_kinds)
+                lo, hi = ANOMALY_SEC[kind]
+                label = {"device_id": self.device_id, "site_id": self.site_id, "kind": kind,
+                         "start": self.now_ts(), "end": None}
+                self.anomaly = {"kind": kind, "since": now, "until": now + self.rng.uniform(lo, hi),
+                                "rate": self.rng.uniform(60, 200), "label": label}
+                self.fleet.labels.append(label)
+                self.fleet.events[f"anomaly_{kind}"] += 1
+        if now >= self.next_outage:
+            self.next_outage = self._next(self.args.outage_rate)
+            kind = self.rng.choice(OUTAGE_KINDS)
+            self.fleet.events[f"outage_{kind}"] += 1
+            self.close()
+            if kind == "wifi":
+                self.offline_until = now + self.rng.expovariate(1.0 / self.args.outage_sec)
+            else:
+                self._boot()
+
+    # ---------- reporting (firmware send_payload / main loop) ----------
+    def agg_add(self, metrics: Dict[str, Any]) -> None:
+        for k in METRIC_KEYS:
+            v = metrics.get(k)
+            if v is None:
+                continue
+            a = self.agg[k]
+            a[0] += 1
+            a[1] += v
+            a[2] = v if a[2] is None else min(a[2], v)
+            a[3] = v if a[3] is None else max(a[3], v)
+
+    def agg_take(self):
+        mean, lo, hi, n = {}, {}, {}, 0
+        for k in METRIC_KEYS:
+            a = self.agg[k]
+            if a[0]:
+                mean[k], lo[k], hi[k] = a[1] / a[0], a[2], a[3]
+                n = max(n, a[0])
+            self.agg[k] = [0, 0.0, None, None]
+        return mean, {"n": n, "min": lo, "max": hi}
+
+    def changed(self, metrics: Dict[str, Any]) -> bool:
+        for k, band in self.deadband.items():
+            v, last = metrics.get(k), self.last_sent.get(k)
+            if v is None or last is None:
+                if v is not None or last is not None:
+                    return True
+            elif abs(v - last) >= band:
+                return True
+        return False
+
+    def _hold(self, data: bytes) -> None:
+        try:
+            secs = int(json.loads(data).get("retry_after", 1))
+        except Exception:
+            secs = 1
+        self.hold_until = time.monotonic() + max(1, secs)
+        self.fleet.events["held_off"] += 1
+
+    async def send(self, payload: Dict[str, Any]) -> bool:
+        t0 = time.perf_counter()
+        r = await self.http("/ingest", json.dumps(payload).encode())
+        if r is None:
+            return False
+        code, data = r
+        self.fleet.status[code] += 1
+        self.fleet.latency.append(time.perf_counter() - t0)
+        if code == 202:
+            self._hold(data)
+            return True
+        if code in (429, 503):
+            self._hold(data)
+            return False
+        if code != 200:
+            return False
+        try:
+            adv = json.loads(data).get("next") or {}
+            self.interval_s = max(MIN_INTERVAL_SEC, int(adv.get("interval_s", self.interval_s)))
+            self.deadband = adv.get("deadband") or {}
+        except Exception:
+            pass
+        return True
+
+    async def run(self, deadline: float) -> None:
+        await asyncio.sleep(self.rng.uniform(0, self.interval_s))   # devices do not boot in lockstep
+        last_pub = last_check = time.monotonic()
+        booted = None
+        while time.monotonic() < deadline:
+            self._inject()
+            now = time.monotonic()
+            if now - self.boot_mono < BOOT_SEC:
+                await asyncio.sleep(READ_MS / 1000.0)
+                continue
+            if booted != self.boot:
+                # Startup: one sync attempt, then the periodic check
+                booted, last_check = self.boot, now
+                await self.sync_time()
+            elif now - last_check >= RESYNC_CHECK_SEC:
+                last_check = now
+                if self.need_resync():
+                    await self.sync_time()
+
+            metrics = self.read()
+            if self.args.aggregate:
+                self.agg_add(metrics)
+            eco2, tvoc = metrics.get("eco2_ppm"), metrics.get("tvoc_ppb")
+            alarm = (eco2 is not None and eco2 >= LOCAL_ECO2_WARN) or \
+                    (tvoc is not None and tvoc >= LOCAL_TVOC_WARN)
+            crossed = alarm and not self.alarm
+            self.alarm = alarm
+
+            elapsed = time.monotonic() - last_pub
+            if time.monotonic() >= self.hold_until and (crossed or elapsed >= MIN_INTERVAL_SEC):
+                due = elapsed >= self.interval_s
+                moved = not due and not crossed and self.changed(metrics)
+                if crossed or due or moved:
+                    payload = {
+                        "site_id": self.site_id,
+                        "device_id": self.device_id,
+                        "ts": self.now_ts(),
+                        "ts_ms": self.now_ms(),
+                        "boot": self.boot,
+                        "seq": self.seq,
+                        "interval_s": self.interval_s,
+                        "reason": "threshold" if crossed else ("change" if moved else "heartbeat"),
+                        "metrics": metrics,
+                    }
+                    if self.args.aggregate:
+                        payload["metrics"], payload["agg"] = self.agg_take()
+                    self.seq += 1
+                    self.fleet.events["samples"] += 1
+                    # One retry, as on the device (the server de-duplicates on seq)
+                    ok = await self.send(payload)
+                    if not ok and time.monotonic() >= self.hold_until:
+                        self.fleet.events["retries"] += 1
+                        ok = await self.send(payload)
+                    if not ok:
+                        self.fleet.events["samples_lost"] += 1
+                    self.last_sent = metrics
+                    last_pub = time.monotonic()
+            await asyncio.sleep(READ_MS / 1000.0)
+        self.close()
+
+
+async def run_fleet(args) -> Fleet:
+    fleet = Fleet(args.url)
+    rng = random.Random(args.seed)
+    devices = [SimDevice(i, f"sim-site-{i % args.sites:03d}", fleet,
+                         random.Random(rng.getrandbits(64)), args) for i in range(args.devices)]
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*(d.run(deadline) for d in devices))
+    for d in devices:
+        if d.anomaly is not None:
+            d.anomaly["label"]["end"] = d.now_ts()
+    return fleet
+
+
+def _alerts(url: str, site_id: str, limit: int = 100000) -> List[Dict[str, Any]]:
+    q = urllib.parse.urlencode({"site_id": site_id, "limit": limit})
+    with urllib.request.urlopen(f"{url}/alerts?{q}", timeout=30) as r:
+        return json.loads(r.read()).get("items", [])
+
+
+def evaluate(fleet: Fleet) -> Dict[str, Any]:
+    """Share of injected anomalies with an alert for that device inside the window."""
+    by_device: Dict[str, List[float]] = {}
+    for site in sorted({lab["site_id"] for lab in fleet.labels}):
+        for a in _alerts(fleet.url, site):
+            by_device.setdefault(a.get("device_id"), []).append(float(a.get("ts") or 0))
+    hits: Counter = Counter()
+    totals: Counter = Counter()
+    for lab in fleet.labels:
+        totals[lab["kind"]] += 1
+        ts = by_device.get(lab["device_id"], [])
+        end = (lab["end"] or lab["start"]) + DETECT_SLACK_SEC
+        if any(lab["start"] <= t <= end for t in ts):
+            hits[lab["kind"]] += 1
+    return {k: {"injected": totals[k], "alerted": hits[k], "recall": hits[k] / totals[k]} for k in totals}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Simulate a fleet of M5StickC devices against the API.")
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--devices", type=int, default=1000)
+    ap.add_argument("--sites", type=int, default=10)
+    ap.add_argument("--duration", type=float, default=300, help="seconds")
+    ap.add_argument("--anomaly-rate", type=float, default=0.5, help="per device-hour")
+    ap.add_argument("--anomaly-kinds", default=",".join(ANOMALY_KINDS))
+    ap.add_argument("--outage-rate", type=float, default=0.2, help="per device-hour")
+    ap.add_argument("--outage-sec", type=float, default=OUTAGE_SEC, help="mean Wi-Fi outage")
+    ap.add_argument("--drift-ppm", type=float, default=DRIFT_PPM)
+    ap.add_argument("--resync-sec", type=float, default=RESYNC_SEC)
+    ap.add_argument("--no-aggregate", dest="aggregate", action="store_false")
+    ap.add_argument("--labels", type=pathlib.Path, help="write injected anomalies here (JSONL)")
+    ap.add_argument("--no-eval", dest="evaluate", action="store_false", help="skip matching against /alerts")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    args.anomaly_kinds = [k for k in args.anomaly_kinds.split(",") if k in ANOMALY_KINDS] or list(ANOMALY_KINDS)
+
+    nofile = raise_nofile()
+    if 0 < nofile < args.devices + 64:
+        print(f"[warn] open-file limit {nofile} is below --devices {args.devices}")
+    t0 = time.perf_counter()
+    fleet = asyncio.run(run_fleet(args))
+    elapsed = time.perf_counter() - t0
+
+    ms = np.asarray(fleet.latency) * 1000.0 if fleet.latency else np.zeros(1)
+    ok = fleet.status.get(200, 0) + fleet.status.get(202, 0)
+    print(f"{args.devices} devices, {elapsed:.0f}s: {fleet.events['samples']} samples, "
+          f"{ok / elapsed:,.1f} accepted/s, p50 {np.percentile(ms, 50):.1f} ms  p99 {np.percentile(ms, 99):.1f} ms")
+    print(f"  status: {dict((str(k), v) for k, v in fleet.status.items())}")
+    print(f"  events: {dict(sorted(fleet.events.items()))}")
+    if args.labels:
+        args.labels.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.labels, "w", encoding="utf-8") as f:
+            for lab in fleet.labels:
+                f.write(json.dumps(lab) + "\n")
+        print(f"  labels: {len(fleet.labels)} -> {args.labels}")
+    if args.evaluate and fleet.labels:
+        try:
+            for kind, r in evaluate(fleet).items():
+                print(f"  {kind:>8}: {r['alerted']}/{r['injected']} alerted  recall {r['recall']:.2f}")
+        except OSError as e:
+            print(f"[warn] could not read /alerts: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+Per-site sharding of ingest, storage, rollups, models and alert state.
+
+Each site_id gets its own directory with the same layout as data/:
+  data/sites/<site_id>/telemetry.jsonl (+ _1m / _1h tiers), alerts.jsonl,
+  model.joblib (optional; the shared data/model.joblib is used otherwise)
+Samples without a site_id, and history from before sharding, stay in data/.
+
+A Site owns its logs, time indexes, retention manager, rolling feature
+windows and two single-thread executors, so a site flooding the service only
+queues behind itself. Each sample goes through two stages:
+  - persist (writer thread): append to the telemetry log, update the registry,
+  - process (site thread): rolling features, ML scoring, rules, alerts.
+/ingest waits for each stage only up to its budget (PERSIST_BUDGET_SEC,
+SCORE_BUDGET_SEC); past that the work finishes in the background. Once
+MAX_DEFERRED samples wait to be scored, new ones skip the ML model (rules
+still run), and once SITE_MAX_PENDING wait to be written the site is refused
+with 429 and a Retry-After estimated from its backlog.
+
+Sites can be spread over several service instances (processes or hosts):
+list every instance's base URL in DIA_NODES and give each its own DIA_NODE.
+A consistent-hash ring maps each site_id to one node, so adding a node only
+moves about 1/N of the sites. cloud/router.py is a front door that forwards
+each request to its owner; a node asked about a foreign site redirects.
+
+Every site costs a directory and two threads, so /ingest only opens sites it
+admits: those listed in DIA_SITES when that is set, otherwise those already
+on disk plus new ones up to MAX_SITES in total.
+"""
+import asyncio
+import bisect
+import hashlib
+import pathlib
+import re
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .features import FeaturePipeline
+from .models import load_cached
+from .retention import RETENTION_INTERVAL_SEC, TIER_FILES, RetentionManager, tier_paths
+from .storage import JsonlLog
+from .tsindex import TelemetryIndex
+
+SITES_SUBDIR = "sites"
+SITE_MAX_PENDING = 64      # samples waiting to be written per site before 429
+MAX_DEFERRED = 256         # samples waiting to be scored before ML is skipped
+MAX_SCORING = 4096         # ... and before the site is refused (429) as well
+PERSIST_BUDGET_SEC = 1.0   # /ingest answers 202 "queued" if the write takes longer
+SCORE_BUDGET_SEC = 0.25    # ... and without a score if scoring takes longer than this
+RETRY_AFTER_MAX = 30       # seconds
+LATENCY_SAMPLES = 2048     # recent /ingest latencies kept for /health
+VNODES = 160               # ring points per node
+MAX_SITES = 256            # site directories /ingest may create (without DIA_SITES)
+
+
+def site_key(site_id: Any) -> Optional[str]:
+    """Filesystem-safe directory name for a site_id (None when missing)."""
+    if site_id is None or str(site_id).strip() == "":
+        return None
+    key = re.sub(r"[^A-Za-z0-9._-]", "_", str(site_id).strip())
+    return "_" + key if key.startswith(".") else key
+
+
+def site_dir(data_dir: pathlib.Path, site_id: Any) -> pathlib.Path:
+    key = site_key(site_id)
+    return pathlib.Path(data_dir) if key is None else pathlib.Path(data_dir) / SITES_SUBDIR / key
+
+
+def site_dirs(data_dir: pathlib.Path) -> List[pathlib.Path]:
+    """data/ itself (unsited and pre-sharding data) followed by every site directory."""
+    data_dir = pathlib.Path(data_dir)
+    root = data_dir / SITES_SUBDIR
+    subdirs = sorted(p for p in root.iterdir() if p.is_dir()) if root.is_dir() else []
+    return [data_dir] + subdirs
+
+
+def telemetry_files(data_dir: pathlib.Path) -> List[pathlib.Path]:
+    """Every existing telemetry tier in data/ and each site directory, coarsest tier first."""
+    return [p for d in site_dirs(data_dir) for p in tier_paths(d) if p.exists()]
+
+
+def parse_nodes(spec: Optional[str]) -> List[str]:
+    return [n.strip().rstrip("/") for n in (spec or "").split(",") if n.strip()]
+
+
+def parse_sites(spec: Optional[str]) -> Optional[List[str]]:
+    sites = [s.strip() for s in (spec or "").split(",") if s.strip()]
+    return sites or None
+
+
+class HashRing:
+    """Consistent hashing of site_ids onto node names."""
+
+    def __init__(self, nodes: List[str], vnodes: int = VNODES):
+        self.nodes = list(nodes)
+        points = []
+        for node in self.nodes:
+            for i in range(vnodes):
+                points.append((self._hash(f"{node}#{i}"), node))
+        points.sort()
+        self._keys = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+
+    @staticmethod
+    def _hash(s: str) -> int:
+        return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def node_for(self, site_id: Any) -> Optional[str]:
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, self._hash(site_key(site_id) or ""))
+        return self._nodes[i % len(self._nodes)]
+
+
+class Site:
+    def __init__(self, key: Optional[str], path: pathlib.Path):
+        self.key = key
+        self.dir = path
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.telemetry_file = self.dir / "telemetry.jsonl"
+        self.alerts_file = self.dir / "alerts.jsonl"
+        self.model_file = self.dir / "model.joblib"
+        self.telemetry_log = JsonlLog(self.telemetry_file)
+        self.alerts_log = JsonlLog(self.alerts_file)
+        self.retention = RetentionManager(self.dir)
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix=f"site-{key or 'default'}-io")
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix=f"site-{key or 'default'}")
+        # Per-device rolling windows; refilled from the log tail on the site's
+        # own thread, ahead of any queued sample, then kept following the log
+        # so samples other workers wrote count too
+        self.features = FeaturePipeline()
+        self._executor.submit(self.features.follow, self.telemetry_file)
+        # Counters below are only touched from the event loop
+        self.pending = 0       # waiting to be written
+        self.scoring = 0       # waiting to be scored
+        self.ingested = 0
+        self.rejected = 0      # refused with 429
+        self.queued = 0        # answered before the write finished
+        self.deferred = 0      # answered before scoring finished
+        self.skipped = 0       # ML skipped under overload
+        self.latency = deque(maxlen=LATENCY_SAMPLES)
+        # Average service time per stage (EWMA, seconds), for Retry-After
+        self._persist_sec = 0.001
+        self._score_sec = 0.01
+
+    def model(self):
+        # Site model if one was trained for it, else None (score() then uses the shared one)
+        return load_cached(self.model_file)
+
+    @property
+    def busy(self) -> bool:
+        return self.pending >= SITE_MAX_PENDING or self.scoring >= MAX_SCORING
+
+    @property
+    def overloaded(self) -> bool:
+        return self.busy or self.scoring >= MAX_DEFERRED
+
+    def retry_after(self) -> int:
+        """Seconds until this site's backlog should have drained."""
+        backlog = self.pending * self._persist_sec + self.scoring * self._score_sec
+        return int(min(RETRY_AFTER_MAX, max(1, math.ceil(backlog))))
+
+    def submit(self, persist: Callable, process: Callable, payload: Dict[str, Any]) -> Tuple[Any, Any]:
+        """
+        Queue both stages for payload; call from the event loop only.
+        Returns (persisted, processed) asyncio futures. process(site, payload,
+        skip_ml) runs once persist(site, payload) has succeeded, in arrival order.
+        """
+        skip_ml = self.scoring >= MAX_DEFERRED
+        if skip_ml:
+            self.skipped += 1
+
+        def _persist():
+            t0 = time.perf_counter()
+            persist(self, payload)
+            self._persist_sec += 0.1 * (time.perf_counter() - t0 - self._persist_sec)
+
+        def _process():
+            # The writer is FIFO too, so this waits on at most this one sample
+            wrote.result()
+            t0 = time.perf_counter()
+            out = process(self, payload, skip_ml)
+            self._score_sec += 0.1 * (time.perf_counter() - t0 - self._score_sec)
+            return out
+
+        self.pending += 1
+        self.scoring += 1
+        wrote = self._writer.submit(_persist)
+        persisted = asyncio.wrap_future(wrote)
+        processed = asyncio.wrap_future(self._executor.submit(_process))
+        persisted.add_done_callback(self._written)
+        processed.add_done_callback(self._scored)
+        return persisted, processed
+
+    def _written(self, fut) -> None:
+        self.pending -= 1
+        if not fut.cancelled():
+            fut.exception()   # retrieved here; /ingest re-raises it if still waiting
+
+    def _scored(self, fut) -> None:
+        self.scoring -= 1
+        if not fut.cancelled():
+            fut.exception()
+
+    def observe(self, seconds: float) -> None:
+        self.ingested += 1
+        self.latency.append(seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        lat = np.asarray(self.latency) * 1000.0
+        return {"pending": self.pending, "scoring": self.scoring, "ingested": self.ingested,
+                "rejected": self.rejected, "queued": self.queued, "deferred": self.deferred,
+                "skipped": self.skipped, "overloaded": self.overloaded,
+                "latency_ms": {"p50": float(np.percentile(lat, 50)), "p99": float(np.percentile(lat, 99))}
+                if len(lat) else None,
+                "devices_windowed": len(self.features), "retention": self.retention.last_run}
+
+    def close(self) -> None:
+        self._writer.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        self.telemetry_log.close()
+        self.alerts_log.close()
+
+
+class SiteShards:
+    """Sites owned by this node, opened on first use, plus the node ring."""
+
+    def __init__(self, data_dir: pathlib.Path, node: Optional[str] = None,
+                 nodes: Optional[List[str]] = None, allowed: Optional[List[str]] = None,
+                 max_sites: int = MAX_SITES):
+        self.data_dir = pathlib.Path(data_dir)
+        self.node = node.rstrip("/") if node else None
+        self.ring = HashRing(nodes or [])
+        self.allowed = {site_key(s) for s in allowed} if allowed else None
+        self.max_sites = max_sites
+        self._known = {d.name for d in site_dirs(self.data_dir)[1:]}
+        self._sites: Dict[Optional[str], Site] = {}
+        self._indexes: Dict[tuple, TelemetryIndex] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------- routing ----------
+    def owner(self, site_id: Any) -> Optional[str]:
+        """Base URL of the node owning site_id, or None when it is this one."""
+        if self.node is None or not self.ring.nodes:
+            return None
+        node = self.ring.node_for(site_id)
+        return None if node == self.node else node
+
+    def admits(self, site_id: Any) -> bool:
+        """Whether /ingest may open site_id (unsited samples always go to data/)."""
+        key = site_key(site_id)
+        if key is None:
+            return True
+        if self.allowed is not None:
+            return key in self.allowed
+        return key in self._known or len(self._known) < self.max_sites
+
+    def get(self, site_id: Any) -> Site:
+        key = site_key(site_id)
+        site = self._sites.get(key)
+        if site is None:
+            with self._lock:
+                site = self._sites.get(key)
+                if site is None:
+                    site = self._sites[key] = Site(key, site_dir(self.data_dir, site_id))
+                    if key is not None:
+                        self._known.add(key)
+        return site
+
+    def sites(self) -> List[Site]:
+        return list(self._sites.values())
+
+    # ---------- reads ----------
+    def dirs(self, site_id: Any = None) -> List[pathlib.Path]:
+        """Directories holding a site's data (all sites when site_id is None)."""
+        if site_id is None:
+            return site_dirs(self.data_dir)
+        # Pre-sharding history for the site still lives in data/
+        return [self.data_dir, site_dir(self.data_dir, site_id)]
+
+    def index(self, path: pathlib.Path, tier: str) -> TelemetryIndex:
+        k = (str(path), tier)
+        idx = self._indexes.get(k)
+        if idx is None:
+            with self._lock:
+                idx = self._indexes.setdefault(k, TelemetryIndex(pathlib.Path(path) / TIER_FILES[tier]))
+        return idx
+
+    # ---------- retention ----------
+    def run_retention(self, now: Optional[float] = None) -> Dict[str, Any]:
+        out = {}
+        for d in site_dirs(self.data_dir):
+            key = None if d == self.data_dir else d.name
+            if self.owner(key) is not None:
+                continue  # another node compacts it
+            retention = self.get(key).retention
+            try:
+                out[key or "default"] = retention.run_once(now)
+            except Exception as e:
+                # Kept as the site's last run, so /health shows it; other sites still run
+                retention.last_run = out[key or "default"] = {"error": repr(e), "at": time.time()}
+                print(f"RETENTION ({key or 'default'}) failed: {e!r}")
+        return out
+
+    def start(self, interval: float = RETENTION_INTERVAL_SEC) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+
+        def _loop():
+            delay = min(60.0, interval)   # first pass shortly after startup
+            while not self._stop.wait(delay):
+                delay = interval
+                try:
+                    self.run_retention()
+                except Exception as e:
+                    print(f"RETENTION failed: {e!r}")
+
+        self._thread = threading.Thread(target=_loop, name="site-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+        for site in self.sites():
+            site.close()
+
+    def overload(self) -> Dict[str, Any]:
+        """Sites currently degraded, plus totals of the work shed so far."""
+        sites = self.sites()
+        return {
+            "sites": [s.key or "default" for s in sites if s.overloaded],
+            "deferred": sum(s.deferred for s in sites),
+            "skipped": sum(s.skipped for s in sites),
+            "queued": sum(s.queued for s in sites),
+            "rejected": sum(s.rejected for s in sites),
+        }
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            "node": self.node,
+            "nodes": self.ring.nodes,
+            "allowed": sorted(self.allowed) if self.allowed is not None else None,
+            "known": len(self._known),
+            "max_sites": self.max_sites,
+            "sites": {s.key or "default": s.stats() for s in self.sites()},
+        }
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Consistent online snapshot of data/, and restore onto a new node.
+
+    python -m cloud.snapshot export backup.tar.gz [--data-dir data]    # "-" = stdout
+    python -m cloud.snapshot import backup.tar.gz [--data-dir data] [--workers N] [--force]
+
+Copying data/ while the API runs catches the logs mid-append and gives torn
+last lines. Export instead takes a barrier:
+  - every site's retention.lock is held, so no compaction is half done,
+  - every append-only log (APPEND_LOGS) is paused at once
+    (storage.appends_paused) just long enough to note its size and keep a
+    descriptor open on it,
+then everything is released and the snapshot streams out with ingest
+running. A log is archived up to its barrier offset, which always falls on
+a line end, and the open descriptor pins that inode even if retention
+replaces the file afterwards. Every other file (models, stats, registry
+snapshot, re-scored alert sets) is already replaced with temp file +
+rename, so it is opened once and archived as that one version. Indexes
+(*.idx), locks and temp files are left out.
+
+The archive is a gzip-compressed tar written as a stream (no temp copy of
+the data), ending with MANIFEST (sizes and SHA-256 of every member).
+
+Import unpacks into a staging directory next to the target and checks the
+manifest. It then rebuilds, in parallel per site directory, what export
+left out: retention passes (rollups, for a snapshot older than the raw
+window) and the time indexes of every tier. Finally it moves each file into
+place with a rename, so the logs keep the inodes their fresh indexes
+describe. Lock files (and temp files) the rebuild left in staging are not
+moved: a live lock file must keep its inode, or a process holding a flock on
+it and one locking the new file would both think they own the lock. It refuses to overwrite existing logs without --force; with it,
+live appenders switch to the restored files.
+"""
+import argparse
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import pathlib
+import shutil
+import sys
+import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, BinaryIO, Dict, List, Tuple
+
+from .retention import RETENTION_ENABLED, TIER_FILES, RetentionManager
+from .sites import site_dirs
+from .storage import appends_paused, file_lock
+from .tsindex import TelemetryIndex
+
+DATA_DIR = pathlib.Path(__file__).resolve().parent.parent / "data"
+APPEND_LOGS = set(TIER_FILES.values()) | {"alerts.jsonl"}
+SKIP_SUFFIXES = (".idx", ".lock", ".tmp")
+INSTALL_SKIP = (".lock", ".tmp")   # indexes built in staging are installed, locks never
+MANIFEST = "MANIFEST"
+SNAPSHOT_VERSION = 1
+COMPRESS_LEVEL = 6
+COPY_CHUNK = 1024 * 1024
+
+
+def _included(rel: pathlib.PurePath) -> bool:
+    # Hidden entries are work in progress (e.g. rescore's .parts-* directories)
+    return not any(p.startswith(".") for p in rel.parts) and not rel.name.endswith(SKIP_SUFFIXES)
+
+
+def _files(data_dir: pathlib.Path) -> List[pathlib.Path]:
+    return sorted(p for p in data_dir.rglob("*")
+                  if p.is_file() and _included(p.relative_to(data_dir)))
+
+
+class _Hashing(io.RawIOBase):
+    """Read at most `size` bytes from a descriptor, hashing them on the way."""
+
+    def __init__(self, fd: int, size: int):
+        self.fd, self.left, self.pos = fd, size, 0
+        self.sha = hashlib.sha256()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self.left)
+        if n <= 0:
+            return 0
+        os.lseek(self.fd, self.pos, os.SEEK_SET)   # the fd is ours alone (dup / fresh open)
+        data = os.read(self.fd, n)
+        b[:len(data)] = data
+        self.sha.update(data)
+        self.pos += len(data)
+        self.left -= len(data)
+        return len(data)
+
+
+# ----------------------------------------------------------------------
+# Export
+# ----------------------------------------------------------------------
+def barrier(data_dir: pathlib.Path) -> Tuple[Dict[str, Tuple[int, int]], float]:
+    """
+    Open every file of the snapshot at one consistent point.
+    Returns ({relative path: (fd, size)}, barrier time); the caller closes the fds.
+    """
+    data_dir = pathlib.Path(data_dir)
+    files = _files(data_dir)
+    logs = [p for p in files if p.name in APPEND_LOGS]
+    opened: Dict[str, Tuple[int, int]] = {}
+    try:
+        with contextlib.ExitStack() as stack:
+            # Same order as retention (its lock, then the log's): no deadlock
+            for d in site_dirs(data_dir):
+                stack.enter_context(file_lock(d / "retention.lock"))
+            for p in logs:
+                fd = stack.enter_context(appends_paused(p))
+                opened[p.relative_to(data_dir).as_posix()] = (os.dup(fd), os.fstat(fd).st_size)
+            at = time.time()
+        # Files replaced atomically: whichever version is open now is complete
+        for p in files:
+            rel = p.relative_to(data_dir).as_posix()
+            if rel not in opened:
+                try:
+                    fd = os.open(p, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                except FileNotFoundError:
+                    continue   # removed since the listing
+                opened[rel] = (fd, os.fstat(fd).st_size)
+    except BaseException:
+        for fd, _ in opened.values():
+            os.close(fd)
+        raise
+    return opened, at
+
+
+def export(data_dir: pathlib.Path, out: BinaryIO) -> Dict[str, Any]:
+    """Stream a snapshot of data_dir to `out`; returns its manifest."""
+    t0 = time.time()
+    opened, at = barrier(data_dir)
+    manifest = {"version": SNAPSHOT_VERSION, "created_at": at, "files": {}}
+    try:
+        with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=COMPRESS_LEVEL, mtime=int(at)) as gz, \
+                tarfile.open(fileobj=gz, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            for rel, (fd, size) in sorted(opened.items()):
+                info = tarfile.TarInfo(rel)
+                info.size = size
+                info.mtime = int(os.fstat(fd).st_mtime)
+                src = _Hashing(fd, size)
+                tar.addfile(info, io.BufferedReader(src, COPY_CHUNK))
+                manifest["files"][rel] = {"size": size, "sha256": src.sha.hexdigest(),
+                                          "log": pathlib.PurePosixPath(rel).name in APPEND_LOGS}
+            manifest["elapsed_s"] = time.time() - t0
+            body = json.dumps(manifest, indent=2).encode("utf-8")
+            info = tarfile.TarInfo(MANIFEST)
+            info.size = len(body)
+            info.mtime = int(at)
+            tar.addfile(info, io.BytesIO(body))
+    finally:
+        for fd, _ in opened.values():
+            os.close(fd)
+    return manifest
+
+
+# ----------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------
+def _safe_name(name: str) -> pathlib.PurePosixPath:
+    rel = pathlib.PurePosixPath(name)
+    if rel.is_absolute() or ".." in rel.parts or not rel.parts:
+        raise SystemExit(f"Refusing unsafe path in snapshot: {name}")
+    return rel
+
+
+def _unpack(src: BinaryIO, staging: pathlib.Path) -> Dict[str, Any]:
+    sums: Dict[str, Tuple[int, str]] = {}
+    manifest = None
+    with tarfile.open(fileobj=src, mode="r|*") as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            f = tar.extractfile(info)
+            if info.name == MANIFEST:
+                manifest = json.loads(f.read())
+                continue
+            rel = _safe_name(info.name)
+            dst = staging.joinpath(*rel.parts)
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            sha = hashlib.sha256()
+            with open(dst, "wb") as out:
+                for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+                    sha.update(chunk)
+                    out.write(chunk)
+            os.utime(dst, (info.mtime, info.mtime))
+            sums[rel.as_posix()] = (info.size, sha.hexdigest())
+    if manifest is None:
+        raise SystemExit("Snapshot has no MANIFEST (truncated archive?)")
+    want = {k: (v["size"], v["sha256"]) for k, v in manifest["files"].items()}
+    if want != sums:
+        bad = sorted(k for k in set(want) | set(sums) if want.get(k) != sums.get(k))
+        raise SystemExit(f"Snapshot does not match its MANIFEST: {bad[:10]}")
+    return manifest
+
+
+def rebuild_dir(path: str) -> Dict[str, Any]:
+    """Rollups (retention pass, if enabled), then the time index of every tier, for one directory."""
+    d = pathlib.Path(path)
+    t0 = time.time()
+    stats = {"dir": path, "retention": RetentionManager(d).run_once() if RETENTION_ENABLED else None}
+    for tier, name in TIER_FILES.items():
+        if (d / name).exists():
+            idx = TelemetryIndex(d / name)
+            idx.refresh()   # persists every closed block to <tier>.idx
+            stats[tier] = len(idx.blocks)
+    stats["elapsed_s"] = time.time() - t0
+    return stats
+
+
+def _install(staging: pathlib.Path, data_dir: pathlib.Path) -> int:
+    n = 0
+    for p in sorted(q for q in staging.rglob("*") if q.is_file() and not q.name.endswith(INSTALL_SKIP)):
+        dst = data_dir / p.relative_to(staging)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if p.name in APPEND_LOGS and dst.exists():
+            # Appenders waiting on the pause reopen the new file
+            with appends_paused(dst):
+                os.replace(p, dst)
+        else:
+            os.replace(p, dst)
+        n += 1
+    return n
+
+
+def restore(src: BinaryIO, data_dir: pathlib.Path, workers: int = 0, force: bool = False) -> Dict[str, Any]:
+    data_dir = pathlib.Path(data_dir)
+    if not force and data_dir.exists() and any(p.name in APPEND_LOGS for p in _files(data_dir)):
+        raise SystemExit(f"{data_dir} already holds telemetry; restore with --force to replace it")
+    data_dir.parent.mkdir(parents=True, exist_ok=True)
+    staging = data_dir.with_name(f".{data_dir.name}.restore-{os.getpid()}")
+    t0 = time.time()
+    try:
+        staging.mkdir()
+        manifest = _unpack(src, staging)
+        t_unpack = time.time() - t0
+
+        dirs = [str(d) for d in site_dirs(staging)]
+        workers = min(workers or os.cpu_count() or 1, len(dirs))
+        if workers <= 1:
+            rebuilt = [rebuild_dir(d) for d in dirs]
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                rebuilt = list(pool.map(rebuild_dir, dirs))
+        t_rebuild = time.time() - t0 - t_unpack
+
+        installed = _install(staging, data_dir)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return {
+        "snapshot_at": manifest["created_at"],
+        "files": installed,
+        "dirs": len(rebuilt),
+        "workers": workers,
+        "unpack_s": t_unpack,
+        "rebuild_s": t_rebuild,
+        "elapsed_s": time.time() - t0,
+        "rebuilt": rebuilt,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Snapshot data/ while the API runs, or restore a snapshot.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ex = sub.add_parser("export", help="write a .tar.gz snapshot ('-' for stdout)")
+    ex.add_argument("archive")
+    ex.add_argument("--data-dir", type=pathlib.Path, default=DATA_DIR)
+    im = sub.add_parser("import", help="restore a snapshot ('-' for stdin)")
+    im.add_argument("archive")
+    im.add_argument("--data-dir", type=pathlib.Path, default=DATA_DIR)
+    im.add_argument("--workers", type=int, default=0, help="index/rollup rebuild processes (default: CPUs)")
+    im.add_argument("--force", action="store_true", help="replace existing logs")
+    args = ap.parse_args()
+
+    if args.cmd == "export":
+        if args.archive == "-":
+            m = export(args.data_dir, sys.stdout.buffer)
+        else:
+            # Readers of the archive path see the finished file only
+            path = pathlib.Path(args.archive)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(tmp, "wb") as f:
+                m = export(args.data_dir, f)
+            os.replace(tmp, path)
+        size = sum(v["size"] for v in m["files"].values())
+        print(f"[ok] {len(m['files'])} files, {size / 1e6:.1f} MB as of {time.ctime(m['created_at'])} "
+              f"in {m['elapsed_s']:.1f}s", file=sys.stderr)
+    else:
+        if args.archive == "-":
+            r = restore(sys.stdin.buffer, args.data_dir, args.workers, args.force)
+        else:
+            with open(args.archive, "rb") as f:
+                r = restore(f, args.data_dir, args.workers, args.force)
+        print(f"[ok] {r['files']} files restored into {args.data_dir}: unpack {r['unpack_s']:.1f}s, "
+              f"rollups + indexes for {r['dirs']} dirs on {r['workers']} workers {r['rebuild_s']:.1f}s",
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
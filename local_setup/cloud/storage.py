@@ -0,0 +1,160 @@
+"""
+Append-only JSONL storage shared by every uvicorn worker.
+
+`uvicorn cloud.api:app --workers N` runs N processes that all append to the
+same data/telemetry.jsonl and data/alerts.jsonl. Each JsonlLog keeps one
+O_APPEND descriptor per process and funnels every write through a single
+`os.write` taken under an exclusive advisory file lock, so whole lines from
+different workers can never interleave. Encoding and scoring stay parallel
+across cores; only the write syscall itself is serialized.
+"""
+import contextlib
+import json
+import os
+import pathlib
+import threading
+from typing import Any, Dict, Iterable, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _lock_fd(fd: int, blocking: bool = True) -> bool:
+    # Exclusive lock shared by every process appending to this file
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+    except OSError:
+        if blocking:
+            raise
+        return False
+    return True
+
+
+def _unlock_fd(fd: int) -> None:
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+@contextlib.contextmanager
+def file_lock(path: pathlib.Path, blocking: bool = True) -> Iterator[bool]:
+    """
+    Hold an exclusive cross-process lock on a sidecar lock file.
+    Yields False (without waiting) if `blocking` is off and someone else holds it.
+    """
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        locked = _lock_fd(fd, blocking)
+        try:
+            yield locked
+        finally:
+            if locked:
+                _unlock_fd(fd)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def appends_paused(path: pathlib.Path) -> Iterator[int]:
+    """
+    Block every JsonlLog appending to `path`, in all processes, while the file
+    is copied or replaced. Yields a read-only descriptor of the live file.
+    Appenders waiting on the lock notice a replaced file and reopen it.
+    """
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        _lock_fd(fd)
+        try:
+            yield fd
+        finally:
+            _unlock_fd(fd)
+    finally:
+        os.close(fd)
+
+
+def write_json_atomic(path: pathlib.Path, obj: Any) -> None:
+    # Readers see either the old or the new file, never a partial one
+    path = pathlib.Path(path)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(obj, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def encode_line(record: Dict[str, Any]) -> bytes:
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class JsonlLog:
+    """
+    Process-safe appender for one JSONL file.
+    The descriptor is opened lazily so the object can be created at import
+    time, before uvicorn forks its workers.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_open(self) -> int:
+        # Re-open after fork so workers never share a parent's descriptor
+        if self._fd is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+            self._fd = os.open(self.path, flags, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    def append(self, record: Dict[str, Any]) -> None:
+        self.append_bytes(encode_line(record))
+
+    def append_many(self, records: Iterable[Dict[str, Any]]) -> None:
+        data = b"".join(encode_line(r) for r in records)
+        if data:
+            self.append_bytes(data)
+
+    def _acquire(self) -> int:
+        # Lock the live file. If it was swapped while we waited (retention
+        # compaction, restore), reopen so nothing lands in an unlinked inode.
+        while True:
+            fd = self._ensure_open()
+            _lock_fd(fd)
+            try:
+                live = os.path.samestat(os.fstat(fd), os.stat(self.path))
+            except FileNotFoundError:
+                live = False
+            if live:
+                return fd
+            _unlock_fd(fd)
+            os.close(fd)
+            self._fd = None
+
+    def append_bytes(self, data: bytes) -> None:
+        with self._lock:
+            fd = self._acquire()
+            try:
+                view = memoryview(data)
+                while view:
+                    n = os.write(fd, view)
+                    view = view[n:]
+            finally:
+                _unlock_fd(fd)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fd is not None and self._pid == os.getpid():
+                os.close(self._fd)
+            self._fd = None
+            self._pid = None
@@ -0,0 +1,249 @@
+"""
+Push stream of newly ingested telemetry and alerts (Server-Sent Events).
+
+A TailerSet per worker follows telemetry.jsonl and alerts.jsonl of every
+site directory (picking up new sites as they appear) and hands each new line
+to the Broker. Tailing the shared logs (rather than
+hooking ingest()) means a subscriber sees every sample even when
+`--workers N` spreads ingest over several processes. When retention or a
+restore replaces a log, its tailer carries on after the last line it had
+seen (or from the top of an unrelated log), so no appended line is skipped.
+
+The Broker encodes each event once and fans the bytes out to subscribers,
+indexed by device filter so a publish only touches interested clients. Each
+subscriber has a bounded deque: a slow consumer silently loses its oldest
+events (and is told how many) instead of growing memory or stalling others.
+"""
+import asyncio
+import json
+import mmap
+import os
+import pathlib
+from collections import deque
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+CLIENT_BUFFER = 256        # events buffered per subscriber before drop-oldest
+HEARTBEAT_SEC = 15         # SSE comment to keep proxies from closing idle streams
+TAIL_INTERVAL_SEC = 0.2
+DISCOVER_SEC = 5           # how often TailerSet looks for new logs
+LAST_LINE_PROBE = 8192     # bytes read back to remember the last line skipped over
+
+
+class Subscriber:
+    def __init__(self, devices: Optional[Set[str]], kinds: Optional[Set[str]], maxlen: int):
+        self.devices = devices
+        self.kinds = kinds
+        self.queue: deque = deque(maxlen=maxlen)
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+
+    def push(self, frame: bytes) -> None:
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(frame)
+        self.wakeup.set()
+
+
+class Broker:
+    def __init__(self, maxlen: int = CLIENT_BUFFER):
+        self.maxlen = maxlen
+        self._all: Set[Subscriber] = set()                 # no device filter
+        self._by_device: Dict[str, Set[Subscriber]] = {}
+        self._seq = 0
+        self._count = 0
+
+    @property
+    def subscribers(self) -> int:
+        return self._count
+
+    def subscribe(self, devices: Optional[Iterable[str]] = None,
+                  kinds: Optional[Iterable[str]] = None) -> Subscriber:
+        devs = set(devices) if devices else None
+        sub = Subscriber(devs, set(kinds) if kinds else None, self.maxlen)
+        self._count += 1
+        if devs is None:
+            self._all.add(sub)
+        else:
+            for d in devs:
+                self._by_device.setdefault(d, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        if sub.closed:
+            return
+        sub.closed = True
+        self._count -= 1
+        self._all.discard(sub)
+        for d in sub.devices or ():
+            subs = self._by_device.get(d)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._by_device[d]
+
+    def publish(self, kind: str, device_id: Optional[str], data: bytes) -> None:
+        """Fan one event out; `data` is the already-encoded JSON body."""
+        targets = self._all
+        if device_id is not None and device_id in self._by_device:
+            targets = targets | self._by_device[device_id]
+        if not targets:
+            return
+        self._seq += 1
+        frame = b"id: %d\nevent: %s\ndata: %s\n\n" % (self._seq, kind.encode(), data)
+        for sub in targets:
+            if sub.kinds is None or kind in sub.kinds:
+                sub.push(frame)
+
+    async def events(self, sub: Subscriber) -> AsyncIterator[bytes]:
+        """SSE byte stream for one subscriber; unsubscribes when the client goes away."""
+        try:
+            yield b"retry: 3000\n\n"
+            while True:
+                if not sub.queue:
+                    sub.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(sub.wakeup.wait(), HEARTBEAT_SEC)
+                    except asyncio.TimeoutError:
+                        yield b": ping\n\n"
+                        continue
+                if sub.dropped:
+                    yield b"event: dropped\ndata: %d\n\n" % sub.dropped
+                    sub.dropped = 0
+                # Hand over everything buffered in one write
+                frames = list(sub.queue)
+                sub.queue.clear()
+                yield b"".join(frames)
+        finally:
+            self.unsubscribe(sub)
+
+
+def _last_line(f, end: int) -> Optional[bytes]:
+    """Last complete line (with its newline) in the first `end` bytes of f."""
+    start = max(0, end - LAST_LINE_PROBE)
+    f.seek(start)
+    buf = f.read(end - start)
+    stop = buf.rfind(b"\n") + 1
+    if stop == 0:
+        return None
+    begin = buf.rfind(b"\n", 0, stop - 1) + 1
+    if begin == 0 and start > 0:
+        return None   # longer than the probe
+    return buf[begin:stop]
+
+
+def _resume_offset(path: pathlib.Path, last: Optional[bytes]) -> int:
+    """
+    Where to continue in a replaced log: just past `last` (the last line already
+    seen) if it is still there, since retention copies the lines it keeps byte
+    for byte; otherwise 0, as every line in the log is new.
+    """
+    if last is None:
+        return 0
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            pos = m.rfind(b"\n" + last)
+            if pos >= 0:
+                return pos + 1 + len(last)
+            return len(last) if m[:len(last)] == last else 0
+
+
+class LogTailer:
+    """Follow one JSONL log from its current end and publish each new line."""
+
+    def __init__(self, path: pathlib.Path, kind: str, broker: Broker, from_start: bool = False):
+        self.path = pathlib.Path(path)
+        self.kind = kind
+        self.broker = broker
+        self._offset = None
+        self._ino = None
+        self._last: Optional[bytes] = None   # last line before _offset
+        self._from_start = from_start   # for logs discovered after startup
+
+    def _skip_to(self, size: int) -> None:
+        with open(self.path, "rb") as f:
+            self._last = _last_line(f, size)
+        self._offset = size
+
+    def poll(self) -> None:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if self._offset is None:
+            self._ino = st.st_ino
+            if not self._from_start:
+                # First poll: start from its end, never replay
+                self._skip_to(st.st_size)
+                return
+            self._offset = 0
+        elif st.st_ino != self._ino or st.st_size < self._offset:
+            # Log replaced (retention, restore) or truncated: lines appended since
+            # the last poll are in the new one too, so carry on where we left off
+            self._offset, self._ino = _resume_offset(self.path, self._last), st.st_ino
+            st = os.stat(self.path)
+        if st.st_size <= self._offset:
+            return
+        if not self.broker.subscribers:
+            self._skip_to(st.st_size)
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            buf = f.read(st.st_size - self._offset)
+        end = buf.rfind(b"\n") + 1          # only complete lines
+        if end == 0:
+            return
+        self._offset += end
+        self._last = buf[buf.rfind(b"\n", 0, end - 1) + 1:end]
+        for line in buf[:end].splitlines():
+            try:
+                rec = json.loads(line)
+            except Exception:
+                continue
+            dev = rec.get("device_id") if isinstance(rec, dict) else None
+            self.broker.publish(self.kind, None if dev is None else str(dev), line)
+
+    async def run(self, interval: float = TAIL_INTERVAL_SEC) -> None:
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                pass
+            await asyncio.sleep(interval)
+
+
+class TailerSet:
+    """LogTailers for a changing set of logs; `sources()` lists (path, kind) pairs."""
+
+    def __init__(self, sources: Callable[[], List[Tuple[pathlib.Path, str]]], broker: Broker):
+        self.sources = sources
+        self.broker = broker
+        self._tailers: Dict[Tuple[str, str], LogTailer] = {}
+        self._started = False
+
+    def discover(self) -> None:
+        for path, kind in self.sources():
+            k = (str(path), kind)
+            if k not in self._tailers:
+                # Logs present at startup are followed from their end; later ones from the start
+                self._tailers[k] = LogTailer(path, kind, self.broker, from_start=self._started)
+        self._started = True
+
+    async def run(self, interval: float = TAIL_INTERVAL_SEC) -> None:
+        since = None
+        while True:
+            loop_t = asyncio.get_running_loop().time()
+            if since is None or loop_t - since >= DISCOVER_SEC:
+                since = loop_t
+                try:
+                    self.discover()
+                except Exception:
+                    pass
+            for t in list(self._tailers.values()):
+                try:
+                    t.poll()
+                except Exception:
+                    pass
+            await asyncio.sleep(interval)
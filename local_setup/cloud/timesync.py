@@ -0,0 +1,81 @@
+"""
+Server-side half of device time sync, and receive stamps for every sample.
+
+/now answers an NTP-style exchange: the device sends its own tick count as
+t0, and the reply carries it back with the server's receive and transmit
+times (rx_ms, tx_ms, integer epoch milliseconds, since MicroPython floats are
+single precision). From t0, its own receive tick and those two times the
+device gets the round trip and the server clock at the moment of receipt;
+comparing successive syncs gives its oscillator's drift rate
+(devices/m5stickc/main.py, sync_time()).
+
+Every accepted sample is stamped with the server's receive time (rx_ts).
+`ts` is then normalized:
+  - a device sending ts_ms (epoch ms) gets ts = ts_ms / 1000, so two samples
+    within the same second still sort correctly,
+  - a ts that is missing, not a number, from before MIN_VALID_TS (clock
+    never synced), more than MAX_SKEW_SEC behind arrival or more than
+    MAX_AHEAD_SEC ahead of it is not believed: ts becomes rx_ts and the
+    device's value is kept as device_ts.
+Loads that must see samples in arrival order (training features, so they
+match what /ingest computed) sort by rx_ts and fall back to ts for records
+written before it existed.
+"""
+import time
+from typing import Any, Dict, Optional
+
+MIN_VALID_TS = 1700000000  # same sanity floor as the firmware's sync check
+MAX_SKEW_SEC = 120         # retries and slow links arrive seconds late, not minutes
+MAX_AHEAD_SEC = 5          # a sample cannot come from the future
+
+
+def now_reply(t0: Optional[int], received: float) -> Dict[str, Any]:
+    """Body of /now; `received` is when the request came in."""
+    sent = time.time()
+    return {
+        "now": sent,                       # seconds, as before (older firmware)
+        "t0": t0,
+        "rx_ms": int(received * 1000),
+        "tx_ms": int(sent * 1000),
+    }
+
+
+def _as_float(v) -> Optional[float]:
+    if isinstance(v, bool):
+        return None
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return None
+    return f if f == f else None
+
+
+class ClockCheck:
+    """Stamps samples at arrival and replaces timestamps that cannot be right."""
+
+    def __init__(self, max_skew: float = MAX_SKEW_SEC, max_ahead: float = MAX_AHEAD_SEC):
+        self.max_skew = max_skew
+        self.max_ahead = max_ahead
+        self.stamped = 0
+        self.corrected = 0
+
+    def stamp(self, payload: Dict[str, Any], received: Optional[float] = None) -> bool:
+        """Add rx_ts and normalize ts in place; True if ts was replaced."""
+        received = time.time() if received is None else received
+        payload["rx_ts"] = received
+        self.stamped += 1
+        ms = _as_float(payload.get("ts_ms"))
+        ts = ms / 1000.0 if ms is not None else _as_float(payload.get("ts"))
+        if ts is not None and ts >= MIN_VALID_TS and \
+                received - self.max_skew <= ts <= received + self.max_ahead:
+            if ms is not None:
+                payload["ts"] = ts
+            return False
+        payload["device_ts"] = payload.get("ts")
+        payload["ts"] = received
+        self.corrected += 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {"stamped": self.stamped, "corrected": self.corrected,
+                "max_skew_s": self.max_skew, "max_ahead_s": self.max_ahead}
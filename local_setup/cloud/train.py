@@ -1,19 +1,40 @@
 #!/usr/bin/env python3
 """
 Train an unsupervised anomaly detector from data/telemetry.jsonl
+(plus the 1-minute / hourly rollup tiers written by cloud/retention.py)
 - Saves: data/model.joblib, data/feature_cols.json, data/training_stats.json
+- Files are replaced atomically, so a running API switches models cleanly
+- `--site <site_id>` trains on one site only and saves into data/sites/<site_id>/,
+  which the API then uses for that site instead of the shared model
+- Besides the instantaneous FEATURES, the model sees each device's rolling-window
+  features (cloud/features.py), computed exactly as /ingest computes them
 """
-import json, pathlib, time
-from typing import List
+import argparse, json, os, pathlib, re, time
+from typing import Any, Dict, Iterable, List
+import numpy as np
 import pandas as pd
 
+try:
+    from .colreader import read_many
+    from .features import add_features, derived_cols
+except ImportError:  # run as a script: python cloud/train.py
+    from colreader import read_many
+    from features import add_features, derived_cols
+
 # Define paths for data and model storage
 DATA_DIR = pathlib.Path(__file__).resolve().parent.parent / "data"
 DATA_FILE = DATA_DIR / "telemetry.jsonl"
+# Retention tiers, coarsest first; rollups share the raw record shape
+TIER_NAMES = ["telemetry_1h.jsonl", "telemetry_1m.jsonl", "telemetry.jsonl"]
+# Per-site shards written by cloud/sites.py
+SITES_DIR = DATA_DIR / "sites"
 MODEL_FILE = DATA_DIR / "model.joblib"
 FEAT_FILE = DATA_DIR / "feature_cols.json"
 STATS_FILE = DATA_DIR / "training_stats.json"
 
+# Reference distribution stored for drift detection (see cloud/drift.py)
+REF_QUANTILES = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
 # Candidate feature columns to be used for training
 FEATURES = [
     "metrics.ambient_temp_c",
@@ -22,6 +43,8 @@ FEATURES = [
     "metrics.eco2_ppm",
     "metrics.tvoc_ppb",
 ]
+# Fields read from the logs: features plus what _dedup and sorting need
+LOAD_FIELDS = ["ts", "rx_ts", "device_id", "site_id", "boot", "seq"] + FEATURES
 
 def _flatten(d, parent_key="", sep="."):
     """
@@ -38,48 +61,124 @@ def _flatten(d, parent_key="", sep="."):
             items.append((nk, v))
     return dict(items)
 
-def _load_df() -> pd.DataFrame:
-    if not DATA_FILE.exists():
+def _site_dir(site_id: str) -> pathlib.Path:
+    # Same directory naming as cloud/sites.py
+    key = re.sub(r"[^A-Za-z0-9._-]", "_", str(site_id).strip())
+    return SITES_DIR / ("_" + key if key.startswith(".") else key)
+
+def _load_df(site_id: str = None) -> pd.DataFrame:
+    # data/ (unsited and pre-sharding samples) plus the site shards: all of them,
+    # or only the given site's
+    if site_id is None:
+        dirs = [DATA_DIR] + (sorted(p for p in SITES_DIR.iterdir() if p.is_dir()) if SITES_DIR.is_dir() else [])
+    else:
+        dirs = [DATA_DIR, _site_dir(site_id)]
+    files = [d / name for d in dirs for name in TIER_NAMES]
+    cols = read_many(files, LOAD_FIELDS, site_id=site_id)
+    if not len(cols["ts"]):
         return pd.DataFrame()
-    rows = []
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            try:
-                rows.append(json.loads(line))
-            except:
-                continue
-    if not rows:
+    return _arrival_order(_dedup(pd.DataFrame(cols)))
+
+def _frame(rows: Iterable[Dict[str, Any]]) -> pd.DataFrame:
+    # Raw telemetry records -> de-duplicated LOAD_FIELDS frame in arrival order.
+    # Records are consumed one at a time, so a generator is never held as dicts.
+    cols = {c: [] for c in LOAD_FIELDS}
+    for r in rows:
+        flat = _flatten(r)
+        for c, v in cols.items():
+            v.append(flat.get(c))
+    if not cols["ts"]:
         return pd.DataFrame()
-    flats = [_flatten(r) for r in rows]
-    df = pd.DataFrame(flats)
-    # Sort by timestamp if present
-    if "ts" in df.columns:
-        df = df.sort_values("ts")
+    df = pd.DataFrame(cols)
+    df = _dedup(df)
+    df = _arrival_order(df)
     # Ensure selected features are numeric
     for c in FEATURES:
         if c in df.columns:
             df[c] = pd.to_numeric(df[c], errors="coerce")
     return df
 
-def _clean(df: pd.DataFrame, cols: List[str]) -> pd.DataFrame:
-    # Clean the dataset: Clip extreme values to the 0.1% and 99.9% quantiles
+def _arrival_order(df: pd.DataFrame) -> pd.DataFrame:
+    # The order /ingest saw the samples in (server receive stamp rx_ts; ts for
+    # records from before it), so window features match the online ones
+    if "ts" not in df.columns:
+        return df
+    key = pd.to_numeric(df["ts"], errors="coerce")
+    if "rx_ts" in df.columns:
+        key = pd.to_numeric(df["rx_ts"], errors="coerce").fillna(key)
+    return df.iloc[np.argsort(key.to_numpy(dtype=float), kind="stable")]
+
+def _dedup(df: pd.DataFrame) -> pd.DataFrame:
+    # Drop retried samples: by idempotency key (device_id, boot, seq) when present,
+    # otherwise rows with identical device, timestamp and readings
+    if "seq" in df.columns:
+        key = [c for c in ("device_id", "boot", "seq") if c in df.columns]
+        keyed = df["seq"].notna()
+        df = pd.concat([df[keyed].drop_duplicates(subset=key), df[~keyed]])
+    subset = [c for c in ["device_id", "ts"] + FEATURES if c in df.columns]
+    return df.drop_duplicates(subset=subset) if subset else df
+
+def _clip(df: pd.DataFrame, cols: List[str]):
+    # Clip extreme values to the 0.1% and 99.9% quantiles; returns (clipped, lo, hi)
     x = df[cols].copy()
-    x = x.clip(lower=x.quantile(0.001), upper=x.quantile(0.999), axis=1)
-    return x.dropna()
+    lo, hi = x.quantile(0.001), x.quantile(0.999)
+    return x.clip(lower=lo, upper=hi, axis=1), lo, hi
+
+def _reference(x: pd.DataFrame, lo: pd.Series, hi: pd.Series) -> Dict[str, Any]:
+    # Decile bin edges plus the share of training rows per bin, per feature over
+    # every row that has it (the monitor bins each feature on its own too). Bins
+    # are searchsorted(edges, v, side="right") of the value clipped to [lo, hi],
+    # the same rule the drift monitor uses.
+    ref = {}
+    for c in x.columns:
+        v = x[c].dropna().to_numpy(dtype=float)
+        if not len(v):
+            continue
+        edges = np.unique(np.quantile(v, REF_QUANTILES))
+        counts = np.bincount(np.searchsorted(edges, v, side="right"), minlength=len(edges) + 1)
+        ref[c] = {
+            "edges": edges.tolist(),
+            "expected": (counts / max(1, counts.sum())).tolist(),
+            "lo": float(lo[c]),
+            "hi": float(hi[c]),
+            "mean": float(v.mean()),
+            "std": float(v.std()),
+        }
+    return ref
+
+def _write_atomic(path: pathlib.Path, write) -> None:
+    # Write next to the target, then rename over it
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    write(tmp)
+    os.replace(tmp, path)
+
+def _ts_range(df: pd.DataFrame):
+    if "ts" not in df.columns:
+        return None
+    ts = pd.to_numeric(df["ts"], errors="coerce").dropna()
+    return [float(ts.min()), float(ts.max())] if len(ts) else None
 
-def train():
+def fit(df: pd.DataFrame, source: str = "data/telemetry.jsonl", out_dir: pathlib.Path = None) -> Dict[str, Any]:
     """
-    Train an anomaly detection model.
-    - Preferred: IsolationForest
-    - Fallback: Robust Z-score method
+    Fit on a telemetry frame and promote the result atomically
+    (into data/, or out_dir for a site model).
+    Returns the saved training statistics.
     """
-    df = _load_df()
+    out_dir = pathlib.Path(out_dir) if out_dir is not None else DATA_DIR
+    out_dir.mkdir(parents=True, exist_ok=True)
+    model_file = out_dir / MODEL_FILE.name
+    feat_file = out_dir / FEAT_FILE.name
+    stats_file = out_dir / STATS_FILE.name
     if df.empty:
-        raise SystemExit("No telemetry found at data/telemetry.jsonl")
+        raise SystemExit(f"No telemetry found at {source}")
+    # Rolling-window features per device; df is in arrival order (_load_df / _frame)
+    df = add_features(df)
     cols = [c for c in FEATURES if c in df.columns]
+    cols += derived_cols(cols)
     if len(cols) < 2:
         raise SystemExit(f"Not enough features to train. Found: {cols}")
-    X = _clean(df, cols)
+    clipped, lo, hi = _clip(df, cols)
+    X = clipped.dropna()
     if len(X) < 100:
         print(f"[warn] Only {len(X)} rows after cleaning; model may be weak (>=100 recommended).")
 
@@ -94,25 +193,46 @@ def train():
             n_jobs=-1,
         )
         clf.fit(X)
-        dump({"model": "IsolationForest", "clf": clf, "cols": cols}, MODEL_FILE)
+        model = {"model": "IsolationForest", "clf": clf, "cols": cols}
+        _write_atomic(model_file, lambda p: dump(model, p))
         algo = "IsolationForest"
     except Exception:
         # Fallback: Robust Z-score method
         med = X.median()
         mad = (X - med).abs().median().replace(0, 1e-6)
         params = {"median": med.to_dict(), "mad": mad.to_dict(), "k": 6.0, "cols": cols}
-        MODEL_FILE.write_text(json.dumps({"model": "RobustZ", "params": params}), encoding="utf-8")
+        text = json.dumps({"model": "RobustZ", "params": params})
+        _write_atomic(model_file, lambda p: p.write_text(text, encoding="utf-8"))
         algo = "RobustZ"
 
     # Save training statistics
-    FEAT_FILE.write_text(json.dumps(cols, ensure_ascii=False, indent=2), encoding="utf-8")
-    STATS_FILE.write_text(json.dumps({
+    stats = {
         "trained_at": time.time(),
         "algo": algo,
         "rows_used": int(len(X)),
         "feature_cols": cols,
-    }, indent=2), encoding="utf-8")
-    print(f"OK: trained {algo} on {len(X)} rows with features={cols}")
+        "ts_range": _ts_range(df),
+        "reference": _reference(clipped, lo, hi),
+    }
+    feat_text = json.dumps(cols, ensure_ascii=False, indent=2)
+    stats_text = json.dumps(stats, indent=2)
+    _write_atomic(feat_file, lambda p: p.write_text(feat_text, encoding="utf-8"))
+    _write_atomic(stats_file, lambda p: p.write_text(stats_text, encoding="utf-8"))
+    print(f"OK: trained {algo} on {len(X)} rows with features={cols} -> {model_file}")
+    return stats
+
+def train(site_id: str = None):
+    """
+    Train an anomaly detection model.
+    - Preferred: IsolationForest
+    - Fallback: Robust Z-score method
+    """
+    if site_id is None:
+        fit(_load_df())
+    else:
+        fit(_load_df(site_id), source=f"site {site_id}", out_dir=_site_dir(site_id))
 
 if __name__ == "__main__":
-    train()
\ No newline at end of file
+    ap = argparse.ArgumentParser(description="Train the anomaly model.")
+    ap.add_argument("--site", default=None, help="train a model for one site_id only")
+    train(ap.parse_args().site)
@@ -0,0 +1,297 @@
+"""
+Sparse timestamp -> byte-offset index over data/telemetry.jsonl.
+
+The log is cut into blocks of roughly BLOCK_BYTES. For each block we keep its
+byte range, min/max `ts`, and the device_ids / site_ids seen in it. A range
+query bisects to the first block that can hold `from`, skips blocks whose
+time range or device set cannot match, and seeks straight to the rest, so
+only matching blocks are ever read and memory stays flat whatever the range.
+
+The index is refreshed incrementally (only bytes appended since the last
+refresh are scanned) and persisted next to the log so restarts do not rescan
+months of history.
+"""
+import bisect
+import io
+import json
+import os
+import pathlib
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+
+BLOCK_BYTES = 64 * 1024
+INDEX_VERSION = 1
+
+
+def _flatten(d, parent_key: str = "", sep: str = "."):
+    items = []
+    for k, v in d.items():
+        nk = f"{parent_key}{sep}{k}" if parent_key else k
+        if isinstance(v, dict):
+            items.extend(_flatten(v, nk, sep=sep).items())
+        else:
+            items.append((nk, v))
+    return dict(items)
+
+
+def _as_ts(v) -> Optional[float]:
+    try:
+        t = float(v)
+    except (TypeError, ValueError):
+        return None
+    return t if t == t else None
+
+
+class _Block:
+    __slots__ = ("start", "end", "min_ts", "max_ts", "devices", "sites")
+
+    def __init__(self, start: int):
+        self.start = start
+        self.end = start
+        self.min_ts: Optional[float] = None
+        self.max_ts: Optional[float] = None
+        self.devices = set()
+        self.sites = set()
+
+    def add(self, end: int, ts: Optional[float], device_id, site_id) -> None:
+        self.end = end
+        if ts is not None:
+            self.min_ts = ts if self.min_ts is None else min(self.min_ts, ts)
+            self.max_ts = ts if self.max_ts is None else max(self.max_ts, ts)
+        if device_id is not None:
+            self.devices.add(str(device_id))
+        if site_id is not None:
+            self.sites.add(str(site_id))
+
+    def to_list(self) -> list:
+        return [self.start, self.end, self.min_ts, self.max_ts, sorted(self.devices), sorted(self.sites)]
+
+    @classmethod
+    def from_list(cls, v: list) -> "_Block":
+        b = cls(v[0])
+        b.end, b.min_ts, b.max_ts = v[1], v[2], v[3]
+        b.devices, b.sites = set(v[4]), set(v[5])
+        return b
+
+
+class TelemetryIndex:
+    def __init__(self, path: pathlib.Path, index_path: Optional[pathlib.Path] = None,
+                 block_bytes: int = BLOCK_BYTES):
+        self.path = pathlib.Path(path)
+        self.index_path = index_path or self.path.with_name(self.path.name + ".idx")
+        self.block_bytes = block_bytes
+        self._lock = threading.Lock()
+        self._reset()
+        self._load()
+
+    def _reset(self, ident=None) -> None:
+        self.blocks: List[_Block] = []    # closed blocks, ordered by offset
+        self._cummax: List[float] = []    # running max of max_ts, for bisect
+        self._tail: Optional[_Block] = None
+        self.indexed_upto = 0
+        self._ident = ident
+
+    @staticmethod
+    def _file_ident(st: os.stat_result):
+        # Changes when the log is replaced (retention rewrite, restore)
+        return [st.st_ino, st.st_dev]
+
+    # ---------- persistence ----------
+    def _load(self) -> None:
+        try:
+            raw = json.loads(self.index_path.read_text(encoding="utf-8"))
+            if raw.get("version") != INDEX_VERSION or raw.get("block_bytes") != self.block_bytes:
+                return
+            self._ident = raw["ident"]
+            for v in raw["blocks"]:
+                self._close(_Block.from_list(v))
+            self.indexed_upto = int(raw["indexed_upto"])
+        except Exception:
+            self._reset()
+
+    def _save(self) -> None:
+        # Only closed blocks are persisted; the tail is rescanned on load
+        upto = self.blocks[-1].end if self.blocks else 0
+        data = {
+            "version": INDEX_VERSION,
+            "block_bytes": self.block_bytes,
+            "ident": self._ident,
+            "indexed_upto": upto,
+            "blocks": [b.to_list() for b in self.blocks],
+        }
+        tmp = self.index_path.with_name(f"{self.index_path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(data, separators=(",", ":")), encoding="utf-8")
+        os.replace(tmp, self.index_path)
+
+    # ---------- building ----------
+    def _close(self, b: _Block) -> None:
+        self.blocks.append(b)
+        prev = self._cummax[-1] if self._cummax else float("-inf")
+        self._cummax.append(max(prev, b.max_ts if b.max_ts is not None else prev))
+
+    def refresh(self) -> None:
+        """Index any complete lines appended since the last call."""
+        with self._lock:
+            try:
+                st = self.path.stat()
+            except FileNotFoundError:
+                self._reset()
+                return
+            ident = self._file_ident(st)
+            if ident != self._ident or st.st_size < self.indexed_upto:
+                self._reset(ident)
+            if st.st_size == self.indexed_upto:
+                return
+            closed = False
+            with open(self.path, "rb") as f:
+                f.seek(self.indexed_upto)
+                pos = self.indexed_upto
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # partial line still being written
+                    start, pos = pos, pos + len(line)
+                    try:
+                        rec = json.loads(line)
+                    except Exception:
+                        rec = None
+                    if self._tail is None:
+                        self._tail = _Block(start)
+                    if isinstance(rec, dict):
+                        self._tail.add(pos, _as_ts(rec.get("ts")), rec.get("device_id"), rec.get("site_id"))
+                    else:
+                        self._tail.end = pos
+                    if self._tail.end - self._tail.start >= self.block_bytes:
+                        self._close(self._tail)
+                        self._tail = None
+                        closed = True
+                self.indexed_upto = pos
+            if closed:
+                try:
+                    self._save()
+                except OSError:
+                    pass
+
+    # ---------- querying ----------
+    def _candidates(self, device_id, site_id, t_from, t_to) -> List[_Block]:
+        blocks = self.blocks + ([self._tail] if self._tail is not None else [])
+        first = bisect.bisect_left(self._cummax, t_from) if t_from is not None else 0
+        out = []
+        for b in blocks[first:]:
+            if t_from is not None or t_to is not None:
+                if b.max_ts is None:
+                    continue
+                if t_from is not None and b.max_ts < t_from:
+                    continue
+                if t_to is not None and b.min_ts > t_to:
+                    continue
+            if device_id is not None and device_id not in b.devices:
+                continue
+            if site_id is not None and site_id not in b.sites:
+                continue
+            out.append(b)
+        return out
+
+    def query(self, device_id: Optional[str] = None, site_id: Optional[str] = None,
+              t_from: Optional[float] = None, t_to: Optional[float] = None,
+              fields: Optional[List[str]] = None, limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Yield records in log order matching all filters. With `fields`, records
+        are flattened and reduced to ts / device_id / site_id plus those keys.
+        A `limit` of 0 or less yields nothing.
+        """
+        if limit is not None and limit <= 0:
+            return
+        self.refresh()
+        with self._lock:
+            blocks = self._candidates(device_id, site_id, t_from, t_to)
+        if not blocks:
+            return
+        n = 0
+        with open(self.path, "rb") as f:
+            for b in blocks:
+                f.seek(b.start)
+                for line in f.read(b.end - b.start).splitlines():
+                    try:
+                        rec = json.loads(line)
+                    except Exception:
+                        continue
+                    if not isinstance(rec, dict):
+                        continue
+                    if device_id is not None and str(rec.get("device_id")) != device_id:
+                        continue
+                    if site_id is not None and str(rec.get("site_id")) != site_id:
+                        continue
+                    if t_from is not None or t_to is not None:
+                        ts = _as_ts(rec.get("ts"))
+                        if ts is None or (t_from is not None and ts < t_from) or (t_to is not None and ts > t_to):
+                            continue
+                    if fields:
+                        flat = _flatten(rec)
+                        rec = {k: flat.get(k) for k in ["ts", "device_id", "site_id"] + fields}
+                    yield rec
+                    n += 1
+                    if limit is not None and n >= limit:
+                        return
+
+
+def to_ndjson(records: Iterator[Dict[str, Any]]) -> Iterator[bytes]:
+    for rec in records:
+        yield (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class _Drain(io.RawIOBase):
+    # Write-only sink that hands back whatever was written since the last drain
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        out, self._chunks = b"".join(self._chunks), []
+        return out
+
+
+def to_arrow(records: Iterator[Dict[str, Any]], fields: List[str], batch_rows: int = 4096) -> Iterator[bytes]:
+    """Stream records as an Arrow IPC stream, one record batch at a time (requires pyarrow)."""
+    import pyarrow as pa
+
+    schema = pa.schema(
+        [("ts", pa.float64()), ("device_id", pa.string()), ("site_id", pa.string())]
+        + [(c, pa.float64()) for c in fields]
+    )
+    sink = _Drain()
+    writer = pa.ipc.new_stream(sink, schema)
+
+    def _num(v):
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return None
+
+    def _str(v):
+        return None if v is None else str(v)
+
+    def _batch(buf):
+        arrays = [
+            pa.array([_num(r.get("ts")) for r in buf], pa.float64()),
+            pa.array([_str(r.get("device_id")) for r in buf], pa.string()),
+            pa.array([_str(r.get("site_id")) for r in buf], pa.string()),
+        ] + [pa.array([_num(r.get(c)) for r in buf], pa.float64()) for c in fields]
+        return pa.record_batch(arrays, schema=schema)
+
+    buf = []
+    for rec in records:
+        buf.append(rec)
+        if len(buf) >= batch_rows:
+            writer.write_batch(_batch(buf))
+            buf = []
+            yield sink.drain()
+    if buf:
+        writer.write_batch(_batch(buf))
+    writer.close()
+    yield sink.drain()
@@ -1,50 +1,55 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
-import json, pathlib, os
+import json, pathlib, os, sys, threading, time
+
+# The column reader lives with the API code (local_setup/cloud)
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from cloud.colreader import DEFAULT_FIELDS, read_many
+from cloud.heartbeat import offline_after
+from cloud.rules import SEV_HIGH_PROB, SEV_MEDIUM_PROB
 
 # -------------------------------
 st.set_page_config(page_title="DIA Lift Station Monitors (ENV/GAS)", layout="wide")
 st.title("DIA Lift Station Monitors — ENV/GAS Demo")
 
-DATA_FILE = pathlib.Path(__file__).resolve().parent.parent / "data" / "telemetry.jsonl"
-ALERTS_FILE = pathlib.Path(__file__).resolve().parent.parent / "data" / "alerts.jsonl"
+DATA_DIR = pathlib.Path(__file__).resolve().parent.parent / "data"
+# Retention tiers written by cloud/retention.py, coarsest first
+TIER_NAMES = ["telemetry_1h.jsonl", "telemetry_1m.jsonl", "telemetry.jsonl"]
+DEVICES_FILE = DATA_DIR / "devices.json"
 
 DISPLAY_TZ = "America/Denver"
+ALERTS_SHOWN = 500       # rows in the alerts table
+ALERTS_WINDOW = 5000     # most recent alert lines considered for it
+REFRESH_SEC = 5          # shared cache refresh interval (all sessions)
 
 # -------------------------------
-@st.cache_data(ttl=5)
-def load_df():
-    if not DATA_FILE.exists() or os.path.getsize(DATA_FILE) == 0:
-        return pd.DataFrame([])
+def site_dirs():
+    # data/ plus one directory per site shard (cloud/sites.py)
+    sites = DATA_DIR / "sites"
+    return [DATA_DIR] + (sorted(p for p in sites.iterdir() if p.is_dir()) if sites.is_dir() else [])
 
-    rows = []
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            try:
-                rows.append(json.loads(line))
-            except Exception:
-                pass
-    if not rows:
-        return pd.DataFrame([])
+def tier_files():
+    return [d / name for name in TIER_NAMES for d in site_dirs()]
 
-    df = pd.json_normalize(rows)
+def alert_files():
+    return [d / "alerts.jsonl" for d in site_dirs()]
+
+# -------------------------------
+def load_df():
+    # Only the shown fields, read column-wise from the mapped files (cloud/colreader.py).
+    # Rollups keep their means in metrics.*, so their min/max/count are never read.
+    cols = read_many(tier_files(), DEFAULT_FIELDS)
+    if not len(cols["ts"]):
+        return pd.DataFrame([])
+    df = pd.DataFrame(cols)
 
     if "ts" in df.columns:
         df["ts"] = pd.to_datetime(df["ts"], unit="s", utc=True, errors="coerce")
         df["Time"] = df["ts"].dt.tz_convert(DISPLAY_TZ).dt.tz_localize(None)
         df = df.drop(columns=["ts"])
 
-    metric_cols = [
-        "metrics.ambient_rh_pct",
-        "metrics.pressure_hpa",
-        "metrics.eco2_ppm",
-        "metrics.tvoc_ppb",
-        "metrics.ambient_temp_c",
-    ]
-    for c in metric_cols:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
-
+    # metrics.* arrive as float64 (NaN where missing); no per-column coercion needed
     if "metrics.ambient_temp_c" in df.columns:
         df["metrics.ambient_temp_f"] = df["metrics.ambient_temp_c"] * 9.0 / 5.0 + 32.0
         df = df.drop(columns=["metrics.ambient_temp_c"])
@@ -55,14 +60,73 @@ def load_df():
     return df
 
 # -------------------------------
-@st.cache_data(ttl=5)
-def load_alerts_clean():
-    if not ALERTS_FILE.exists() or os.path.getsize(ALERTS_FILE) == 0:
+def load_devices():
+    # Device registry snapshot written by cloud/api.py (one row per device)
+    if not DEVICES_FILE.exists():
+        return pd.DataFrame([])
+    try:
+        devices = json.loads(DEVICES_FILE.read_text(encoding="utf-8")).get("devices", [])
+    except Exception:
+        return pd.DataFrame([])
+    if not devices:
         return pd.DataFrame([])
 
     rows = []
-    with open(ALERTS_FILE, "r", encoding="utf-8") as f:
-        for line in f:
+    for d in devices:
+        row = {
+            "device_id": d.get("device_id"),
+            "site_id": d.get("site_id"),
+            "last_seen": d.get("last_seen"),
+            "Samples": d.get("count"),
+            "ts": (d.get("latest") or {}).get("ts"),
+            "offline_after": offline_after((d.get("firmware") or {}).get("interval_s")),
+        }
+        for k, v in ((d.get("latest") or {}).get("metrics") or {}).items():
+            row[f"metrics.{k}"] = v
+        rows.append(row)
+    df = pd.DataFrame(rows)
+
+    now = pd.Timestamp.now(tz="UTC").timestamp()
+    df["Staleness (s)"] = now - pd.to_numeric(df["last_seen"], errors="coerce")
+    # Same rule as the server's offline alerts: 3 missed reports + grace
+    df["Status"] = df["Staleness (s)"].lt(df["offline_after"]).map({True: "online", False: "OFFLINE"})
+    df["Last Seen"] = (
+        pd.to_datetime(df["last_seen"], unit="s", utc=True, errors="coerce")
+        .dt.tz_convert(DISPLAY_TZ).dt.tz_localize(None)
+    )
+    df["Time"] = (
+        pd.to_datetime(df["ts"], unit="s", utc=True, errors="coerce")
+        .dt.tz_convert(DISPLAY_TZ).dt.tz_localize(None)
+    )
+    if "metrics.ambient_temp_c" in df.columns:
+        df["metrics.ambient_temp_f"] = pd.to_numeric(df["metrics.ambient_temp_c"], errors="coerce") * 9.0 / 5.0 + 32.0
+    return df.drop(columns=["last_seen", "ts", "offline_after"] + [c for c in ["metrics.ambient_temp_c"] if c in df.columns])
+
+# -------------------------------
+def _tail_lines(path, n):
+    # Last n lines of a file, read backwards in blocks instead of a full scan
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        buf = b""
+        while pos > 0 and buf.count(b"\n") <= n:
+            step = min(64 * 1024, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+    lines = buf.splitlines()
+    if pos > 0:
+        lines = lines[1:]  # first line may be cut
+    return lines[-n:]
+
+
+def load_alerts_clean():
+    # Alerts are appended in time order, so the newest ones are at each file's tail
+    rows = []
+    for path in alert_files():
+        if not path.exists() or os.path.getsize(path) == 0:
+            continue
+        for line in _tail_lines(path, ALERTS_WINDOW):
             try:
                 rows.append(json.loads(line))
             except Exception:
@@ -72,6 +136,29 @@ def load_alerts_clean():
 
     df = pd.json_normalize(rows)
 
+    # Severity: written by cloud/api.py; derived with vectorized masks for older alerts
+    none = pd.Series(None, index=df.index, dtype=object)
+    prob = pd.to_numeric(df.get("details.anomaly_prob", none), errors="coerce")
+    has_rule = df.get("details.rule_alerts", none).map(len, na_action="ignore").fillna(0).gt(0)
+    is_anom = df.get("details.is_anomaly", none).isin([True, "True", "true"])
+    derived = pd.Series(
+        np.select(
+            [has_rule, prob.ge(SEV_HIGH_PROB), prob.ge(SEV_MEDIUM_PROB), is_anom],
+            ["CRITICAL", "HIGH", "MEDIUM", "MEDIUM"],
+            default=None,
+        ),
+        index=df.index,
+    )
+    df["Severity"] = df["severity"].fillna(derived) if "severity" in df.columns else derived
+    df = df[df["Severity"].notna()]
+
+    # Partial sort: pick the newest rows before building display columns
+    if "ts" in df.columns:
+        df["ts"] = pd.to_numeric(df["ts"], errors="coerce")
+        df = df.nlargest(ALERTS_SHOWN, "ts")
+    else:
+        df = df.tail(ALERTS_SHOWN).iloc[::-1]
+
     if "ts" in df.columns:
         df["ts"] = pd.to_datetime(df["ts"], unit="s", utc=True, errors="coerce")
         df["Time"] = df["ts"].dt.tz_convert(DISPLAY_TZ).dt.tz_localize(None)
@@ -83,12 +170,10 @@ def load_alerts_clean():
         df["Algo"] = df["details.algo"]
     if "details.anomaly_prob" in df.columns:
         df["Anomaly Prob"] = pd.to_numeric(df["details.anomaly_prob"], errors="coerce")
-    if "details.is_anomaly" in df.columns:
-        df["is_anomaly"] = df["details.is_anomaly"]
     if "details.rule_alerts" in df.columns:
-        df["Rule Alerts"] = df["details.rule_alerts"].apply(
-            lambda x: ", ".join(x) if isinstance(x, list) else (x if isinstance(x, str) else None)
-        )
+        # Lists (or plain strings) -> one comma-separated string per alert
+        joined = df["details.rule_alerts"].explode().dropna().astype(str).groupby(level=0).agg(", ".join)
+        df["Rule Alerts"] = joined.reindex(df.index)
     snap_map_no_temp = {
         "sample.metrics.ambient_rh_pct": "Humidity (%)",
         "sample.metrics.pressure_hpa":   "Pressure (hPa)",
@@ -104,41 +189,146 @@ def load_alerts_clean():
             df["sample.metrics.ambient_temp_c"], errors="coerce"
         ) * 9.0 / 5.0 + 32.0
 
-    def sev_row(r):
-        if isinstance(r.get("Rule Alerts"), str) and r["Rule Alerts"]:
-            return "CRITICAL"
-        p = r.get("Anomaly Prob")
-        if pd.notna(p):
-            if p >= 0.85:
-                return "HIGH"
-            if p >= 0.60:
-                return "MEDIUM"
-        if r.get("is_anomaly") in (True, "True", "true"):
-            return "MEDIUM"
-        return None
-
-    df["Severity"] = df.apply(sev_row, axis=1)
-    df = df[df["Severity"].notna()]
-
     order = [
-        "Severity", "Time", "device_id", "Algo",
+        "Severity", "Time", "site_id", "device_id", "Algo",
         "Anomaly Prob", "Score", "Rule Alerts",
         "Temperature (°F)", "Humidity (%)", "Pressure (hPa)", "eCO2 (ppm)", "TVOC (ppb)",
     ]
     existing = [c for c in order if c in df.columns]
-    df = df[existing]
-
-    df = df.sort_values("Time", ascending=False).head(500)
-    return df
+    return df[existing]
 
 # -------------------------------
-df = load_df()
-alerts_df = load_alerts_clean()
+RENAME_MAP = {
+    "metrics.ambient_temp_f": "Temperature (°F)",
+    "metrics.ambient_rh_pct": "Humidity (%)",
+    "metrics.pressure_hpa":   "Air Pressure (hPa)",
+    "metrics.eco2_ppm":       "eCO2 (ppm)",
+    "metrics.tvoc_ppb":       "TVOC (ppb)",
+    "device_id":              "Device ID",
+    "site_id":                "Site ID",
+}
+ORDER = [
+    "Device ID",
+    "Site ID",
+    "Time",
+    "Temperature (°F)",
+    "Humidity (%)",
+    "Air Pressure (hPa)",
+    "eCO2 (ppm)",
+    "TVOC (ppb)",
+]
+PLOT_COLS = [
+    "Temperature (°F)",
+    "Humidity (%)",
+    "Air Pressure (hPa)",
+    "eCO2 (ppm)",
+    "TVOC (ppb)",
+]
+
+
+def build_telemetry_view(df):
+    # Display-ready history: renamed, ordered, plus one series per chart
+    if df.empty:
+        return {"df": df, "series": {}}
+    df = df.rename(columns=RENAME_MAP)
+    existing = [c for c in ORDER if c in df.columns]
+    others = [c for c in df.columns if c not in existing]
+    df = df[existing + others]
+    series = {}
+    if "Time" in df.columns:
+        indexed = df.set_index("Time")
+        series = {c: indexed[c].dropna() for c in PLOT_COLS if c in df.columns}
+    return {"df": df, "series": series}
+
 
-st.caption(f"Data file: {DATA_FILE}")
+def build_devices_view(devices_df):
+    if devices_df.empty:
+        return None
+    latest = devices_df.rename(columns=RENAME_MAP)
+    first = ["Status", "Device ID", "Site ID", "Time", "Last Seen", "Staleness (s)", "Samples"]
+    latest = latest[[c for c in first + ORDER if c in latest.columns]]
+    return latest.loc[:, ~latest.columns.duplicated()]
+
+
+def _signature(paths):
+    sig = []
+    for p in paths:
+        try:
+            st_ = p.stat()
+            sig.append((st_.st_ino, st_.st_size, st_.st_mtime_ns))
+        except FileNotFoundError:
+            sig.append(None)
+    return tuple(sig)
+
+
+class DashboardCache:
+    """
+    One background refresher per Streamlit server. Every REFRESH_SEC it
+    rebuilds the display-ready frames (only for files that changed) and swaps
+    them in as one dict; sessions read that dict and only slice it.
+    Frames are shared between sessions and must not be mutated in place.
+    """
+
+    def __init__(self, interval: float = REFRESH_SEC):
+        self.interval = interval
+        self.views = {}
+        self._sigs = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self):
+        with self._lock:
+            views = dict(self.views)
+            sig = _signature(tier_files())
+            if self._sigs.get("telemetry") != sig or "telemetry" not in views:
+                views["telemetry"] = build_telemetry_view(load_df())
+                self._sigs["telemetry"] = sig
+            sig = _signature(alert_files())
+            if self._sigs.get("alerts") != sig or "alerts" not in views:
+                views["alerts"] = load_alerts_clean()
+                self._sigs["alerts"] = sig
+            # Staleness moves with the clock, so devices are rebuilt every pass
+            views["devices"] = build_devices_view(load_devices())
+            views["refreshed_at"] = time.time()
+            self.views = views
+
+    def get(self):
+        if not self.views:
+            self.refresh()
+        return self.views
+
+    def start(self):
+        if self._thread is not None:
+            return self
+
+        def _loop():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.refresh()
+                except Exception:
+                    pass
+
+        self._thread = threading.Thread(target=_loop, name="dashboard-cache", daemon=True)
+        self._thread.start()
+        return self
+
+
+@st.cache_resource
+def dashboard_cache():
+    return DashboardCache().start()
+
+
+views = dashboard_cache().get()
+df = views["telemetry"]["df"]
+alerts_df = views["alerts"]
+latest = views["devices"]
+
+_files = [p for p in tier_files() if p.exists()]
+st.caption(f"Data dir: {DATA_DIR} ({len(site_dirs()) - 1} site shards)")
 st.caption(
-    f"Exists: {DATA_FILE.exists()} | "
-    f"Size: {os.path.getsize(DATA_FILE) if DATA_FILE.exists() else 0} bytes | "
+    f"Files: {len(_files)} | "
+    f"Size: {sum(os.path.getsize(p) for p in _files)} bytes | "
     f"Rows: {0 if df.empty else len(df)} | "
     f"Display TZ: {DISPLAY_TZ}"
 )
@@ -146,45 +336,19 @@ st.caption(
 if df.empty:
     st.info("No data yet. Please run cloud/api.py (or mqtt bridge) and let the M5StickC send telemetry.")
 else:
-    rename_map = {
-        "metrics.ambient_temp_f": "Temperature (°F)",
-        "metrics.ambient_rh_pct": "Humidity (%)",
-        "metrics.pressure_hpa":   "Air Pressure (hPa)",
-        "metrics.eco2_ppm":       "eCO2 (ppm)",
-        "metrics.tvoc_ppb":       "TVOC (ppb)",
-        "device_id":              "Device ID",
-        "site_id":                "Site ID",
-    }
-    df = df.rename(columns=rename_map)
-
-    order = [
-        "Device ID",
-        "Site ID",
-        "Time",
-        "Temperature (°F)",
-        "Humidity (%)",
-        "Air Pressure (hPa)",
-        "eCO2 (ppm)",
-        "TVOC (ppb)",
-    ]
-    existing = [c for c in order if c in df.columns]
-    others = [c for c in df.columns if c not in existing]
-    df = df[existing + others]
-
-    st.subheader("Latest Data (10 rows)")
-    st.dataframe(df.tail(10), use_container_width=True)
+    if latest is not None:
+        offline = latest[latest["Status"] == "OFFLINE"]
+        for _, r in offline.iterrows():
+            st.warning(f"Device offline: {r['Device ID']} (no data for {r['Staleness (s)']:.0f} s)")
+        st.subheader("Latest Data (per device)")
+        st.dataframe(latest, use_container_width=True)
+    else:
+        st.subheader("Latest Data (10 rows)")
+        st.dataframe(df.tail(10), use_container_width=True)
 
     st.subheader("Trends")
-    plot_cols = [
-        "Temperature (°F)",
-        "Humidity (%)",
-        "Air Pressure (hPa)",
-        "eCO2 (ppm)",
-        "TVOC (ppb)",
-    ]
     if "Time" in df.columns:
-        for col in [c for c in plot_cols if c in df.columns]:
-            series = df.set_index("Time")[col].dropna()
+        for col, series in views["telemetry"]["series"].items():
             if not series.empty:
                 st.line_chart(series, height=180, use_container_width=True)
             else:
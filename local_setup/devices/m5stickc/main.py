@@ -2,7 +2,7 @@ from m5stack import *
 from m5ui import *
 from uiflow import *
 import unit, hat
-import time, machine, network, ujson
+import time, machine, network, ujson, urandom
 
 # ---------- Wi-Fi and server config ----------
 WIFI_SSID = ''
@@ -17,54 +17,213 @@ MQTT_TOPIC = 'dia/lift/site-001/m5stickc/env'
 
 HTTP_URL = 'http://(***):8000/ingest'
 TIME_URL = 'http://(***):8000/now'
+USE_KEEPALIVE = True   # Reuse one TCP connection for /ingest and /now (urequests is the fallback)
+HTTP_TIMEOUT_S = 3     # The server answers within ~1.5 s even when overloaded
+
+# ---------- HTTP client ----------
+def _split_url(url):
+    """'http://host:port/path' -> (host, port, path)."""
+    rest = url.split('://', 1)[-1]
+    hostport, _, path = rest.partition('/')
+    host, _, port = hostport.partition(':')
+    return host, int(port) if port else 80, '/' + path
+
+class KeepAliveHTTP:
+    """Minimal HTTP/1.1 client that keeps one socket open between requests."""
+    def __init__(self, timeout_s=HTTP_TIMEOUT_S):
+        self.sock = None
+        self.addr = None
+        self.timeout_s = timeout_s
+
+    def close(self):
+        if self.sock is not None:
+            try: self.sock.close()
+            except: pass
+        self.sock = None
+
+    def _connect(self, host, port):
+        if self.sock is not None and self.addr == (host, port):
+            return
+        import usocket
+        self.close()
+        s = usocket.socket()
+        s.settimeout(self.timeout_s)
+        s.connect(usocket.getaddrinfo(host, port)[0][-1])
+        self.sock, self.addr = s, (host, port)
+
+    def request(self, method, url, body=None):
+        """Return (status, body bytes). Raises on any connection problem."""
+        host, port, path = _split_url(url)
+        self._connect(host, port)
+        head = '{} {} HTTP/1.1\r\nHost: {}\r\nConnection: keep-alive\r\n'.format(method, path, host)
+        if body is not None:
+            if isinstance(body, str):
+                body = body.encode()
+            head += 'Content-Type: application/json\r\nContent-Length: {}\r\n'.format(len(body))
+        self.sock.write(head.encode() + b'\r\n' + (body or b''))
+        line = self.sock.readline()
+        if not line:
+            raise OSError('connection closed')
+        status = int(line.split(None, 2)[1])
+        length, keep = 0, True
+        while True:
+            line = self.sock.readline()
+            if not line or line == b'\r\n':
+                break
+            k, _, v = line.decode().partition(':')
+            k, v = k.strip().lower(), v.strip().lower()
+            if k == 'content-length':
+                length = int(v)
+            elif k == 'connection' and v == 'close':
+                keep = False
+            elif k == 'transfer-encoding':
+                raise OSError('chunked replies not supported')
+        data = b''
+        while len(data) < length:
+            chunk = self.sock.read(length - len(data))
+            if not chunk:
+                raise OSError('short body')
+            data += chunk
+        if not keep:
+            self.close()
+        return status, data
+
+HTTP = KeepAliveHTTP()
+
+def http_request(method, url, body=None):
+    """(status, body bytes) over the kept-alive socket, reconnecting once
+       (the server may have closed it while idle), else via urequests.
+       The fallback only gets what is left of HTTP_TIMEOUT_S."""
+    t0 = time.ticks_ms()
+    if USE_KEEPALIVE:
+        for _ in range(2):
+            try:
+                return HTTP.request(method, url, body)
+            except Exception as e:
+                HTTP.close()
+                try: print('keep-alive err:', e)
+                except: pass
+    left_s = HTTP_TIMEOUT_S - time.ticks_diff(time.ticks_ms(), t0) / 1000
+    if left_s <= 0:
+        raise OSError('http timeout')
+    import urequests
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    r = urequests.request(method, url, data=body, headers=headers, timeout=left_s)
+    try:
+        return r.status_code, r.content
+    finally:
+        r.close()
+
+# ---------- Idempotency key ----------
+# The server drops retried samples with an already-seen (device_id, boot, seq)
+BOOT_ID = urandom.getrandbits(30)   # Random per boot so seq may restart at 0
+SEQ = 0
+
+# ---------- Reporting rate (advised by the server in each /ingest reply) ----------
+MIN_INTERVAL_S = 5     # Never send more often than this
+INTERVAL_S = 5         # Send at least this often (heartbeat)
+DEADBAND = {}          # metric -> change that triggers an early send ({} = off)
+LAST_SENT = {}         # Metrics of the last sample sent
+HOLD_UNTIL = None      # ticks_ms before which the server asked us not to send
+
+# ---------- Edge aggregation ----------
+# Sensors are read every loop (~800 ms). With AGGREGATE on, each report is the
+# mean of the window in "metrics" plus "agg" = {n, min, max}, the same shape as
+# the server's rollups; otherwise it is the latest point sample.
+AGGREGATE = True
+LOCAL_ECO2_WARN = 2000   # Keep in sync with cloud/rules.py: crossing either
+LOCAL_TVOC_WARN = 1000   # threshold sends the window at once
+METRIC_KEYS = ('ambient_temp_c', 'ambient_rh_pct', 'pressure_hpa', 'eco2_ppm', 'tvoc_ppb')
+AGG = {k: [0, 0.0, None, None] for k in METRIC_KEYS}   # n, sum, min, max (fixed memory)
+ALARM = False            # Above a local threshold at the previous reading
 
 # ---------- Synthetic time tracking ----------
-SERVER_EPOCH_S = 0     # Last synced server epoch time (seconds)
-SERVER_SYNC_MS = 0     # Local ticks_ms when last synced
+# NTP-style: /now?t0=<ticks> answers with the server's receive and transmit
+# times (rx_ms, tx_ms). With our own receive tick t3:
+#   rtt    = (t3 - t0) - (tx_ms - rx_ms)
+#   server time at t3 = tx_ms + rtt / 2
+# Of SYNC_SAMPLES exchanges the one with the smallest rtt is kept (least
+# queueing, so the least asymmetry). Two syncs far enough apart give the
+# oscillator's drift against the server (RATE_PPM), applied between syncs.
+# All integer milliseconds: floats are single precision here, which cannot
+# even hold epoch seconds exactly.
+SERVER_MS = 0          # Server epoch ms at SYNC_TICKS (0 = never synced)
+SYNC_TICKS = 0         # Local ticks_ms of that instant
+RATE_PPM = 0           # Server ms per local ms, minus one, in ppm
 RESYNC_SEC = 6 * 3600  # Resync interval: 6 hours
+SYNC_SAMPLES = 4       # Exchanges per sync
+DRIFT_SPAN_MS = 600000 # Only estimate drift over >= 10 min between syncs
+MAX_RATE_PPM = 500     # Crystal drift is tens of ppm; more is a bad sample
 
-def now_ts():
-    """Return synthetic current Unix seconds. 
+def now_ms():
+    """Return synthetic current Unix milliseconds.
        If not yet synced, fallback to time.time()."""
-    global SERVER_EPOCH_S, SERVER_SYNC_MS
-    if SERVER_EPOCH_S > 0:
-        elapsed_ms = time.ticks_diff(time.ticks_ms(), SERVER_SYNC_MS)
-        return int(SERVER_EPOCH_S + max(0, elapsed_ms // 1000))
+    if SERVER_MS > 0:
+        el = max(0, time.ticks_diff(time.ticks_ms(), SYNC_TICKS))
+        return SERVER_MS + el + el * RATE_PPM // 1000000
     try:
-        return int(time.time())
+        return int(time.time()) * 1000
     except:
         return 0
 
+def now_ts():
+    """Return synthetic current Unix seconds."""
+    return now_ms() // 1000
+
 def need_resync():
-    """Check if resync with server is needed (based on elapsed synthetic time)."""
-    if SERVER_EPOCH_S == 0:
+    """Check if resync with server is needed (based on ticks since the last sync)."""
+    if SERVER_MS == 0:
         return True
-    return (now_ts() - SERVER_EPOCH_S) >= RESYNC_SEC
+    return time.ticks_diff(time.ticks_ms(), SYNC_TICKS) >= RESYNC_SEC * 1000
+
+def time_exchange():
+    """One /now round trip: (rtt ms, server ms at t3, t3 ticks)."""
+    t0 = time.ticks_ms()
+    sc, body = http_request('GET', TIME_URL + '?t0=' + str(t0))
+    t3 = time.ticks_ms()
+    data = ujson.loads(body)
+    rx, tx = data.get('rx_ms'), data.get('tx_ms')
+    if rx is None or tx is None:  # Older server: seconds only
+        return time.ticks_diff(t3, t0), int(data.get('now')) * 1000, t3
+    if data.get('t0') != t0:
+        raise ValueError('stale /now reply')
+    rtt = time.ticks_diff(t3, t0) - (tx - rx)
+    return rtt, tx + rtt // 2, t3
 
 def sync_time():
-    """Sync time from HTTP /now. 
-       Update SERVER_EPOCH_S and SERVER_SYNC_MS."""
-    global SERVER_EPOCH_S, SERVER_SYNC_MS
-    try:
-        import urequests
-        r = urequests.get(TIME_URL)
-        data = r.json()
-        r.close()
-        server_now = int(data.get('now'))
-        if server_now > 1700000000:  # Rough validation: must be year >= 2023
-            SERVER_EPOCH_S = server_now
-            SERVER_SYNC_MS = time.ticks_ms()
-            footer.setText('TIME SYNC OK')
-            try:
-                print('TIME SYNC: server_now=', server_now, ' sync_ms=', SERVER_SYNC_MS)
-            except:
-                pass
-            return True
-    except Exception as e:
+    """Sync time from HTTP /now.
+       Update SERVER_MS and SYNC_TICKS, and RATE_PPM once syncs are far enough apart."""
+    global SERVER_MS, SYNC_TICKS, RATE_PPM
+    best = None
+    for _ in range(SYNC_SAMPLES):
+        try:
+            s = time_exchange()
+        except Exception as e:
+            try: print('Time sync err:', e)
+            except: pass
+            continue
+        if best is None or s[0] < best[0]:
+            best = s
+    if best is None or best[1] < 1700000000000:  # Rough validation: must be year >= 2023
         footer.setText('TIME SYNC ERR')
-        try: print('Time sync err:', e)
-        except: pass
-    return False
+        return False
+    rtt, server_ms, ticks = best
+    offset = 0
+    if SERVER_MS > 0:
+        span = time.ticks_diff(ticks, SYNC_TICKS)
+        offset = server_ms - (SERVER_MS + span + span * RATE_PPM // 1000000)
+        if span >= DRIFT_SPAN_MS:
+            rate = (server_ms - SERVER_MS - span) * 1000000 // span
+            if -MAX_RATE_PPM <= rate <= MAX_RATE_PPM:
+                RATE_PPM = rate if RATE_PPM == 0 else (RATE_PPM + rate) // 2
+    SERVER_MS = server_ms
+    SYNC_TICKS = ticks
+    footer.setText('TIME SYNC OK')
+    try:
+        print('TIME SYNC: server_ms=', server_ms, ' rtt=', rtt, ' offset=', offset, ' ppm=', RATE_PPM)
+    except:
+        pass
+    return True
 
 # ---------- UI ----------
 setScreenColor(0x000000)
@@ -122,7 +281,60 @@ def wifi_connect():
     else:                 footer.setText('WiFi FAIL')
     return sta.isconnected()
 
+# ---------- Aggregation ----------
+def agg_add(metrics):
+    """Fold one reading into the current window."""
+    for k in METRIC_KEYS:
+        v = metrics.get(k)
+        if v is None:
+            continue
+        a = AGG[k]
+        a[0] += 1
+        a[1] += v
+        if a[2] is None or v < a[2]: a[2] = v
+        if a[3] is None or v > a[3]: a[3] = v
+
+def agg_take():
+    """Return (means, agg) for the window and start a new one."""
+    mean, lo, hi, n = {}, {}, {}, 0
+    for k in METRIC_KEYS:
+        a = AGG[k]
+        if a[0]:
+            mean[k] = a[1] / a[0]
+            lo[k] = a[2]
+            hi[k] = a[3]
+            n = max(n, a[0])
+        a[0] = 0; a[1] = 0.0; a[2] = None; a[3] = None
+    return mean, {'n': n, 'min': lo, 'max': hi}
+
+def over_threshold(metrics):
+    eco2, tvoc = metrics.get('eco2_ppm'), metrics.get('tvoc_ppb')
+    return (eco2 is not None and eco2 >= LOCAL_ECO2_WARN) or \
+           (tvoc is not None and tvoc >= LOCAL_TVOC_WARN)
+
 # ---------- Data sending ----------
+def apply_advice(adv):
+    """Adopt the server's recommended interval and deadband (cloud/pacing.py)."""
+    global INTERVAL_S, DEADBAND
+    if not adv:
+        return
+    try:
+        INTERVAL_S = max(MIN_INTERVAL_S, int(adv.get('interval_s', INTERVAL_S)))
+        DEADBAND = adv.get('deadband') or {}
+    except:
+        pass
+
+def changed(metrics):
+    """True if any metric moved past its deadband since the last send."""
+    for k, band in DEADBAND.items():
+        v, last = metrics.get(k), LAST_SENT.get(k)
+        if v is None or last is None:
+            if v is not None or last is not None:
+                return True
+        elif abs(v - last) >= band:
+            return True
+    return False
+
 mqttc = None
 def mqtt_setup():
     """Setup MQTT client."""
@@ -138,6 +350,21 @@ def mqtt_setup():
     mqttc.connect()
     return True
 
+def hold_off(body):
+    """Pause sending for the reply's retry_after seconds (the server is overloaded)."""
+    global HOLD_UNTIL
+    try:
+        secs = int(ujson.loads(body).get('retry_after', 1))
+    except:
+        secs = 1
+    HOLD_UNTIL = time.ticks_add(time.ticks_ms(), max(1, secs) * 1000)
+
+def held_off():
+    global HOLD_UNTIL
+    if HOLD_UNTIL is not None and time.ticks_diff(HOLD_UNTIL, time.ticks_ms()) <= 0:
+        HOLD_UNTIL = None
+    return HOLD_UNTIL is not None
+
 def send_payload(payload):
     """Send telemetry via HTTP or MQTT depending on config."""
     data = ujson.dumps(payload)
@@ -151,11 +378,18 @@ def send_payload(payload):
             return False
     else:
         try:
-            import urequests
-            r = urequests.post(HTTP_URL, data=data, headers={'Content-Type':'application/json'})
-            sc = getattr(r, 'status_code', None); r.close()
-            if sc and sc != 200:
+            sc, body = http_request('POST', HTTP_URL, data)
+            if sc == 202:
+                # Queued for writing: delivered, but back off
+                hold_off(body); footer.setText('HTTP busy'); return True
+            if sc in (429, 503):
+                hold_off(body); footer.setText('HTTP busy'); return False
+            if sc != 200:
                 footer.setText('HTTP {}'.format(sc)); return False
+            try:
+                apply_advice(ujson.loads(body).get('next'))
+            except:
+                pass
             return True
         except Exception as e:
             footer.setText('HTTP err')
@@ -167,11 +401,11 @@ def send_payload(payload):
 MODE_ENV, MODE_GAS = 0, 1
 mode = MODE_ENV
 
-def show_env_page():
-    """Display environmental values page."""
+def show_env_page(env=None):
+    """Display environmental values page (env = (t, h, p) if already read)."""
     title.setText("ENV Monitor")
     row1.setColor(0x00E0FF); row2.setColor(0x00E0FF); row3.setColor(0x00E0FF); row4.setColor(0x444444)
-    t, h, p = read_env3()
+    t, h, p = env if env is not None else read_env3()
     if t is not None:
         f = t * 9.0 / 5.0 + 32.0
         row1.setText("Temp : {:.1f} F".format(f))
@@ -181,11 +415,11 @@ def show_env_page():
     row3.setText("Press: {:.1f} hPa".format(p) if p is not None else "Press: ----.- hPa")
     footer.setText("A")
 
-def show_gas_page():
-    """Display gas values page."""
+def show_gas_page(gas=None):
+    """Display gas values page (gas = (eco2, tvoc) if already read)."""
     title.setText("Gas Monitor")
     row1.setColor(0xFFD75F); row2.setColor(0xFFD75F); row3.setColor(0x444444); row4.setColor(0x444444)
-    eco2, tvoc = read_sgp30()
+    eco2, tvoc = gas if gas is not None else read_sgp30()
     row1.setText("eCO2: {} ppm".format(int(eco2)) if eco2 is not None else "eCO2: ---- ppm")
     row2.setText("TVOC: {} ppb".format(int(tvoc)) if tvoc is not None else "TVOC: ---- ppb")
     row3.setText("")
@@ -210,8 +444,18 @@ while True:
         mode = MODE_GAS if mode == MODE_ENV else MODE_ENV
 
     try:
-        if mode == MODE_ENV: show_env_page()
-        else:                show_gas_page()
+        # One sensor read per loop feeds both the display and the report window
+        t, h, p = read_env3()
+        eco2, tvoc = read_sgp30()
+        metrics = {
+            "ambient_temp_c": t,
+            "ambient_rh_pct": h,
+            "pressure_hpa": p,
+            "eco2_ppm": eco2,
+            "tvoc_ppb": tvoc
+        }
+        if mode == MODE_ENV: show_env_page((t, h, p))
+        else:                show_gas_page((eco2, tvoc))
 
         # Periodically check if time resync is needed (every 6h)
         if time.ticks_diff(time.ticks_ms(), last_resync_check) > 60000:  # Check every 1 min
@@ -219,24 +463,40 @@ while True:
                 sync_time()
             last_resync_check = time.ticks_ms()
 
-        # Publish every 5 seconds
-        if time.ticks_diff(time.ticks_ms(), last_pub) > 5000:
-            t, h, p = read_env3()
-            eco2, tvoc = read_sgp30()
-            payload = {
-                "site_id": "site-001",
-                "device_id": "m5stickc-01",
-                "ts": now_ts(),   # Use synthetic time (server base + ticks)
-                "metrics": {
-                    "ambient_temp_c": t,
-                    "ambient_rh_pct": h,
-                    "pressure_hpa": p,
-                    "eco2_ppm": eco2,
-                    "tvoc_ppb": tvoc
+        if AGGREGATE:
+            agg_add(metrics)
+        # Crossing a local threshold sends immediately, once per crossing
+        alarm = over_threshold(metrics)
+        crossed = alarm and not ALARM
+        ALARM = alarm
+
+        # Publish every INTERVAL_S, or early (after MIN_INTERVAL_S) when a reading
+        # leaves its deadband; both are advised by the server
+        # While the server has asked us to back off, keep aggregating instead
+        elapsed = time.ticks_diff(time.ticks_ms(), last_pub)
+        if not held_off() and (crossed or elapsed >= MIN_INTERVAL_S * 1000):
+            due = elapsed >= INTERVAL_S * 1000
+            moved = not due and not crossed and changed(metrics)
+            if crossed or due or moved:
+                payload = {
+                    "site_id": "site-001",
+                    "device_id": "m5stickc-01",
+                    "ts": now_ts(),   # Use synthetic time (server base + ticks)
+                    "ts_ms": now_ms(),
+                    "boot": BOOT_ID,
+                    "seq": SEQ,
+                    "interval_s": INTERVAL_S,
+                    "reason": "threshold" if crossed else ("change" if moved else "heartbeat"),
+                    "metrics": metrics
                 }
-            }
-            send_payload(payload)
-            last_pub = time.ticks_ms()
+                if AGGREGATE:
+                    payload["metrics"], payload["agg"] = agg_take()
+                SEQ += 1
+                # One retry: safe because the server de-duplicates on seq
+                if not send_payload(payload) and not held_off():
+                    send_payload(payload)
+                LAST_SENT = metrics
+                last_pub = time.ticks_ms()
     except Exception as e:
         footer.setText("ERR: {}".format(e))
 
@@ -0,0 +1,21 @@
+from fastapi.testclient import TestClient
+
+from cloud import router
+
+
+def test_now_answered_by_router_without_site_id():
+    c = TestClient(router.app)
+    r = c.get("/now", params={"t0": 5})
+    assert r.status_code == 200
+    body = r.json()
+    assert body["t0"] == 5
+    assert body["tx_ms"] >= body["rx_ms"] > 1700000000000
+
+
+def test_site_requests_still_need_site_id(monkeypatch):
+    monkeypatch.setattr(router, "RING", router.HashRing(["http://node-a:8001"]))
+    c = TestClient(router.app, follow_redirects=False)
+    assert c.get("/devices").status_code == 400
+    r = c.get("/telemetry", params={"site_id": "site-001"})
+    assert r.status_code == 307
+    assert r.headers["location"].startswith("http://node-a:8001/telemetry?site_id=site-001")